@@ -0,0 +1,64 @@
+import hmac
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+
+from app.config import app_settings, get_logger
+from app.schemas.base_response import BaseResponse
+from app.services.profiler import profile_buffer
+
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+
+def is_admin(request: Request) -> bool:
+    """Whether the request carries the admin token. Always False while the
+    admin token isn't configured"""
+    admin_token = app_settings().ADMIN_TOKEN
+    if not admin_token:
+        return False
+    token = request.headers.get(ADMIN_TOKEN_HEADER, "")
+    return hmac.compare_digest(token.encode(), admin_token.encode())
+
+
+def validate_admin_token(request: Request) -> bool:
+    if not is_admin(request):
+        get_logger().warning("Attempt to use the admin endpoints without admin token")
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin token required",
+        )
+    return True
+
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+    dependencies=[Depends(validate_admin_token)],
+)
+
+
+@router.get(
+    "/profiles",
+    summary="Retrieves the latest sales queries profiles",
+    status_code=status.HTTP_200_OK,
+)
+async def get_profiles() -> BaseResponse:
+    """Returns id, path, profiling reason, profiled function, start time and
+    duration of the latest profiled sales queries, newest first"""
+    return BaseResponse(data=[profile.summary() for profile in profile_buffer().list()])
+
+
+@router.get(
+    "/profiles/{profile_id}",
+    summary="Retrieves a sales query profile",
+    status_code=status.HTTP_200_OK,
+)
+async def get_profile(profile_id: int) -> BaseResponse:
+    """Returns a profiled sales query along with its `cProfile` report of the
+    functions with the highest cumulative time"""
+    profile = profile_buffer().get(profile_id)
+    if profile is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Profile {profile_id} not found",
+        )
+    return BaseResponse(data={**profile.summary(), "report": profile.report})
@@ -0,0 +1,201 @@
+import resource
+import time
+from typing import List
+
+from fastapi import APIRouter, Response, status
+
+from app.api.auth import token_verifier
+from app.config import app_settings
+from app.constants import SALES_ENGINES
+from app.dataloader import dataset_store
+from app.services.admission import fair_queue, rate_limiter
+from app.services.executor import query_executor
+from app.services.metrics import ROUTE_SECONDS, STAGE_SECONDS, render_metric
+from app.services.response_cache import response_cache
+from app.services.sales import data_ready
+from app.services.single_flight import single_flight
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+router = APIRouter(tags=["metrics"])
+
+
+class RouteMetricsMiddleware:
+    """ASGI middleware recording the latency of every HTTP request, labelled
+    by the path template of the matched route so the series stay bounded"""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.perf_counter()
+        status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+
+        async def send_with_status(message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the scope
+            route = scope.get("route")
+            ROUTE_SECONDS.observe(
+                time.perf_counter() - started_at,
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                str(status_code),
+            )
+
+
+def dataset_metrics() -> List[str]:
+    lines = render_metric(
+        "sales_data_ready",
+        "gauge",
+        "Whether the sales data is loaded",
+        [({}, int(data_ready()))],
+    )
+    if app_settings().SALES_ENGINE != SALES_ENGINES["memory"] or not data_ready():
+        return lines
+
+    dataset = dataset_store.dataset
+    lines += render_metric(
+        "sales_dataset_rows", "gauge", "Rows of the sales dataset", [({}, len(dataset))]
+    )
+    lines += render_metric(
+        "sales_dataset_version",
+        "gauge",
+        "Version of the sales dataset",
+        [({}, dataset.version)],
+    )
+    if dataset_store.load_seconds is not None:
+        lines += render_metric(
+            "sales_dataset_load_seconds",
+            "gauge",
+            "Seconds the latest version of the sales dataset took to load",
+            [({}, dataset_store.load_seconds)],
+        )
+    lines += render_metric(
+        "sales_dataset_memory_bytes",
+        "gauge",
+        "Bytes used by the sales dataset by column",
+        [
+            ({"column": column}, compact)
+            for column, _, compact in dataset.memory_report()
+        ],
+    )
+    return lines
+
+
+def cache_metrics() -> List[str]:
+    lines = []
+    for name, stats in (
+        ("sales_token_cache", token_verifier.stats()),
+        ("sales_response_cache", response_cache().stats()),
+    ):
+        lines += render_metric(
+            f"{name}_hits_total", "counter", "Cache hits", [({}, stats["hits"])]
+        )
+        lines += render_metric(
+            f"{name}_misses_total", "counter", "Cache misses", [({}, stats["misses"])]
+        )
+        lines += render_metric(
+            f"{name}_hit_ratio", "gauge", "Cache hit ratio", [({}, stats["hit_ratio"])]
+        )
+        lines += render_metric(
+            f"{name}_size", "gauge", "Cached entries", [({}, stats["size"])]
+        )
+
+    stats = single_flight().stats()
+    lines += render_metric(
+        "sales_singleflight_executions_total",
+        "counter",
+        "Sales queries computed",
+        [({}, stats["executions"])],
+    )
+    lines += render_metric(
+        "sales_singleflight_coalesced_total",
+        "counter",
+        "Sales queries answered by an identical query in flight",
+        [({}, stats["coalesced"])],
+    )
+    lines += render_metric(
+        "sales_singleflight_coalesced_ratio",
+        "gauge",
+        "Ratio of coalesced sales queries",
+        [({}, stats["coalesced_ratio"])],
+    )
+    return lines
+
+
+def executor_metrics() -> List[str]:
+    stats = query_executor().stats()
+    lines = render_metric(
+        "sales_executor_in_flight",
+        "gauge",
+        "Sales queries running or queued",
+        [({}, stats["in_flight"])],
+    )
+    lines += render_metric(
+        "sales_executor_rejected_total",
+        "counter",
+        "Sales queries rejected because the executor was full",
+        [({}, stats["rejected"])],
+    )
+    return lines
+
+
+def admission_metrics() -> List[str]:
+    limits = rate_limiter().stats()
+    queue = fair_queue().stats()
+    lines = render_metric(
+        "sales_rate_limited_total",
+        "counter",
+        "Sales requests rejected because their user was over the rate limit",
+        [({}, limits["limited"])],
+    )
+    lines += render_metric(
+        "sales_fair_queue_queued",
+        "gauge",
+        "Sales queries waiting in the fair queue",
+        [({}, queue["queued"])],
+    )
+    lines += render_metric(
+        "sales_fair_queue_rejected_total",
+        "counter",
+        "Sales queries rejected by the fair queue",
+        [({}, queue["rejected"])],
+    )
+    return lines
+
+
+def render_metrics() -> str:
+    lines = STAGE_SECONDS.render() + ROUTE_SECONDS.render()
+    lines += dataset_metrics() + cache_metrics() + executor_metrics()
+    lines += admission_metrics()
+    # Linux reports the max resident set size in KiB
+    lines += render_metric(
+        "process_max_resident_memory_bytes",
+        "gauge",
+        "Maximum resident set size of the worker",
+        [({}, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)],
+    )
+    return "\n".join(lines) + "\n"
+
+
+@router.get(
+    "/metrics",
+    summary="Exposes the microservice metrics in the Prometheus text format",
+    status_code=status.HTTP_200_OK,
+    response_class=Response,
+)
+async def get_metrics() -> Response:
+    """Returns latency histograms of the request stages and routes along with
+    dataset, caches and executor metrics"""
+    return Response(content=render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
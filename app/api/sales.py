@@ -1,28 +1,180 @@
+import math
+import random
+from concurrent.futures import BrokenExecutor
+from contextlib import AsyncExitStack
 from datetime import date
-from typing import List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from urllib.parse import urlencode
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 from typing_extensions import Self
 
+from app.api.admin import is_admin
 from app.api.auth import validate_token
-from app.config import get_logger
-from app.constants import FILTER_OPERATORS, KEYS_CONSTANTS
+from app.config import app_settings, get_logger
+from app.constants import (
+    BREAKDOWN_ORDERS,
+    FILTER_OPERATORS,
+    INDEXED_KEYS,
+    KEYS_CONSTANTS,
+    SERIES_BUCKETS,
+)
 from app.dataloader import Filter
-from app.schemas.sales_response import SalesPeriodSchema, SalesTotalAvgSchema
-from app.services.sales import SalesService
+from app.schemas.sales_request import SalesBatchRequestSchema
+from app.schemas.sales_response import (
+    SalesBatchSchema,
+    SalesBreakdownSchema,
+    SalesPeriodSchema,
+    SalesSeriesSchema,
+    SalesTotalAvgSchema,
+)
+from app.schemas.serializers import dump_response
+from app.services.admission import (
+    AdmissionRejectedError,
+    AdmissionTimeoutError,
+    admission_client,
+    fair_queue,
+    rate_limiter,
+)
+from app.services.executor import QueryRejectedError, query_executor
+from app.services.export import EXPORT_MEDIA_TYPES, encode_batches, negotiate_format
+from app.services.profiler import (
+    PROFILE_REASONS,
+    ProfileRequest,
+    profile_request,
+    run_with_profile,
+)
+from app.services.response_cache import response_cache
+from app.services.sales import (
+    SalesBatchService,
+    SalesService,
+    at_data_version,
+    data_progress,
+    data_ready,
+    data_version,
+)
+from app.services.single_flight import single_flight
+
+# Seconds clients are asked to wait before retrying while data is loading
+DATA_LOADING_RETRY_AFTER = 5
+# Header asking to profile a request, honored for admins only
+PROFILE_HEADER = "X-Profile"
+
+
+def data_ready_validator():
+    """Rejects sales queries right away while the data is loading, instead of
+    holding them until it's loaded"""
+    if not data_ready():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail={
+                "error_msg": "Sales data is loading, try it later",
+                "progress": data_progress().to_dict(),
+            },
+            headers={"Retry-After": str(DATA_LOADING_RETRY_AFTER)},
+        )
+
+
+def retry_after_header(seconds: float) -> Dict[str, str]:
+    return {"Retry-After": str(max(math.ceil(seconds), 1))}
+
+
+async def admission_control(request: Request) -> None:
+    """Rejects right away the requests of users over their rate limit and
+    sets the user the queries of the request are fairly queued for. Requests
+    without a user ID are limited by client address"""
+    user = getattr(request.state, "user_id", None)
+    if user is None:
+        user = request.client.host if request.client else "anonymous"
+    retry_after = rate_limiter().acquire(user)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, try it later",
+            headers=retry_after_header(retry_after),
+        )
+    admission_client.set(user)
+
+
+async def profiling_selector(request: Request) -> None:
+    """Profiles the queries of the request when an admin asks for it with the
+    `X-Profile` header or when the request is sampled"""
+    reason = None
+    sample_rate = app_settings().PROFILE_SAMPLE_RATE
+    if request.headers.get(PROFILE_HEADER) and is_admin(request):
+        reason = PROFILE_REASONS["header"]
+    elif sample_rate > 0 and random.random() < sample_rate:
+        reason = PROFILE_REASONS["sampled"]
+    profile_request.set(
+        ProfileRequest(path=normalized_query(request).rstrip("?"), reason=reason)
+        if reason
+        else None
+    )
+
 
 router = APIRouter(
-    prefix="/sales", tags=["sales"], dependencies=[Depends(validate_token)]
+    prefix="/sales",
+    tags=["sales"],
+    dependencies=[
+        Depends(validate_token),
+        Depends(admission_control),
+        Depends(data_ready_validator),
+        Depends(profiling_selector),
+    ],
 )
 
 
+def missing_keys_error() -> HTTPException:
+    get_logger().warning("Request received without key values")
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail={"error_msg": "At least one key must be included in the query params"},
+    )
+
+
 def keys_validator(key_employee, key_product, key_store):
     if any([key_employee, key_store, key_product]) is False:
-        get_logger().warning("Request received without key values")
+        raise missing_keys_error()
+
+
+def period_validator(start_period: Optional[date], end_period: Optional[date]):
+    if start_period and end_period and start_period > end_period:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Start period value couldn't be greater than end period one",
+        )
+
+
+def breakdown_validator(group_by: str, order: str):
+    if group_by not in INDEXED_KEYS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={"error_msg": f"group_by must be one of {', '.join(INDEXED_KEYS)}"},
+        )
+    if order not in BREAKDOWN_ORDERS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={"error_msg": f"order must be one of {', '.join(BREAKDOWN_ORDERS)}"},
+        )
+
+
+def bucket_validator(bucket: str):
+    if bucket not in SERIES_BUCKETS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={"error_msg": f"bucket must be one of {', '.join(SERIES_BUCKETS)}"},
+        )
+
+
+def series_validator(start_period: date, end_period: date, bucket: str):
+    max_buckets = app_settings().SERIES_MAX_BUCKETS
+    if SalesService.bucket_count(start_period, end_period, bucket) > max_buckets:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail={
-                "error_msg": "At least one key must be included in the query params"
+                "error_msg": f"Sales series can't have more than {max_buckets} "
+                "buckets, use a shorter period or a larger bucket"
             },
         )
 
@@ -32,36 +184,212 @@ class FilterBuilder:
         self.filters: List[Filter] = []
 
     def with_employee_key(self, key_employee: str) -> Self:
-        employee_filter = Filter(
-            key=KEYS_CONSTANTS["Employee"],
-            operator=FILTER_OPERATORS["eq"],
-            value=key_employee,
-        )
-        self.filters.append(employee_filter)
+        self.filters.append(self._key_filter(KEYS_CONSTANTS["Employee"], key_employee))
         return self
 
     def with_product_key(self, key_product: str) -> Self:
-        product_filter = Filter(
-            key=KEYS_CONSTANTS["Product"],
-            operator=FILTER_OPERATORS["eq"],
-            value=key_product,
-        )
-        self.filters.append(product_filter)
+        self.filters.append(self._key_filter(KEYS_CONSTANTS["Product"], key_product))
         return self
 
     def with_store_key(self, key_store: str) -> Self:
-        store_filter = Filter(
-            key=KEYS_CONSTANTS["Store"],
-            operator=FILTER_OPERATORS["eq"],
-            value=key_store,
-        )
-        self.filters.append(store_filter)
+        self.filters.append(self._key_filter(KEYS_CONSTANTS["Store"], key_store))
+        return self
+
+    def with_period(
+        self, start_period: Optional[date], end_period: Optional[date]
+    ) -> Self:
+        if start_period:
+            self.add_filter(
+                Filter(
+                    key=KEYS_CONSTANTS["Date"],
+                    operator=FILTER_OPERATORS["gte"],
+                    value=start_period,
+                )
+            )
+        if end_period:
+            self.add_filter(
+                Filter(
+                    key=KEYS_CONSTANTS["Date"],
+                    operator=FILTER_OPERATORS["lte"],
+                    value=end_period,
+                )
+            )
         return self
 
     def add_filter(self, filter: Filter) -> Self:
         self.filters.append(filter)
         return self
 
+    @staticmethod
+    def _key_filter(key: str, value: str) -> Filter:
+        """Equality filter of a key value, or `in` filter of a comma-separated
+        list of values (e.g. `S1,S2,S3`)"""
+        values = tuple(dict.fromkeys(item.strip() for item in value.split(",")))
+        values = tuple(item for item in values if item)
+        if not values:
+            # e.g. `key_store=,`, which would match no rows at all
+            raise missing_keys_error()
+        if len(values) == 1:
+            return Filter(key=key, operator=FILTER_OPERATORS["eq"], value=values[0])
+        return Filter(key=key, operator=FILTER_OPERATORS["in"], value=values)
+
+
+def build_filters(
+    key_employee: Optional[str],
+    key_product: Optional[str],
+    key_store: Optional[str],
+    start_period: Optional[date] = None,
+    end_period: Optional[date] = None,
+) -> List[Filter]:
+    """Validates the query params and builds the filters they define"""
+    keys_validator(key_employee, key_product, key_store)
+    return period_filters(
+        key_employee, key_product, key_store, start_period, end_period
+    )
+
+
+def period_filters(
+    key_employee: Optional[str],
+    key_product: Optional[str],
+    key_store: Optional[str],
+    start_period: Optional[date] = None,
+    end_period: Optional[date] = None,
+) -> List[Filter]:
+    """Builds the filters of a period and optional keys"""
+    period_validator(start_period, end_period)
+    filter_builder = FilterBuilder().with_period(start_period, end_period)
+    if key_employee:
+        filter_builder.with_employee_key(key_employee)
+
+    if key_product:
+        filter_builder.with_product_key(key_product)
+
+    if key_store:
+        filter_builder.with_store_key(key_store)
+    return filter_builder.filters
+
+
+def admission_user() -> str:
+    return admission_client.get() or "anonymous"
+
+
+def admission_error(e: Exception) -> HTTPException:
+    """429 for the queries of users over their share, 503 for the ones
+    rejected because the service is overloaded"""
+    if isinstance(e, AdmissionRejectedError) and not isinstance(
+        e, AdmissionTimeoutError
+    ):
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers=retry_after_header(e.retry_after),
+        )
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=str(e),
+        headers=retry_after_header(getattr(e, "retry_after", 1)),
+    )
+
+
+async def run_query(function: Callable, *args: Any, cost: float = 1.0) -> Any:
+    """Runs a sales query in the queries executor once the fair queue admits
+    it for the user of the request, translating its errors"""
+    profiling = profile_request.get()
+    if app_settings().QUERY_EXECUTOR == "process":
+        # Pool processes hold their own data, brought to the app version first
+        function, args = at_data_version, (data_version(), function, *args)
+    try:
+        async with fair_queue().slot(admission_user(), cost):
+            if profiling is None:
+                return await query_executor().run(function, *args)
+            return await run_with_profile(
+                profiling, query_executor().run, function, *args
+            )
+    except (AdmissionRejectedError, QueryRejectedError) as e:
+        raise admission_error(e)
+    except BrokenExecutor:
+        # A worker process died while running the query
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Sales query workers are restarting, try it later",
+            headers=retry_after_header(DATA_LOADING_RETRY_AFTER),
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """Streaming response releasing the admission of its query once sent,
+    even if the client disconnects before the body starts"""
+
+    def __init__(self, *args: Any, admission: AsyncExitStack, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._admission = admission
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self._admission.aclose()
+
+
+def normalized_query(request: Request) -> str:
+    """Path and sorted non-empty query params, so equivalent requests share
+    their cached response"""
+    params = sorted(
+        (key, value) for key, value in request.query_params.multi_items() if value
+    )
+    return f"{request.url.path}?{urlencode(params)}"
+
+
+def if_none_match(request: Request) -> Set[str]:
+    header = request.headers.get("if-none-match", "")
+    return {tag.strip().removeprefix("W/") for tag in header.split(",") if tag}
+
+
+async def cached_response(
+    request: Request, build_body: Callable[[], Awaitable[bytes]]
+) -> Response:
+    """Answers a sales query from the response cache. Clients revalidating
+    the ETag of the current data version get a 304 without the query being
+    computed or serialized again, and identical queries arriving while one
+    is being computed await its response"""
+    cache = response_cache()
+    query = normalized_query(request)
+    version = data_version()
+    etag = cache.etag(query, version)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    revalidated_tags = if_none_match(request)
+    if etag in revalidated_tags or "*" in revalidated_tags:
+        cache.not_modified += 1
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    async def build_cached_body() -> bytes:
+        body = await build_body()
+        cache.put(query, version, body)
+        return body
+
+    profiling = profile_request.get()
+    if profiling is not None and profiling.reason == PROFILE_REASONS["header"]:
+        # Asked to be profiled, so computed even if it's cached
+        body = await build_cached_body()
+    else:
+        body = cache.get(query, version)
+        if body is None:
+            body = await single_flight().run(f"{version}:{query}", build_cached_body)
+    headers.update(profile_headers())
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def profile_headers() -> Dict[str, str]:
+    """Points to the profiles recorded for the current request"""
+    profiling = profile_request.get()
+    if profiling is None or not profiling.profile_ids:
+        return {}
+    return {"X-Profile-Id": ",".join(map(str, profiling.profile_ids))}
+
 
 @router.get(
     "/",
@@ -69,6 +397,7 @@ class FilterBuilder:
     status_code=status.HTTP_200_OK,
 )
 async def get_total_avg_sales(
+    request: Request,
     key_employee: Optional[str] = None,
     key_product: Optional[str] = None,
     key_store: Optional[str] = None,
@@ -78,26 +407,14 @@ async def get_total_avg_sales(
     - KeyEmployee: Filter by employee key
     - KeyProduct: Filter by product key
     - KeyStore: Filter by store"""
-    keys_validator(key_employee, key_product, key_store)
-    # Builds proper filters
-    filter_builder = FilterBuilder()
-    if key_employee:
-        filter_builder.with_employee_key(key_employee)
+    filters = build_filters(key_employee, key_product, key_store)
+    service = SalesService(filters=filters)
 
-    if key_product:
-        filter_builder.with_product_key(key_product)
+    async def build_body() -> bytes:
+        total_avg = await run_query(service.total_avg_sales)
+        return dump_response(total_avg)
 
-    if key_store:
-        filter_builder.with_store_key(key_store)
-
-    service = SalesService(filters=filter_builder.filters)
-    try:
-        total_avg = service.total_avg_sales()
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
-        )
-    return SalesTotalAvgSchema(data=total_avg)
+    return await cached_response(request, build_body)
 
 
 @router.get(
@@ -106,6 +423,7 @@ async def get_total_avg_sales(
     status_code=status.HTTP_200_OK,
 )
 async def get_sales_by_period(
+    request: Request,
     start_period: date,
     end_period: date,
     key_employee: Optional[str] = None,
@@ -118,37 +436,198 @@ async def get_sales_by_period(
     - KeyEmployee: Filter by employee key
     - KeyProduct: Filter by product key
     - KeyStore: Filter by store"""
-    keys_validator(key_employee, key_product, key_store)
-    # Validates dates
-    if start_period > end_period:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Start period value couldn't be greater than end period one",
-        )
-    # Builds proper filters
-    filter_builder = FilterBuilder()
-    start_period_filter = Filter(
-        key=KEYS_CONSTANTS["Date"], operator=FILTER_OPERATORS["gte"], value=start_period
+    filters = build_filters(
+        key_employee, key_product, key_store, start_period, end_period
     )
-    end_period_filter = Filter(
-        key=KEYS_CONSTANTS["Date"], operator=FILTER_OPERATORS["lte"], value=end_period
+    service = SalesService(filters=filters)
+
+    async def build_body() -> bytes:
+        total_sales = await run_query(service.sales_by_period)
+        return dump_response({"amount": total_sales})
+
+    return await cached_response(request, build_body)
+
+
+@router.post(
+    "/batch",
+    summary="Retrieves total & average sales of many queries at once",
+    status_code=status.HTTP_200_OK,
+)
+async def get_sales_batch(batch: SalesBatchRequestSchema) -> SalesBatchSchema:
+    """Fetchs and returns total and average sales of every query, in order.
+    Each query takes the same params as `/sales/` plus an optional
+    `start_period` and `end_period`, and at least one key is required.
+    Queries are evaluated together against the same data, a failed query
+    reports its `error_details` without failing the others"""
+    results: List[Dict[str, Any]] = [{}] * len(batch.queries)
+    filter_sets = []
+    positions = []
+    for position, query in enumerate(batch.queries):
+        try:
+            filter_sets.append(
+                build_filters(
+                    query.key_employee,
+                    query.key_product,
+                    query.key_store,
+                    query.start_period,
+                    query.end_period,
+                )
+            )
+            positions.append(position)
+        except HTTPException as e:
+            results[position] = {"data": None, "error_details": e.detail}
+
+    if filter_sets:
+        service = SalesBatchService(filter_sets=filter_sets)
+        # A batch weighs as much as its queries in the fair queue
+        totals = await run_query(service.total_avg_sales, cost=len(filter_sets))
+        for position, total_avg in zip(positions, totals):
+            if isinstance(total_avg, Exception):
+                results[position] = {"data": None, "error_details": str(total_avg)}
+            else:
+                results[position] = {"data": total_avg, "error_details": None}
+    return Response(
+        content=dump_response(results),
+        media_type="application/json",
+        headers=profile_headers(),
     )
-    filter_builder.add_filter(start_period_filter).add_filter(end_period_filter)
 
-    if key_employee:
-        filter_builder.with_employee_key(key_employee)
 
-    if key_product:
-        filter_builder.with_product_key(key_product)
+@router.get(
+    "/breakdown",
+    summary="Retrieves total, count & average sales per Employee, Product or Store",
+    status_code=status.HTTP_200_OK,
+)
+async def get_sales_breakdown(
+    request: Request,
+    group_by: str,
+    start_period: Optional[date] = None,
+    end_period: Optional[date] = None,
+    key_employee: Optional[str] = None,
+    key_product: Optional[str] = None,
+    key_store: Optional[str] = None,
+    top: int = Query(default=10, ge=1),
+    order: str = BREAKDOWN_ORDERS["desc"],
+) -> SalesBreakdownSchema:
+    """Fetchs and returns the sales per value of a key, ranked by total.
+    - group_by: KeyEmployee, KeyProduct or KeyStore
+    - start_period & end_period (optional) should be given in format YYYY-MM-DD
+    - key_employee, key_product & key_store (optional) filter the sales
+    - top: Number of groups to return (10 by default)
+    - order: desc (highest totals first, by default) or asc"""
+    breakdown_validator(group_by, order)
+    filters = period_filters(
+        key_employee, key_product, key_store, start_period, end_period
+    )
+    service = SalesService(filters=filters)
 
-    if key_store:
-        filter_builder.with_store_key(key_store)
+    async def build_body() -> bytes:
+        breakdown = await run_query(
+            service.breakdown, group_by, top, order == BREAKDOWN_ORDERS["asc"]
+        )
+        return dump_response(breakdown)
+
+    return await cached_response(request, build_body)
+
+
+@router.get(
+    "/series",
+    summary="Retrieves sales per day, week or month of a given period",
+    status_code=status.HTTP_200_OK,
+)
+async def get_sales_series(
+    request: Request,
+    start_period: date,
+    end_period: date,
+    bucket: str = SERIES_BUCKETS["day"],
+    rolling: Optional[int] = Query(default=None, ge=1),
+    key_employee: Optional[str] = None,
+    key_product: Optional[str] = None,
+    key_store: Optional[str] = None,
+) -> SalesSeriesSchema:
+    """Fetchs and returns total and count sales per bucket of a given period.
+    - start_period & end_period should be given in format YYYY-MM-DD to be valid
+    - bucket: day (by default), week (starting on Monday) or month, up to
+      `SERIES_MAX_BUCKETS` buckets
+    - rolling (optional): Number of buckets averaged into `rolling_average`
+    - key_employee, key_product & key_store (optional) filter the sales"""
+    bucket_validator(bucket)
+    filters = period_filters(
+        key_employee, key_product, key_store, start_period, end_period
+    )
+    series_validator(start_period, end_period, bucket)
+    service = SalesService(filters=filters)
 
-    service = SalesService(filters=filter_builder.filters)
+    async def build_body() -> bytes:
+        series = await run_query(service.series, bucket, rolling)
+        return dump_response(series)
+
+    return await cached_response(request, build_body)
+
+
+@router.get(
+    "/export",
+    summary="Streams the sales rows matching the filters as CSV, NDJSON or Arrow",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_200_OK: {
+            "content": {media_type: {} for media_type in EXPORT_MEDIA_TYPES.values()}
+        }
+    },
+)
+async def export_sales(
+    request: Request,
+    start_period: Optional[date] = None,
+    end_period: Optional[date] = None,
+    key_employee: Optional[str] = None,
+    key_product: Optional[str] = None,
+    key_store: Optional[str] = None,
+) -> StreamingResponse:
+    """Streams the sales rows (KeyDate, KeyEmployee, KeyProduct, KeyStore and
+    SaleAmount) matching the filters in chunks, in the format of the `Accept`
+    header:
+    - text/csv (by default)
+    - application/x-ndjson
+    - application/vnd.apache.arrow.stream
+    - start_period, end_period, key_employee, key_product & key_store
+    (optional) filter the rows"""
+    export_format = negotiate_format(request.headers.get("accept"))
+    if export_format is None:
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail={
+                "error_msg": "Accept must be one of "
+                f"{', '.join(EXPORT_MEDIA_TYPES.values())}"
+            },
+        )
+    filters = period_filters(
+        key_employee, key_product, key_store, start_period, end_period
+    )
+    # Exports are admitted as the other queries and hold their places until
+    # the response is sent
+    admission = AsyncExitStack()
     try:
-        total_sales = service.sales_by_period()
+        await admission.enter_async_context(fair_queue().slot(admission_user()))
+        await admission.enter_async_context(query_executor().admission())
+        batches = SalesService(filters=filters).export_batches()
+    except (AdmissionRejectedError, QueryRejectedError) as e:
+        await admission.aclose()
+        raise admission_error(e)
     except Exception as e:
+        await admission.aclose()
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
         )
-    return SalesPeriodSchema(data={"amount": total_sales})
+    except BaseException:
+        await admission.aclose()
+        raise
+    # Batches are read and encoded in the threadpool as the response is sent
+    return AdmittedStreamingResponse(
+        encode_batches(batches, export_format),
+        admission=admission,
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={
+            "Content-Disposition": f'attachment; filename="sales.{export_format}"'
+        },
+    )
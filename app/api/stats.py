@@ -0,0 +1,66 @@
+from fastapi import APIRouter, status
+
+from app.api.auth import token_verifier
+from app.schemas.base_response import BaseResponse
+from app.services.admission import fair_queue, rate_limiter
+from app.services.executor import query_executor
+from app.services.response_cache import response_cache
+from app.services.single_flight import single_flight
+
+router = APIRouter(prefix="/stats", tags=["stats"])
+
+
+@router.get(
+    "/tokens",
+    summary="Retrieves authentication token cache statistics",
+    status_code=status.HTTP_200_OK,
+)
+async def get_token_stats() -> BaseResponse:
+    """Returns hits, misses, hit ratio and size of the verified tokens cache"""
+    return BaseResponse(data=token_verifier.stats())
+
+
+@router.get(
+    "/executor",
+    summary="Retrieves sales queries executor statistics",
+    status_code=status.HTTP_200_OK,
+)
+async def get_executor_stats() -> BaseResponse:
+    """Returns in flight queries, queue depth, rejections and queue wait times
+    of the sales queries executor"""
+    return BaseResponse(data=query_executor().stats())
+
+
+@router.get(
+    "/responses",
+    summary="Retrieves sales responses cache statistics",
+    status_code=status.HTTP_200_OK,
+)
+async def get_response_cache_stats() -> BaseResponse:
+    """Returns hits, misses, 304 answers, hit ratio, size and data version of
+    the sales responses cache"""
+    return BaseResponse(data=response_cache().stats())
+
+
+@router.get(
+    "/singleflight",
+    summary="Retrieves sales queries coalescing statistics",
+    status_code=status.HTTP_200_OK,
+)
+async def get_single_flight_stats() -> BaseResponse:
+    """Returns the number of computed and coalesced sales queries and the
+    ones in flight"""
+    return BaseResponse(data=single_flight().stats())
+
+
+@router.get(
+    "/admission",
+    summary="Retrieves sales requests admission statistics",
+    status_code=status.HTTP_200_OK,
+)
+async def get_admission_stats() -> BaseResponse:
+    """Returns the requests admitted and rate limited per user and the
+    running, queued and rejected queries of the fair queue"""
+    return BaseResponse(
+        data={"rate_limit": rate_limiter().stats(), "fair_queue": fair_queue().stats()}
+    )
@@ -1,14 +1,17 @@
 import logging
 from contextlib import asynccontextmanager
 from functools import cached_property, lru_cache
-from typing import Callable, Dict, Optional, Sequence
+from typing import Callable, Optional, Sequence
 
 from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
-from app.dataloader import load_data
+from app.constants import IDENTITY_TOOLKIT_URL, SALES_ENGINES
+from app.dataloader import DatasetRefresher, DatasetWarmup, SalesDataset, dataset_store
 from app.schemas.base_response import BaseResponse
+from app.services.token_verifier import FIREBASE_CERTS_URL
 
 LOG_LEVELS_MAPPING = {
     "DEBUG": logging.DEBUG,
@@ -30,24 +33,38 @@ class AppSettings(BaseSettings):
     FIREBASE_MSG_SENDER_ID: str = ""
     FIREBASE_APP_ID: str = ""
     ALLOWED_ORIGINS: str = ""
+    FIREBASE_CERTS_URL: str = FIREBASE_CERTS_URL
+    IDENTITY_TOOLKIT_URL: str = IDENTITY_TOOLKIT_URL
+    IDENTITY_TIMEOUT: float = 10.0  # Seconds per login and signup call
+    IDENTITY_MAX_CONNECTIONS: int = 20  # Pooled keep-alive connections
+    IDENTITY_MAX_CONCURRENCY: int = 20  # Login and signup calls in flight at once
+    TOKEN_CACHE_SIZE: int = 10000
+    TOKEN_CACHE_TTL: float = 300.0  # Seconds, capped by each token expiration
+    DATA_REFRESH_INTERVAL: float = 60.0  # Seconds, 0 disables data reloading
+    SALES_ENGINE: str = SALES_ENGINES["memory"]
+    SALES_SHARDS: int = 0  # Shards per app worker, 0 for CPUs / WEB_CONCURRENCY
+    WEB_CONCURRENCY: int = 1  # App worker processes per host, as gunicorn reads it
+    QUERY_EXECUTOR: str = "thread"  # thread or process pool for sales queries
+    QUERY_WORKERS: int = 4
+    QUERY_QUEUE_SIZE: int = 16
+    QUERY_ADMISSION_TIMEOUT: float = 1.0  # Seconds before answering 503
+    RATE_LIMIT_PER_SECOND: float = 0.0  # Sales requests per user, 0 disables it
+    RATE_LIMIT_BURST: int = 20  # Sales requests a user can make at once
+    FAIR_QUEUE_SLOTS: int = 0  # Queries admitted at once, 0 for workers + queue size
+    FAIR_QUEUE_MAX_QUEUED: int = 8  # Queued sales queries per user before 429
+    FAIR_QUEUE_TIMEOUT: float = 1.0  # Seconds a query waits queued before 503
+    FAIR_QUEUE_WEIGHTS: str = ""  # Users weights, e.g. "uid1:4,uid2:0.5"
+    SERIES_MAX_BUCKETS: int = 3660  # Buckets per sales series, 10 years of days
+    RESPONSE_CACHE_SIZE: int = 1024  # 0 disables caching sales responses
+    RESPONSE_CACHE_TTL: float = 60.0  # Seconds
+    ADMIN_TOKEN: str = ""  # Token of the admin endpoints, empty disables them
+    PROFILE_SAMPLE_RATE: float = 0.0  # Ratio of sales queries profiled
+    PROFILE_BUFFER_SIZE: int = 20  # Latest profiles kept
 
     @cached_property
     def APP_LOG_LEVEL(self) -> int:
         return LOG_LEVELS_MAPPING.get(self.LOG_LEVEL, LOG_LEVELS_MAPPING["default"])
 
-    @cached_property
-    def FIREBASE_APP_CONFIG(self) -> Dict[str, str]:
-        app_config = {
-            "apiKey": self.FIREBASE_API_KEY,
-            "authDomain": self.FIREBASE_AUTH_DOMAIN,
-            "projectId": self.FIREBASE_PROJECT_ID,
-            "storageBucket": self.FIREBASE_STORAGE_BUCKET,
-            "messagingSenderId": self.FIREBASE_MSG_SENDER_ID,
-            "appId": self.FIREBASE_APP_ID,
-            "databaseURL": "",
-        }
-        return app_config
-
     model_config = SettingsConfigDict(env_file=".env")
 
 
@@ -74,11 +91,71 @@ def get_logger() -> logging.Logger:
     return logger
 
 
+def log_dataset(dataset: SalesDataset) -> None:
+    logger = get_logger()
+    logger.info("Sales data loaded: %d rows", len(dataset))
+    for column, loaded_nbytes, compact_nbytes in dataset.memory_report():
+        logger.info(
+            "Memory usage of %s: %d bytes loaded, %d bytes compact",
+            column,
+            loaded_nbytes,
+            compact_nbytes,
+        )
+
+
 @asynccontextmanager
 async def load_app_data(app: FastAPI):
-    """Loading parquet data to be used by the microservice"""
-    app_data = load_data()
+    """Loads the sales data and closes the pooled connections of the
+    authentication client on shutdown"""
+    async with load_sales_data(app):
+        yield
+    # The client module reads the settings, so it can only be imported here
+    from app.services.identity import identity_client
+
+    await identity_client().aclose()
+    identity_client.cache_clear()
+
+
+@asynccontextmanager
+async def load_sales_data(app: FastAPI):
+    """Loading parquet data to be used by the microservice. The data is
+    loaded by a background warmup, so the worker starts serving probes right
+    away and reports ready once the data is loaded"""
+    settings = app_settings()
+    refresher = None
+    if settings.SALES_ENGINE == SALES_ENGINES["sharded"]:
+        # Shard workers load their own rows, the app doesn't hold the data. The
+        # engine module reads the settings, so it can only be imported here
+        from app.services.sharded_engine import sharded_engine
+
+        engine = sharded_engine()
+        engine.start()
+        if settings.DATA_REFRESH_INTERVAL > 0:
+            refresher = DatasetRefresher(engine, settings.DATA_REFRESH_INTERVAL)
+            refresher.start()
+        yield
+        if refresher is not None:
+            refresher.stop()
+        engine.shutdown()
+        return
+
+    if settings.SALES_ENGINE == SALES_ENGINES["arrow"]:
+        # The data files are read on demand, only discovered here
+        from app.services.arrow_engine import arrow_engine
+
+        store = arrow_engine()
+        warmup = DatasetWarmup(store)
+    else:
+        store = dataset_store
+        warmup = DatasetWarmup(dataset_store, on_ready=log_dataset)
+    warmup.start()
+    if settings.DATA_REFRESH_INTERVAL > 0:
+        refresher = DatasetRefresher(store, settings.DATA_REFRESH_INTERVAL)
+        refresher.start()
     yield
+    warmup.stop()
+    if refresher is not None:
+        refresher.stop()
 
 
 def build_fastapi_app(dependencies: Optional[Sequence[Callable]] = None) -> FastAPI:
@@ -92,6 +169,7 @@ def build_fastapi_app(dependencies: Optional[Sequence[Callable]] = None) -> Fast
         description="Celes microservice to expose sales related data",
         responses={400: {"model": BaseResponse}, 404: {"model": BaseResponse}},
         lifespan=load_app_data,
+        default_response_class=ORJSONResponse,
     )
 
     settings = app_settings()
@@ -13,4 +13,39 @@ FILTER_OPERATORS = {
     "gte": ">=",
     "lt": "<",
     "lte": "<=",
+    "in": "in",
 }
+
+# Key columns that get an inverted index built at load time
+INDEXED_KEYS = (
+    KEYS_CONSTANTS["Employee"],
+    KEYS_CONSTANTS["Product"],
+    KEYS_CONSTANTS["Store"],
+)
+
+# Columns whose product is the amount of a sale
+AMOUNT_COLUMNS = ("Qty", "CostAmount")
+
+# Engines SalesService can aggregate the sales with: in-memory dataset or
+# out-of-core scans of the parquet files
+SALES_ENGINES = {
+    "memory": "memory",
+    "arrow": "arrow",
+    "sharded": "sharded",
+}
+
+# Ranking orders of grouped sales by total
+BREAKDOWN_ORDERS = {
+    "desc": "desc",
+    "asc": "asc",
+}
+
+# Time buckets sales series can be aggregated by
+SERIES_BUCKETS = {
+    "day": "day",
+    "week": "week",
+    "month": "month",
+}
+
+# Firebase Authentication REST API, a local stand-in can be set for testing
+IDENTITY_TOOLKIT_URL = "https://identitytoolkit.googleapis.com/v1"
@@ -1,15 +1,175 @@
-from dataclasses import dataclass
-from functools import lru_cache
-from typing import Any, List
+import hashlib
+import logging
+import os
+import threading
+import time
+import zlib
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Protocol,
+    Sequence,
+    Tuple,
+)
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 
+from app.constants import AMOUNT_COLUMNS, FILTER_OPERATORS, INDEXED_KEYS, KEYS_CONSTANTS
+from app.snapshot import read_snapshot, snapshot_lock, write_snapshot
 
-@lru_cache()
-def load_data() -> pd.DataFrame:
-    """Loads data from parquet files and caches it"""
-    data = pd.read_parquet("data/", engine="pyarrow")
-    return data
+logger = logging.getLogger(__name__)
+
+# Settings can't be read here (they import this module), so the data
+# directory is taken from the environment
+DATA_DIR = os.environ.get("SALES_DATA_DIR", "data/")
+# Hidden directory, so it isn't taken as data, inside the data directory
+SNAPSHOT_DIR = ".snapshot"
+# Snapshots directory out of the data directory, e.g. when it's read-only
+SNAPSHOT_PATH = os.environ.get("SALES_SNAPSHOT_DIR", "")
+DATA_COLUMNS = [KEYS_CONSTANTS["Date"], *INDEXED_KEYS, *AMOUNT_COLUMNS]
+
+# Stages of a dataset load reported by `LoadProgress`
+LOAD_STAGES = {
+    "pending": "pending",
+    "scanning": "scanning files",
+    "snapshot": "opening snapshot",
+    "loading": "loading files",
+    "building": "building indexes and rollups",
+    "writing": "writing snapshot",
+    "shards": "loading shards",
+    "ready": "ready",
+    "failed": "failed",
+}
+
+
+@dataclass(frozen=True)
+class DataFile:
+    path: str
+    mtime_ns: int
+    size: int
+
+
+def scan_data_files(data_dir: str) -> List[DataFile]:
+    """Lists the data files along with their modification time and size.
+    Hidden and `_` prefixed paths are skipped the same way pyarrow does"""
+    files = []
+    for path in sorted(Path(data_dir).rglob("*")):
+        relative_parts = path.relative_to(data_dir).parts
+        if not path.is_file() or any(
+            part.startswith((".", "_")) for part in relative_parts
+        ):
+            continue
+        stat = path.stat()
+        files.append(
+            DataFile(path=str(path), mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        )
+    return files
+
+
+def data_fingerprint(files: Iterable[DataFile]) -> str:
+    """Hash of the paths, modification times and sizes of the data files.
+    Unlike version counters, it's the same in every process and container
+    reading the same files, and it changes whenever they do"""
+    digest = hashlib.sha256()
+    for file in sorted(files, key=lambda file: file.path):
+        digest.update(f"{file.path}\0{file.mtime_ns}\0{file.size}\n".encode())
+    return digest.hexdigest()[:32]
+
+
+def data_partitioning() -> ds.PartitioningFactory:
+    """Hive partitioning of the data files, e.g. `KeyStore=S1/Month=2024-01/`.
+    Plain (non partitioned) data directories are read as they are"""
+    return ds.HivePartitioning.discover(infer_dictionary=False)
+
+
+def read_data_file(path: str, data_dir: str = DATA_DIR) -> pd.DataFrame:
+    """Reads the sales columns of a parquet file, including the ones given by
+    its hive partition directories"""
+    dataset = ds.dataset(
+        [path],
+        format="parquet",
+        partitioning=data_partitioning(),
+        partition_base_dir=data_dir,
+    )
+    table = dataset.to_table(columns=DATA_COLUMNS)
+    # Partition values may be inferred as numbers, keys are always strings
+    for field in dataset.partitioning.schema:
+        if field.name in INDEXED_KEYS and field.type != pa.string():
+            position = table.schema.get_field_index(field.name)
+            table = table.set_column(
+                position, field.name, table[field.name].cast(pa.string())
+            )
+    return table.to_pandas()
+
+
+@dataclass
+class LoadProgress:
+    """Progress of the latest dataset load, as reported by the readiness
+    probe"""
+
+    stage: str = LOAD_STAGES["pending"]
+    files_total: int = 0
+    files_loaded: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def start(self) -> None:
+        with self._lock:
+            self.stage = LOAD_STAGES["scanning"]
+            self.files_total = self.files_loaded = 0
+            self.started_at, self.finished_at = time.time(), None
+            self.error = None
+
+    def finish(self, error: Optional[Exception] = None) -> None:
+        with self._lock:
+            self.stage = LOAD_STAGES["failed" if error else "ready"]
+            self.error = str(error) if error else None
+            self.finished_at = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            progress = {
+                key: value for key, value in vars(self).items() if key != "_lock"
+            }
+        end = progress["finished_at"] or time.time()
+        progress["elapsed_seconds"] = (
+            end - progress["started_at"] if progress["started_at"] else 0.0
+        )
+        return progress
+
+
+def load_data(
+    files: Sequence[DataFile],
+    data_dir: str = DATA_DIR,
+    progress: Optional[LoadProgress] = None,
+) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Loads the sales columns from the given parquet files along with the
+    position in `files` of the file each row was read from"""
+    frames = []
+    if progress is not None:
+        progress.stage, progress.files_total = LOAD_STAGES["loading"], len(files)
+    for file in files:
+        frames.append(read_data_file(file.path, data_dir))
+        if progress is not None:
+            progress.files_loaded += 1
+    if not frames:
+        return pd.DataFrame(columns=DATA_COLUMNS), np.zeros(0, dtype=np.int32)
+    sources = np.repeat(
+        np.arange(len(frames), dtype=np.int32), [len(frame.index) for frame in frames]
+    )
+    return pd.concat(frames, ignore_index=True), sources
 
 
 @dataclass
@@ -17,3 +177,723 @@ class Filter:
     key: str
     operator: str
     value: Any
+
+
+def to_day_number(value: Any) -> int:
+    """Converts a date like value to its number of days since epoch"""
+    return int(pd.Timestamp(value).to_datetime64().astype("datetime64[D]").astype(int))
+
+
+def period_bounds(days: np.ndarray, filters: Iterable[Filter]) -> Tuple[int, int]:
+    """Returns the [lo, hi) bounds of a sorted day numbers array that satisfy
+    every given date filter, found by binary search instead of comparing each
+    row"""
+    lo, hi = 0, len(days)
+    for filter in filters:
+        # Searching a Python int would copy the int32 days into int64 ones
+        value = days.dtype.type(to_day_number(filter.value))
+        if filter.operator in (FILTER_OPERATORS["gte"], FILTER_OPERATORS["eq"]):
+            lo = max(lo, np.searchsorted(days, value, side="left"))
+        if filter.operator == FILTER_OPERATORS["gt"]:
+            lo = max(lo, np.searchsorted(days, value, side="right"))
+        if filter.operator in (FILTER_OPERATORS["lte"], FILTER_OPERATORS["eq"]):
+            hi = min(hi, np.searchsorted(days, value, side="right"))
+        if filter.operator == FILTER_OPERATORS["lt"]:
+            hi = min(hi, np.searchsorted(days, value, side="left"))
+    return int(lo), int(max(lo, hi))
+
+
+def shard_of(value: Any, shards: int) -> int:
+    """Shard of a key value, stable across processes and dataset versions"""
+    return zlib.crc32(str(value).encode()) % shards
+
+
+def day_range(filters: Iterable[Filter]) -> Tuple[int, int]:
+    """Returns the inclusive [first, last] day numbers satisfying every given
+    date filter. Unbounded ends are the int32 limits"""
+    first, last = np.iinfo(np.int32).min, np.iinfo(np.int32).max
+    for filter in filters:
+        value = to_day_number(filter.value)
+        if filter.operator in (FILTER_OPERATORS["gte"], FILTER_OPERATORS["eq"]):
+            first = max(first, value)
+        if filter.operator == FILTER_OPERATORS["gt"]:
+            first = max(first, value + 1)
+        if filter.operator in (FILTER_OPERATORS["lte"], FILTER_OPERATORS["eq"]):
+            last = min(last, value)
+        if filter.operator == FILTER_OPERATORS["lt"]:
+            last = min(last, value - 1)
+    return int(first), int(last)
+
+
+def positions_dtype(size: int) -> np.dtype:
+    """Smallest integer type able to address `size` rows"""
+    return np.dtype(np.int32 if size <= np.iinfo(np.int32).max else np.int64)
+
+
+class SnapshotArrays:
+    """Lookup structure made of numpy arrays, which can be written to and
+    restored from a dataset snapshot as they are"""
+
+    ARRAYS: Tuple[str, ...] = ()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {name.lstrip("_"): getattr(self, name) for name in self.ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> Any:
+        instance = object.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(instance, name, arrays[name.lstrip("_")])
+        return instance
+
+
+class KeyIndex(SnapshotArrays):
+    """Inverted index that maps each code of a dictionary-encoded key column
+    to the row positions holding it.
+
+    Positions are stored grouped by code (CSR layout): `_positions` holds
+    every row position sorted by code and `_offsets[code]` marks where the
+    rows of a code start, so a lookup is a slice. As the dataset rows are
+    sorted by date, the rows of each code are date-sorted too and a period is
+    narrowed with a binary search over `_days`.
+    """
+
+    ARRAYS = ("_positions", "_offsets", "_days")
+
+    def __init__(self, codes: np.ndarray, cardinality: int, days: np.ndarray) -> None:
+        # Stable sort keeps the positions of each code in ascending order
+        self._positions = np.argsort(codes, kind="stable").astype(
+            positions_dtype(len(codes))
+        )
+        self._offsets = np.searchsorted(
+            codes[self._positions], np.arange(cardinality + 1)
+        )
+        self._days = days[self._positions]
+
+    def lookup(self, code: int, date_filters: Iterable[Filter] = ()) -> np.ndarray:
+        """Returns the ascending row positions that hold the given code,
+        narrowed to the rows that satisfy the given date filters"""
+        if code < 0:
+            return self._positions[:0]
+        start, stop = self._offsets[code], self._offsets[code + 1]
+        lo, hi = period_bounds(self._days[start:stop], date_filters)
+        return self._positions[start + lo : start + hi]
+
+    def lookup_range(self, low: int, high: int) -> np.ndarray:
+        """Returns the ascending row positions that hold a code in [low, high)"""
+        return np.sort(self._positions[self._offsets[low] : self._offsets[high]])
+
+    def count(self, codes: np.ndarray) -> int:
+        """Returns the number of rows that hold any of the given codes"""
+        return int((self._offsets[codes + 1] - self._offsets[codes]).sum())
+
+    def count_range(self, low: int, high: int) -> int:
+        """Returns the number of rows that hold a code in [low, high)"""
+        return int(self._offsets[high] - self._offsets[low])
+
+    def partitions(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns row positions, day numbers and code offsets of every code"""
+        start = self._offsets[0]
+        return self._positions[start:], self._days[start:], self._offsets - start
+
+
+class DailyRollup(SnapshotArrays):
+    """Pre-aggregated sales per key code and day.
+
+    Days of each code are stored sorted (CSR layout as in `KeyIndex`) along
+    with the running sum of sales amounts and the running count of sales, so
+    the totals of any period are two binary searches and a subtraction.
+    """
+
+    ARRAYS = ("_offsets", "_days", "_amounts", "_counts")
+
+    def __init__(self, index: KeyIndex, amounts: np.ndarray) -> None:
+        positions, days, offsets = index.partitions()
+        codes = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        # A new (code, day) group starts wherever the code or the day changes
+        starts = np.flatnonzero(
+            np.diff(codes, prepend=-1) | np.diff(days, prepend=days[:1] - 1)
+        )
+        group_codes = codes[starts]
+        self._offsets = np.searchsorted(group_codes, np.arange(len(offsets)))
+        self._days = days[starts]
+        sums = pd.Series(np.add.reduceat(amounts[positions], starts))
+        counts = pd.Series(np.diff(starts, append=len(positions)))
+        self._amounts = sums.groupby(group_codes).cumsum().to_numpy(np.float64)
+        self._counts = counts.groupby(group_codes).cumsum().to_numpy(np.int64)
+
+    def lookup(
+        self, code: int, date_filters: Iterable[Filter] = ()
+    ) -> Tuple[float, int]:
+        """Returns the sales amount and the number of sales of the given code
+        in the period defined by the given date filters"""
+        if code < 0:
+            return 0.0, 0
+        start, stop = self._offsets[code], self._offsets[code + 1]
+        lo, hi = period_bounds(self._days[start:stop], date_filters)
+        if lo == hi:
+            return 0.0, 0
+        last, before = start + hi - 1, start + lo - 1
+        if lo == 0:
+            return float(self._amounts[last]), int(self._counts[last])
+        return (
+            float(self._amounts[last] - self._amounts[before]),
+            int(self._counts[last] - self._counts[before]),
+        )
+
+    def daily(
+        self, code: int, first_day: int, last_day: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the days with sales of the given code in the inclusive
+        [first_day, last_day] period, along with the sales amount and the
+        number of sales of each day"""
+        if code < 0:
+            return np.empty(0, np.int32), np.empty(0), np.empty(0, np.int64)
+        start, stop = self._offsets[code], self._offsets[code + 1]
+        days = self._days[start:stop]
+        lo = start + np.searchsorted(days, first_day, side="left")
+        hi = start + np.searchsorted(days, last_day, side="right")
+        if lo >= hi:
+            return np.empty(0, np.int32), np.empty(0), np.empty(0, np.int64)
+        # Running sums are turned back into per day values
+        amounts = np.diff(self._amounts[lo:hi], prepend=0.0)
+        counts = np.diff(self._counts[lo:hi], prepend=0)
+        if lo > start:
+            amounts[0] -= self._amounts[lo - 1]
+            counts[0] -= self._counts[lo - 1]
+        return self._days[lo:hi], amounts, counts
+
+    def lookup_many(
+        self, codes: np.ndarray, first_days: np.ndarray, last_days: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Vectorized `lookup` of many codes at once, each one over its own
+        inclusive [first_day, last_day] period. Returns the sales amounts and
+        the numbers of sales in the order of the given codes"""
+        codes = np.asarray(codes, dtype=np.int64)
+        known = codes >= 0
+        codes = np.where(known, codes, 0)
+        keys = self._group_keys()
+        lo = np.searchsorted(keys, _group_key(codes, first_days), side="left")
+        hi = np.searchsorted(keys, _group_key(codes, last_days), side="right")
+        found = known & (hi > lo)
+        last = np.where(found, hi - 1, 0)
+        # Running sums restart at every code, so the sum before the period is
+        # only subtracted when the period doesn't start the code days
+        has_before = found & (lo > self._offsets[codes])
+        before = np.where(has_before, lo - 1, 0)
+        amounts = np.where(
+            found,
+            self._amounts[last] - np.where(has_before, self._amounts[before], 0.0),
+            0.0,
+        )
+        counts = np.where(
+            found,
+            self._counts[last] - np.where(has_before, self._counts[before], 0),
+            0,
+        )
+        return amounts, counts
+
+    def _group_keys(self) -> np.ndarray:
+        """(code, day) of every group packed into sorted int64 keys, so many
+        periods of different codes are found by a single binary search"""
+        keys = getattr(self, "_keys", None)
+        if keys is None:
+            codes = np.repeat(np.arange(len(self._offsets) - 1), np.diff(self._offsets))
+            keys = self._keys = _group_key(codes, self._days)
+        return keys
+
+
+def _group_key(codes: np.ndarray, days: np.ndarray) -> np.ndarray:
+    """Packs codes and int32 day numbers into int64 keys sorted by code and
+    then by day"""
+    offset_days = np.asarray(days, dtype=np.int64) - np.iinfo(np.int32).min
+    return (np.asarray(codes, dtype=np.int64) << 32) | offset_days
+
+
+class SalesDataset:
+    """Compact columnar sales data along with the lookup structures built
+    once at load time.
+
+    Key columns are dictionary-encoded to int32 codes over their sorted
+    values, `KeyDate` is kept as int32 day numbers and `Qty * CostAmount` as a
+    float64 amount column. Rows are sorted by date so any period is a
+    contiguous slice. Every row also keeps the position in `files` of the
+    data file it was read from, so a new version can drop the rows of the
+    changed files instead of loading everything again.
+    """
+
+    def __init__(
+        self,
+        data: pd.DataFrame,
+        files: Optional[Sequence[DataFile]] = None,
+        sources: Optional[np.ndarray] = None,
+    ) -> None:
+        if files is None:
+            files = [DataFile(path="", mtime_ns=0, size=0)]
+        if sources is None:
+            sources = np.zeros(len(data.index), dtype=np.int32)
+        days, amounts, codes, dictionaries = self._encode(data)
+        self._build(
+            days,
+            amounts,
+            codes,
+            dictionaries,
+            sources,
+            list(files),
+            self._loaded_nbytes_by_file(data, files, sources),
+            version=0,
+        )
+
+    @staticmethod
+    def _encode(
+        data: pd.DataFrame,
+    ) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        days = (
+            pd.to_datetime(data[KEYS_CONSTANTS["Date"]])
+            .to_numpy()
+            .astype("datetime64[D]")
+            .astype(np.int32)
+        )
+        quantities, costs = (
+            data[column].to_numpy(np.float64) for column in AMOUNT_COLUMNS
+        )
+        codes: Dict[str, np.ndarray] = {}
+        dictionaries: Dict[str, np.ndarray] = {}
+        for key in INDEXED_KEYS:
+            key_codes, uniques = pd.factorize(data[key], sort=True)
+            codes[key] = key_codes.astype(np.int32)
+            dictionaries[key] = np.asarray(uniques, dtype=object)
+        return days, quantities * costs, codes, dictionaries
+
+    @staticmethod
+    def _loaded_nbytes_by_file(
+        data: pd.DataFrame, files: Sequence[DataFile], sources: np.ndarray
+    ) -> Dict[str, pd.Series]:
+        columns = data[DATA_COLUMNS]
+        if len(files) == 1:
+            return {files[0].path: columns.memory_usage(index=False, deep=True)}
+        return {
+            file.path: columns[sources == position].memory_usage(index=False, deep=True)
+            for position, file in enumerate(files)
+        }
+
+    def _build(
+        self,
+        days: np.ndarray,
+        amounts: np.ndarray,
+        codes: Dict[str, np.ndarray],
+        dictionaries: Dict[str, np.ndarray],
+        sources: np.ndarray,
+        files: List[DataFile],
+        loaded_nbytes: Dict[str, pd.Series],
+        version: int,
+    ) -> None:
+        order = np.argsort(days, kind="stable")
+        self.days = days[order]
+        self.amounts = amounts[order]
+        self.codes = {key: key_codes[order] for key, key_codes in codes.items()}
+        self.dictionaries = dictionaries
+        self.sources = sources[order]
+        self.files = files
+        self.version = version
+        self.fingerprint = data_fingerprint(files)
+        self._loaded_nbytes = loaded_nbytes
+
+        self.indexes: Dict[str, KeyIndex] = {
+            key: KeyIndex(key_codes, len(self.dictionaries[key]), self.days)
+            for key, key_codes in self.codes.items()
+        }
+        self.rollups: Dict[str, DailyRollup] = {
+            key: DailyRollup(index, self.amounts) for key, index in self.indexes.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def to_snapshot(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """Returns the dataset arrays, derived structures included, and the
+        metadata needed to restore it from a snapshot"""
+        arrays = {"days": self.days, "amounts": self.amounts, "sources": self.sources}
+        for key in self.codes:
+            arrays[f"codes.{key}"] = self.codes[key]
+            arrays[f"dictionary.{key}"] = self.dictionaries[key]
+            for name, values in self.indexes[key].to_arrays().items():
+                arrays[f"index.{key}.{name}"] = values
+            for name, values in self.rollups[key].to_arrays().items():
+                arrays[f"rollup.{key}.{name}"] = values
+        metadata = {
+            "version": self.version,
+            "files": [asdict(file) for file in self.files],
+            "loaded_nbytes": {
+                path: {column: int(value) for column, value in nbytes.items()}
+                for path, nbytes in self._loaded_nbytes.items()
+            },
+        }
+        return arrays, metadata
+
+    @classmethod
+    def from_snapshot(
+        cls, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]
+    ) -> "SalesDataset":
+        """Restores a dataset from its snapshot arrays without copying them"""
+        dataset = object.__new__(cls)
+        dataset.days = arrays["days"]
+        dataset.amounts = arrays["amounts"]
+        dataset.sources = arrays["sources"]
+        dataset.codes = {key: arrays[f"codes.{key}"] for key in INDEXED_KEYS}
+        dataset.dictionaries = {
+            key: arrays[f"dictionary.{key}"] for key in INDEXED_KEYS
+        }
+        dataset.files = [DataFile(**file) for file in metadata["files"]]
+        dataset.version = metadata["version"]
+        dataset.fingerprint = data_fingerprint(dataset.files)
+        dataset._loaded_nbytes = {
+            path: pd.Series(nbytes)
+            for path, nbytes in metadata["loaded_nbytes"].items()
+        }
+        dataset.indexes = {}
+        dataset.rollups = {}
+        for key in INDEXED_KEYS:
+            dataset.indexes[key] = KeyIndex.from_arrays(
+                cls._prefixed_arrays(arrays, f"index.{key}.")
+            )
+            dataset.rollups[key] = DailyRollup.from_arrays(
+                cls._prefixed_arrays(arrays, f"rollup.{key}.")
+            )
+        return dataset
+
+    @staticmethod
+    def _prefixed_arrays(
+        arrays: Dict[str, np.ndarray], prefix: str
+    ) -> Dict[str, np.ndarray]:
+        return {
+            name[len(prefix) :]: values
+            for name, values in arrays.items()
+            if name.startswith(prefix)
+        }
+
+    def merge(
+        self,
+        data: pd.DataFrame,
+        files: Sequence[DataFile],
+        sources: np.ndarray,
+        removed: Iterable[str] = (),
+    ) -> "SalesDataset":
+        """Returns the next dataset version: the rows read from the `removed`
+        files are dropped and the rows of `data` (read from `files`) added"""
+        removed = set(removed)
+        kept_files = [file for file in self.files if file.path not in removed]
+        # Old file positions are remapped to their position among kept files
+        file_positions = np.full(len(self.files), -1, dtype=np.int32)
+        position = 0
+        for old_position, file in enumerate(self.files):
+            if file.path not in removed:
+                file_positions[old_position] = position
+                position += 1
+        kept_sources = file_positions[self.sources]
+        keep = kept_sources >= 0
+
+        days, amounts, codes, dictionaries = self._encode(data)
+        merged_codes: Dict[str, np.ndarray] = {}
+        merged_dictionaries: Dict[str, np.ndarray] = {}
+        for key in INDEXED_KEYS:
+            dictionary = np.union1d(self.dictionaries[key], dictionaries[key])
+            merged_codes[key] = np.concatenate(
+                [
+                    _recode(self.codes[key][keep], self.dictionaries[key], dictionary),
+                    _recode(codes[key], dictionaries[key], dictionary),
+                ]
+            )
+            merged_dictionaries[key] = dictionary
+
+        loaded_nbytes = {
+            path: nbytes
+            for path, nbytes in self._loaded_nbytes.items()
+            if path not in removed
+        }
+        loaded_nbytes.update(self._loaded_nbytes_by_file(data, files, sources))
+        dataset = object.__new__(SalesDataset)
+        dataset._build(
+            np.concatenate([self.days[keep], days]),
+            np.concatenate([self.amounts[keep], amounts]),
+            merged_codes,
+            merged_dictionaries,
+            np.concatenate([kept_sources[keep], sources + len(kept_files)]),
+            kept_files + list(files),
+            loaded_nbytes,
+            version=self.version + 1,
+        )
+        return dataset
+
+    def take(self, positions: np.ndarray) -> "SalesDataset":
+        """Returns a dataset of the rows at the given positions, with the same
+        dictionaries and version, and its own indexes and rollups"""
+        dataset = object.__new__(SalesDataset)
+        dataset._build(
+            self.days[positions],
+            self.amounts[positions],
+            {key: codes[positions] for key, codes in self.codes.items()},
+            self.dictionaries,
+            self.sources[positions],
+            self.files,
+            self._loaded_nbytes,
+            version=self.version,
+        )
+        return dataset
+
+    def shard(self, key: str, shard: int, shards: int) -> "SalesDataset":
+        """Returns the rows whose `key` value belongs to the given shard out of
+        `shards` (See `shard_of`)"""
+        dictionary_shards = np.fromiter(
+            (shard_of(value, shards) for value in self.dictionaries[key]),
+            dtype=np.int32,
+            count=len(self.dictionaries[key]),
+        )
+        return self.take(np.flatnonzero(dictionary_shards[self.codes[key]] == shard))
+
+    def encode(self, key: str, value: Any) -> int:
+        """Returns the code of a key value, -1 if the value isn't present"""
+        dictionary = self.dictionaries[key]
+        try:
+            code = int(np.searchsorted(dictionary, value))
+        except TypeError:
+            return -1
+        if code < len(dictionary) and dictionary[code] == value:
+            return code
+        return -1
+
+    @property
+    def rollups_nbytes(self) -> int:
+        return sum(rollup.nbytes for rollup in self.rollups.values())
+
+    def memory_report(self) -> List[Tuple[str, int, int]]:
+        """Returns (column, loaded bytes, compact bytes) for every column
+        along with the bytes used by the indexes and rollups"""
+        loaded_nbytes = sum(self._loaded_nbytes.values())
+        report = [
+            (
+                KEYS_CONSTANTS["Date"],
+                loaded_nbytes[KEYS_CONSTANTS["Date"]],
+                self.days.nbytes,
+            ),
+            (
+                " * ".join(AMOUNT_COLUMNS),
+                loaded_nbytes[list(AMOUNT_COLUMNS)].sum(),
+                self.amounts.nbytes,
+            ),
+        ]
+        for key, codes in self.codes.items():
+            dictionary_nbytes = pd.Series(self.dictionaries[key]).memory_usage(
+                index=False, deep=True
+            )
+            report.append((key, loaded_nbytes[key], codes.nbytes + dictionary_nbytes))
+        report.append(("Sources", 0, self.sources.nbytes))
+        report.append(
+            ("Indexes", 0, sum(index.nbytes for index in self.indexes.values()))
+        )
+        report.append(("Rollups", 0, self.rollups_nbytes))
+        return [(column, int(raw), int(compact)) for column, raw, compact in report]
+
+
+def _recode(
+    codes: np.ndarray, dictionary: np.ndarray, merged_dictionary: np.ndarray
+) -> np.ndarray:
+    """Translates codes over `dictionary` into codes over a merged dictionary
+    holding all its values"""
+    # Missing values (-1 codes) pick the trailing -1 of the mapping
+    mapping = np.append(np.searchsorted(merged_dictionary, dictionary), -1)
+    return mapping.astype(np.int32)[codes]
+
+
+class DatasetStore:
+    """Holds the current dataset version.
+
+    New versions are built out of the data files that changed since the
+    current one and swapped in atomically, so requests keep using the version
+    they started with while a new one is being built. Every version is also
+    written as a memory-mapped snapshot (See `app/snapshot.py`): workers open
+    the snapshot matching the data files instead of decoding the parquet
+    files again, and share its pages through the OS page cache. Snapshots
+    are best-effort: when they can't be used the parquet files are loaded.
+    """
+
+    def __init__(
+        self,
+        data_dir: str = DATA_DIR,
+        snapshot: bool = True,
+        snapshot_dir: str = SNAPSHOT_PATH,
+    ) -> None:
+        self._data_dir = data_dir
+        self._snapshot_dir = (
+            (snapshot_dir or os.path.join(data_dir, SNAPSHOT_DIR)) if snapshot else None
+        )
+        self._dataset: Optional[SalesDataset] = None
+        self._lock = threading.Lock()
+        self.progress = LoadProgress()
+        # Seconds the latest change of version took to load
+        self.load_seconds: Optional[float] = None
+
+    @property
+    def dataset(self) -> SalesDataset:
+        if self._dataset is None:
+            self.refresh()
+        return self._dataset
+
+    @property
+    def ready(self) -> bool:
+        """Whether a dataset version is loaded, without loading it"""
+        return self._dataset is not None
+
+    def refresh(self) -> bool:
+        """Loads the data files added or changed since the current version and
+        swaps in the new version. Returns whether there were changes"""
+        with self._lock:
+            self.progress.start()
+            started_at = time.perf_counter()
+            try:
+                changed = self._refresh()
+            except Exception as e:
+                self.progress.finish(error=e)
+                raise
+            self.progress.finish()
+            if changed:
+                self.load_seconds = time.perf_counter() - started_at
+            return changed
+
+    def _refresh(self) -> bool:
+        files = scan_data_files(self._data_dir)
+        current = self._dataset
+        if current is not None and set(current.files) == set(files):
+            return False
+        if self._snapshot_dir is None:
+            self._dataset = self._next_version(current, files)
+            return True
+
+        with ExitStack() as stack:
+            self.progress.stage = LOAD_STAGES["snapshot"]
+            try:
+                stack.enter_context(snapshot_lock(self._snapshot_dir))
+                snapshot = read_snapshot(self._snapshot_dir)
+                writable = True
+            except OSError as e:
+                # e.g. a read-only volume or a file in place of the directory
+                logger.warning(msg="Sales data snapshot couldn't be used", exc_info=e)
+                snapshot, writable = None, False
+            dataset = None
+            if snapshot is not None:
+                dataset = SalesDataset.from_snapshot(*snapshot)
+            if dataset is None or set(dataset.files) != set(files):
+                # A stale snapshot is still a good base to load the delta
+                dataset = self._next_version(current or dataset, files)
+                if writable:
+                    self.progress.stage = LOAD_STAGES["writing"]
+                    self._write_snapshot(dataset)
+        self._dataset = dataset
+        return True
+
+    def _next_version(
+        self, current: Optional[SalesDataset], files: List[DataFile]
+    ) -> SalesDataset:
+        if current is None:
+            data, sources = load_data(files, self._data_dir, self.progress)
+            self.progress.stage = LOAD_STAGES["building"]
+            return SalesDataset(data, files, sources)
+
+        current_files = {file.path: file for file in current.files}
+        scanned_files = set(files)
+        removed = [
+            path for path, file in current_files.items() if file not in scanned_files
+        ]
+        added = [file for file in files if current_files.get(file.path) != file]
+        logger.info(
+            "Reloading sales data: %d new or changed files, %d removed",
+            len(added),
+            len(removed),
+        )
+        data, sources = load_data(added, self._data_dir, self.progress)
+        self.progress.stage = LOAD_STAGES["building"]
+        return current.merge(data, added, sources, removed)
+
+    def _write_snapshot(self, dataset: SalesDataset) -> None:
+        try:
+            write_snapshot(self._snapshot_dir, *dataset.to_snapshot())
+        except OSError as e:
+            logger.warning(msg="Sales data snapshot couldn't be written", exc_info=e)
+
+
+class Refreshable(Protocol):
+    def refresh(self) -> bool: ...
+
+
+class DataSource(Refreshable, Protocol):
+    @property
+    def dataset(self) -> Any: ...
+
+
+class DatasetRefresher(threading.Thread):
+    """Background thread that periodically reloads (or discovers again, for
+    the engines reading the data files on demand) the changed data files"""
+
+    def __init__(self, store: Refreshable, interval: float) -> None:
+        super().__init__(name="dataset-refresher", daemon=True)
+        self._store = store
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            try:
+                self._store.refresh()
+            except Exception as e:
+                logger.error(msg="Sales data couldn't be reloaded", exc_info=e)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+
+class DatasetWarmup(threading.Thread):
+    """Background thread loading the dataset (or discovering the data files)
+    at startup, so the worker answers probes (and rejects sales queries fast)
+    while it's loading. Failed loads are retried"""
+
+    RETRY_INTERVAL = 5.0
+
+    def __init__(
+        self,
+        store: DataSource,
+        on_ready: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        super().__init__(name="dataset-warmup", daemon=True)
+        self._store = store
+        self._on_ready = on_ready
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                dataset = self._store.dataset
+            except Exception as e:
+                logger.error(msg="Sales data couldn't be loaded", exc_info=e)
+                self._stopped.wait(self.RETRY_INTERVAL)
+                continue
+            if self._on_ready is not None:
+                self._on_ready(dataset)
+            return
+
+    def stop(self) -> None:
+        # Not joined: shutting down doesn't wait for a load in progress
+        self._stopped.set()
+
+
+dataset_store = DatasetStore()
+
+
+def load_dataset() -> SalesDataset:
+    """Returns the current version of the sales dataset, loading it from the
+    parquet files the first time"""
+    return dataset_store.dataset
@@ -1,17 +1,26 @@
-from fastapi import HTTPException, Response, status
+from fastapi import Response, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
+from app.api.admin import router as admin_router
 from app.api.auth import router as auth_router
+from app.api.metrics import RouteMetricsMiddleware
+from app.api.metrics import router as metrics_router
 from app.api.sales import router as sales_router
-from app.config import build_fastapi_app, get_logger
-from app.dataloader import load_data
+from app.api.stats import router as stats_router
+from app.config import build_fastapi_app
 from app.schemas.base_response import BaseResponse
+from app.schemas.serializers import dump_response
+from app.services.sales import data_progress, data_ready
 
 app = build_fastapi_app()
 app.include_router(sales_router)
 app.include_router(auth_router)
+app.include_router(stats_router)
+app.include_router(metrics_router)
+app.include_router(admin_router)
+app.add_middleware(RouteMetricsMiddleware)
 
 
 # App exceptions handlers
@@ -21,10 +30,9 @@ async def http_exception_handler(request, exc):
     the microservice response schema
     """
     response = Response(
-        content=BaseResponse(
-            error_details=str(exc),
-        ).model_dump_json(),
+        content=dump_response(error_details=str(exc)),
         status_code=exc.status_code,
+        headers=getattr(exc, "headers", None),
     )
     response.headers["Content-Type"] = "application/json"
     return response
@@ -37,7 +45,7 @@ async def validation_exception_handler(request, exc):
     """
     errors = jsonable_encoder(exc.errors())
     response = Response(
-        content=BaseResponse(error_details=errors).model_dump_json(),
+        content=dump_response(error_details=errors),
         status_code=status.HTTP_400_BAD_REQUEST,
     )
     response.headers["Content-Type"] = "application/json"
@@ -46,11 +54,27 @@ async def validation_exception_handler(request, exc):
 
 @app.get("/", status_code=204)
 async def health_check():
-    """Simple health check endpoint"""
-    try:
-        load_data()
-    except Exception as e:
-        get_logger().error(e)
-        raise HTTPException(status_code=500, detail=e)
+    """Simple health check endpoint, it never waits for the data to load"""
+    if not data_ready():
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response(status_code=204)
+
 
+@app.get("/livez", status_code=204)
+async def liveness_check():
+    """Liveness probe: the worker is up and serving requests"""
     return Response(status_code=204)
+
+
+@app.get("/readyz", status_code=200)
+async def readiness_check() -> BaseResponse:
+    """Readiness probe: 200 once the sales data is loaded and 503 while it's
+    loading. Both report the progress of the latest data load"""
+    progress = data_progress().to_dict()
+    if not data_ready():
+        return Response(
+            content=dump_response(progress, "Sales data is loading"),
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            media_type="application/json",
+        )
+    return Response(content=dump_response(progress), media_type="application/json")
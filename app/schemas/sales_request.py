@@ -0,0 +1,27 @@
+from datetime import date
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+# Most filter sets accepted by a single batch request
+MAX_BATCH_SIZE = 500
+
+
+class SalesQuerySchema(BaseModel):
+    key_employee: Optional[str] = Field(default=None, examples=["E1"])
+    key_product: Optional[str] = Field(default=None, examples=["P1"])
+    key_store: Optional[str] = Field(default=None, examples=["S1"])
+    start_period: Optional[date] = Field(
+        default=None, description="Period start (YYYY-MM-DD)"
+    )
+    end_period: Optional[date] = Field(
+        default=None, description="Period end (YYYY-MM-DD)"
+    )
+
+
+class SalesBatchRequestSchema(BaseModel):
+    queries: List[SalesQuerySchema] = Field(
+        description="Filter sets evaluated in the given order",
+        min_length=1,
+        max_length=MAX_BATCH_SIZE,
+    )
@@ -1,4 +1,5 @@
-from typing import Dict, Optional
+from datetime import date
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel
 from pydantic.fields import Field
@@ -30,3 +31,43 @@ class SalesTotalAvgSchema(BaseResponse):
         ],
         default=None,
     )
+
+
+class SalesBatchSchema(BaseResponse):
+    data: Optional[List[SalesTotalAvgSchema]] = Field(
+        description="Total and average sales of every query, in request order. "
+        "A failed query has its error details instead",
+        default=None,
+    )
+
+
+class SalesGroup(BaseModel):
+    key: str = Field(description="Value of the grouped key", examples=["S1"])
+    total: float = Field(description="Total sales", examples=[125698.34])
+    count: int = Field(description="Number of sales", examples=[2])
+    average: float = Field(description="Average sales", examples=[62849.17])
+
+
+class SalesBreakdownSchema(BaseResponse):
+    data: Optional[List[SalesGroup]] = Field(
+        description="Total, count and average sales per group, ranked by total",
+        default=None,
+    )
+
+
+class SalesPoint(BaseModel):
+    period: date = Field(description="First day of the bucket", examples=["2024-01-01"])
+    total: float = Field(description="Total sales", examples=[125698.34])
+    count: int = Field(description="Number of sales", examples=[2])
+    rolling_average: Optional[float] = Field(
+        default=None,
+        description="Average total of the buckets in the rolling window",
+        examples=[98421.7],
+    )
+
+
+class SalesSeriesSchema(BaseResponse):
+    data: Optional[List[SalesPoint]] = Field(
+        description="Sales per time bucket of the period, empty buckets included",
+        default=None,
+    )
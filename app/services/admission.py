@@ -0,0 +1,242 @@
+import asyncio
+import heapq
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from app.config import app_settings
+
+# User the sales queries of the current request are admitted for
+admission_client: ContextVar[Optional[str]] = ContextVar(
+    "admission_client", default=None
+)
+
+
+class AdmissionRejectedError(Exception):
+    """Request rejected for exceeding the limits of its user, `retry_after`
+    being the seconds it's worth waiting before retrying"""
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionTimeoutError(AdmissionRejectedError):
+    """Query rejected for waiting too long for a slot, the service being
+    overloaded rather than its user over their share"""
+
+
+class TokenBucket:
+    """`burst` tokens refilled at `rate` tokens per second"""
+
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, burst: float, now: float) -> None:
+        self.tokens = burst
+        self.updated_at = now
+
+    def take(self, rate: float, burst: float, now: float) -> float:
+        """Takes a token, returning 0 or the seconds until one is available
+        when there are none left"""
+        self.tokens = min(burst, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class RateLimiter:
+    """Token bucket rate limit per user: a user makes up to `burst` requests
+    at once and `rate` requests per second after that. Buckets of the
+    `max_users` users seen most recently are kept, a user seen again after
+    being evicted starts with a full bucket. A `rate` of 0 disables it.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        max_users: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._rate = rate
+        self._burst = max(burst, 1)
+        self._max_users = max_users
+        self._clock = clock
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._admitted = 0
+        self._limited = 0
+
+    def acquire(self, user: str) -> float:
+        """Returns 0 when the request of the user is admitted, otherwise the
+        seconds until it would be"""
+        if self._rate <= 0:
+            return 0.0
+        now = self._clock()
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            bucket = self._buckets[user] = TokenBucket(self._burst, now)
+            if len(self._buckets) > self._max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user)
+        retry_after = bucket.take(self._rate, self._burst, now)
+        if retry_after:
+            self._limited += 1
+        else:
+            self._admitted += 1
+        return retry_after
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rate": self._rate,
+            "burst": self._burst,
+            "users": len(self._buckets),
+            "admitted": self._admitted,
+            "limited": self._limited,
+        }
+
+
+class FairQueue:
+    """Weighted fair queuing of the sales queries of different users.
+
+    At most `slots` queries run at once. Once they are all taken, queries
+    wait and every freed slot goes to the waiting query with the lowest
+    virtual finish time: each query finishes `cost / weight` after the
+    previous query of its user or after the current virtual time, whichever
+    is later. A user flooding queries only delays their own queries and users
+    with a higher weight (1 by default) get proportionally more slots. A user
+    can't have more than `max_queued` queries waiting, those raise
+    `AdmissionRejectedError`, and a query can't wait longer than `timeout`
+    seconds, those raise `AdmissionTimeoutError`.
+    """
+
+    def __init__(
+        self,
+        slots: int = 4,
+        max_queued: int = 8,
+        timeout: float = 1.0,
+        weights: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self._slots = slots
+        self._max_queued = max_queued
+        self._timeout = timeout
+        self._weights = weights or {}
+        self._running = 0
+        self._virtual_time = 0.0
+        # (finish time, arrival, user, future) of the waiting queries
+        self._waiting: List[Tuple[float, int, str, asyncio.Future]] = []
+        self._arrivals = 0
+        self._queued: Dict[str, int] = {}
+        self._finish: Dict[str, float] = {}
+        self._admitted = 0
+        self._rejected = 0
+
+    @asynccontextmanager
+    async def slot(self, user: str, cost: float = 1.0) -> AsyncIterator[None]:
+        """Holds a slot for a query of the user while in the context"""
+        await self._acquire(user, cost)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, user: str, cost: float) -> None:
+        if self._running < self._slots and not self._queued:
+            self._running += 1
+            self._admitted += 1
+            return
+        if self._queued.get(user, 0) >= self._max_queued:
+            self._rejected += 1
+            raise AdmissionRejectedError(
+                "Too many queries of the user queued, try it later", self._timeout
+            )
+
+        finish = max(self._virtual_time, self._finish.get(user, 0.0))
+        finish += cost / self._weights.get(user, 1.0)
+        self._finish[user] = finish
+        self._queued[user] = self._queued.get(user, 0) + 1
+        self._arrivals += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (finish, self._arrivals, user, future))
+        try:
+            await asyncio.wait_for(future, self._timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over while giving up
+                self._release()
+            else:
+                future.cancel()
+                self._unqueue(user)
+            if isinstance(e, asyncio.TimeoutError):
+                self._rejected += 1
+                raise AdmissionTimeoutError(
+                    "Queries waited too long to run, try it later", self._timeout
+                )
+            raise
+        self._admitted += 1
+
+    def _release(self) -> None:
+        """Hands the slot over to the next query or frees it"""
+        while self._waiting:
+            finish, _, user, future = heapq.heappop(self._waiting)
+            if future.cancelled():
+                continue
+            self._unqueue(user)
+            self._virtual_time = finish
+            future.set_result(None)
+            return
+        self._running -= 1
+
+    def _unqueue(self, user: str) -> None:
+        self._queued[user] -= 1
+        if not self._queued[user]:
+            # Finish times don't matter anymore for users with nothing queued
+            del self._queued[user]
+            del self._finish[user]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "slots": self._slots,
+            "running": self._running,
+            "queued": sum(self._queued.values()),
+            "queued_users": len(self._queued),
+            "admitted": self._admitted,
+            "rejected": self._rejected,
+        }
+
+
+def parse_weights(weights: str) -> Dict[str, float]:
+    """Weights by user of a `user:weight,...` string"""
+    parsed = {}
+    for item in filter(None, (item.strip() for item in weights.split(","))):
+        user, _, weight = item.rpartition(":")
+        if not user or float(weight) <= 0:
+            raise ValueError(f"Invalid fair queue weight {item!r}")
+        parsed[user.strip()] = float(weight)
+    return parsed
+
+
+@lru_cache
+def rate_limiter() -> RateLimiter:
+    settings = app_settings()
+    return RateLimiter(
+        rate=settings.RATE_LIMIT_PER_SECOND, burst=settings.RATE_LIMIT_BURST
+    )
+
+
+@lru_cache
+def fair_queue() -> FairQueue:
+    settings = app_settings()
+    return FairQueue(
+        # As many queries as the executor admits, so its queue fills up too
+        slots=settings.FAIR_QUEUE_SLOTS
+        or settings.QUERY_WORKERS + settings.QUERY_QUEUE_SIZE,
+        max_queued=settings.FAIR_QUEUE_MAX_QUEUED,
+        timeout=settings.FAIR_QUEUE_TIMEOUT,
+        weights=parse_weights(settings.FAIR_QUEUE_WEIGHTS),
+    )
@@ -0,0 +1,283 @@
+import threading
+from functools import lru_cache
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from app.constants import AMOUNT_COLUMNS, FILTER_OPERATORS, KEYS_CONSTANTS
+from app.dataloader import (
+    DATA_DIR,
+    DataFile,
+    Filter,
+    LoadProgress,
+    data_fingerprint,
+    data_partitioning,
+    scan_data_files,
+)
+from app.services.export import EXPORT_AMOUNT_COLUMN, EXPORT_SCHEMA
+
+# Hive partition holding the YYYY-MM month of the sales in a directory
+MONTH_PARTITION = "Month"
+
+# Scan settings bounding the memory used by a query
+SCAN_BATCH_SIZE = 64 * 1024
+SCAN_BATCH_READAHEAD = 2
+SCAN_FRAGMENT_READAHEAD = 2
+
+COMPARISONS = {
+    FILTER_OPERATORS["eq"]: lambda field, value: field == value,
+    FILTER_OPERATORS["gt"]: lambda field, value: field > value,
+    FILTER_OPERATORS["gte"]: lambda field, value: field >= value,
+    FILTER_OPERATORS["lt"]: lambda field, value: field < value,
+    FILTER_OPERATORS["lte"]: lambda field, value: field <= value,
+}
+
+
+class ArrowSalesEngine:
+    """Out-of-core sales aggregation over the parquet files.
+
+    Filters are pushed down to the `pyarrow.dataset` scan: hive partition
+    directories (e.g. `KeyStore=S1/Month=2024-01/`) and parquet row-group
+    statistics skip the data that can't match, and only the amount columns
+    are read, batch by batch, so memory stays bounded whatever the data size.
+    """
+
+    def __init__(self, data_dir: str = DATA_DIR) -> None:
+        self._data_dir = data_dir
+        self._dataset: Optional[ds.Dataset] = None
+        self._files: List[DataFile] = []
+        self._lock = threading.Lock()
+        # Increased every time the discovered data files change
+        self.version = -1
+        # Fingerprint of the discovered data files (See `data_fingerprint`)
+        self.fingerprint: Optional[str] = None
+        self.progress = LoadProgress()
+
+    @property
+    def dataset(self) -> ds.Dataset:
+        """Discovered data files, discovered the first time they are needed
+        and then again by `refresh`"""
+        if self._dataset is None:
+            self.refresh()
+        return self._dataset
+
+    @property
+    def ready(self) -> bool:
+        """Whether the data files are discovered, without discovering them"""
+        return self._dataset is not None
+
+    def refresh(self) -> bool:
+        """Discovers the data files again so new or changed files are picked
+        up. Returns whether there were changes. Discovery scans the data
+        directory, so it runs in a background thread (See `DatasetRefresher`)
+        rather than on the event loop"""
+        with self._lock:
+            self.progress.start()
+            try:
+                changed = self._refresh()
+            except Exception as e:
+                self.progress.finish(error=e)
+                raise
+            self.progress.finish()
+            return changed
+
+    def _refresh(self) -> bool:
+        files = scan_data_files(self._data_dir)
+        # Files are only discovered, they are read by the queries
+        self.progress.files_total = self.progress.files_loaded = len(files)
+        if self._dataset is not None and files == self._files:
+            return False
+        self._dataset = ds.dataset(
+            self._data_dir, format="parquet", partitioning=data_partitioning()
+        )
+        self._files = files
+        self.fingerprint = data_fingerprint(files)
+        self.version += 1
+        return True
+
+    def aggregate(self, filters: List[Filter]) -> Tuple[float, int]:
+        """Returns the sales amount and the number of sales matching the
+        filters"""
+        total, count = 0.0, 0
+        for batch in self._scan(filters, list(AMOUNT_COLUMNS)):
+            total += pc.sum(self._amounts(batch)).as_py() or 0.0
+            count += batch.num_rows
+        return total, count
+
+    def group_totals(
+        self, filters: List[Filter], group_by: str
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the values of the `group_by` key along with the sales
+        amount and the number of sales of each one matching the filters.
+        Every batch is reduced to its groups as it's read"""
+        partials = []
+        for batch in self._scan(filters, [group_by, *AMOUNT_COLUMNS]):
+            batch_groups = (
+                pa.table(
+                    {
+                        "key": batch[group_by].cast(pa.string()),
+                        "amount": self._amounts(batch),
+                    }
+                )
+                .group_by("key")
+                .aggregate([("amount", "sum"), ("amount", "count")])
+            )
+            partials.append(batch_groups)
+        if not partials:
+            return np.empty(0, dtype=object), np.empty(0), np.empty(0, dtype=np.int64)
+        groups = (
+            pa.concat_tables(partials)
+            .group_by("key")
+            .aggregate([("amount_sum", "sum"), ("amount_count", "sum")])
+        )
+        return (
+            groups["key"].to_numpy(),
+            groups["amount_sum_sum"].to_numpy(),
+            groups["amount_count_sum"].to_numpy(),
+        )
+
+    def export_batches(
+        self, filters: List[Filter], chunk_size: int = SCAN_BATCH_SIZE
+    ) -> Iterator[pa.RecordBatch]:
+        """Record batches of the rows matching the filters, in the export
+        schema. The scan is set up right away, so invalid filters fail before
+        any row is read"""
+        scanner = self._scanner(
+            filters,
+            [
+                *(name for name in EXPORT_SCHEMA.names if name != EXPORT_AMOUNT_COLUMN),
+                *AMOUNT_COLUMNS,
+            ],
+            chunk_size,
+        )
+        return self._export_batches(scanner)
+
+    def _export_batches(self, scanner: ds.Scanner) -> Iterator[pa.RecordBatch]:
+        for batch in scanner.to_batches():
+            if batch.num_rows == 0:
+                continue
+            yield pa.RecordBatch.from_arrays(
+                [
+                    *(
+                        batch[field.name].cast(field.type)
+                        for field in EXPORT_SCHEMA
+                        if field.name != EXPORT_AMOUNT_COLUMN
+                    ),
+                    self._amounts(batch),
+                ],
+                schema=EXPORT_SCHEMA,
+            )
+
+    def _scan(
+        self, filters: List[Filter], columns: List[str]
+    ) -> Iterator[pa.RecordBatch]:
+        """Non-empty batches of the given columns of the rows matching the
+        filters"""
+        for batch in self._scanner(filters, columns).to_batches():
+            if batch.num_rows > 0:
+                yield batch
+
+    def _scanner(
+        self,
+        filters: List[Filter],
+        columns: List[str],
+        batch_size: int = SCAN_BATCH_SIZE,
+    ) -> ds.Scanner:
+        dataset = self.dataset
+        return dataset.scanner(
+            columns=columns,
+            filter=self.build_expression(dataset.schema, filters),
+            batch_size=batch_size,
+            batch_readahead=SCAN_BATCH_READAHEAD,
+            fragment_readahead=SCAN_FRAGMENT_READAHEAD,
+        )
+
+    @staticmethod
+    def _amounts(batch: pa.RecordBatch) -> pa.Array:
+        quantity_column, cost_column = AMOUNT_COLUMNS
+        return pc.multiply(
+            batch[quantity_column].cast(pa.float64()),
+            batch[cost_column].cast(pa.float64()),
+        )
+
+    @staticmethod
+    def build_expression(
+        schema: pa.Schema, filters: List[Filter]
+    ) -> Optional[ds.Expression]:
+        """Translates the filters into a dataset expression. Date filters
+        also bound the month partition when the data is partitioned by month
+        """
+        expressions = []
+        for filter in filters:
+            field_type = schema.field(filter.key).type
+            value = filter.value
+            if filter.operator == FILTER_OPERATORS["in"]:
+                if filter.key == KEYS_CONSTANTS["Date"]:
+                    raise ValueError(f"Filtering {filter.key} by in is not supported")
+                expressions.append(
+                    ds.field(filter.key).isin(pa.array(list(value)).cast(field_type))
+                )
+                continue
+            if filter.key == KEYS_CONSTANTS["Date"]:
+                value = pd.Timestamp(value).date()
+                if MONTH_PARTITION in schema.names:
+                    expressions.append(
+                        month_expression(
+                            schema, filter.operator, value.strftime("%Y-%m")
+                        )
+                    )
+            expressions.append(
+                COMPARISONS[filter.operator](
+                    ds.field(filter.key), pa.scalar(value).cast(field_type)
+                )
+            )
+        if not expressions:
+            return None
+        expression = expressions[0]
+        for other in expressions[1:]:
+            expression = expression & other
+        return expression
+
+
+def month_expression(schema: pa.Schema, operator: str, month: str) -> ds.Expression:
+    """Expression over the month partition that keeps every month holding
+    dates that may satisfy a date filter"""
+    field = ds.field(MONTH_PARTITION)
+    month = pa.scalar(month).cast(schema.field(MONTH_PARTITION).type)
+    if operator in (FILTER_OPERATORS["gt"], FILTER_OPERATORS["gte"]):
+        return field >= month
+    if operator in (FILTER_OPERATORS["lt"], FILTER_OPERATORS["lte"]):
+        return field <= month
+    return field == month
+
+
+def write_partitioned_data(source_dir: str, target_dir: str) -> None:
+    """Rewrites the parquet files of `source_dir` into `target_dir`
+    partitioned by store and month, streaming the data batch by batch"""
+    dataset = ds.dataset(source_dir, format="parquet", partitioning=data_partitioning())
+    columns = {name: ds.field(name) for name in dataset.schema.names}
+    columns[MONTH_PARTITION] = pc.strftime(
+        ds.field(KEYS_CONSTANTS["Date"]), format="%Y-%m"
+    )
+    partitioning = ds.partitioning(
+        pa.schema(
+            [(KEYS_CONSTANTS["Store"], pa.string()), (MONTH_PARTITION, pa.string())]
+        ),
+        flavor="hive",
+    )
+    ds.write_dataset(
+        dataset.scanner(columns=columns, batch_size=SCAN_BATCH_SIZE),
+        target_dir,
+        format="parquet",
+        partitioning=partitioning,
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+
+@lru_cache
+def arrow_engine() -> ArrowSalesEngine:
+    return ArrowSalesEngine()
@@ -0,0 +1,118 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache, partial
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple
+
+from app.config import app_settings
+
+QUERY_EXECUTORS = {
+    "thread": ThreadPoolExecutor,
+    # Spawned, as forked processes would inherit the locks held by the threads
+    # of the app (e.g. the data refresher) and wait on them forever
+    "process": partial(
+        ProcessPoolExecutor, mp_context=multiprocessing.get_context("spawn")
+    ),
+}
+
+
+class QueryRejectedError(Exception):
+    pass
+
+
+def _timed_call(function: Callable, *args: Any) -> Tuple[float, Any]:
+    """Runs the function in the pool returning the (wall clock) time it
+    started at, so the time spent queued can be measured across processes"""
+    return time.time(), function(*args)
+
+
+class QueryExecutor:
+    """Runs blocking sales queries out of the event loop in a bounded pool.
+
+    At most `workers + queue_size` queries are admitted at once: `workers` of
+    them run and the rest wait in the pool queue. A query that can't be
+    admitted within `admission_timeout` seconds is rejected right away, so
+    callers can answer fast instead of piling requests up.
+    """
+
+    def __init__(
+        self,
+        kind: str = "thread",
+        workers: int = 4,
+        queue_size: int = 16,
+        admission_timeout: float = 1.0,
+    ) -> None:
+        self._pool: Executor = QUERY_EXECUTORS[kind](max_workers=workers)
+        self._kind = kind
+        self._workers = workers
+        self._capacity = workers + queue_size
+        self._admission_timeout = admission_timeout
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    async def run(self, function: Callable, *args: Any) -> Any:
+        """Runs the function in the pool and returns its result. Raises
+        `QueryRejectedError` if it can't be admitted in time"""
+        async with self.admission():
+            submitted_at = time.time()
+            loop = asyncio.get_running_loop()
+            started_at, result = await loop.run_in_executor(
+                self._pool, _timed_call, function, *args
+            )
+        wait = max(started_at - submitted_at, 0.0)
+        self._completed += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        return result
+
+    @asynccontextmanager
+    async def admission(self) -> AsyncIterator[None]:
+        """Holds one of the places of the admitted queries while in the
+        context, for work run out of the pool (e.g. streamed exports). Raises
+        `QueryRejectedError` if it can't be admitted in time"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._capacity)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self._admission_timeout)
+        except asyncio.TimeoutError:
+            self._rejected += 1
+            raise QueryRejectedError("Too many queries in progress, try it later")
+
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "kind": self._kind,
+            "workers": self._workers,
+            "capacity": self._capacity,
+            "in_flight": self._in_flight,
+            "queue_depth": max(self._in_flight - self._workers, 0),
+            "completed": self._completed,
+            "rejected": self._rejected,
+            "avg_wait_seconds": (
+                self._total_wait / self._completed if self._completed else 0.0
+            ),
+            "max_wait_seconds": self._max_wait,
+        }
+
+
+@lru_cache
+def query_executor() -> QueryExecutor:
+    settings = app_settings()
+    return QueryExecutor(
+        kind=settings.QUERY_EXECUTOR,
+        workers=settings.QUERY_WORKERS,
+        queue_size=settings.QUERY_QUEUE_SIZE,
+        admission_timeout=settings.QUERY_ADMISSION_TIMEOUT,
+    )
@@ -0,0 +1,151 @@
+"""Streaming export of sales rows.
+
+Rows matching a query are produced as Arrow record batches of at most
+`EXPORT_CHUNK_ROWS` rows, their keys decoded, and every batch is encoded as
+soon as it's produced, so memory doesn't grow with the size of the export.
+"""
+
+import io
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.csv as csv
+
+from app.constants import KEYS_CONSTANTS
+
+EXPORT_CHUNK_ROWS = 64 * 1024
+
+EXPORT_AMOUNT_COLUMN = "SaleAmount"
+
+# Columns of the exported rows, the amount being `Qty * CostAmount`
+EXPORT_SCHEMA = pa.schema(
+    [
+        (KEYS_CONSTANTS["Date"], pa.date32()),
+        (KEYS_CONSTANTS["Employee"], pa.string()),
+        (KEYS_CONSTANTS["Product"], pa.string()),
+        (KEYS_CONSTANTS["Store"], pa.string()),
+        (EXPORT_AMOUNT_COLUMN, pa.float64()),
+    ]
+)
+
+EXPORT_FORMATS = {
+    "csv": "csv",
+    "ndjson": "ndjson",
+    "arrow": "arrow",
+}
+
+EXPORT_MEDIA_TYPES = {
+    EXPORT_FORMATS["csv"]: "text/csv; charset=utf-8",
+    EXPORT_FORMATS["ndjson"]: "application/x-ndjson",
+    EXPORT_FORMATS["arrow"]: "application/vnd.apache.arrow.stream",
+}
+
+# Accepted media types, wildcards pick CSV
+ACCEPTED_MEDIA_TYPES = {
+    "*/*": EXPORT_FORMATS["csv"],
+    "text/*": EXPORT_FORMATS["csv"],
+    "text/csv": EXPORT_FORMATS["csv"],
+    "application/x-ndjson": EXPORT_FORMATS["ndjson"],
+    "application/ndjson": EXPORT_FORMATS["ndjson"],
+    "application/vnd.apache.arrow.stream": EXPORT_FORMATS["arrow"],
+}
+
+
+def negotiate_format(accept: Optional[str]) -> Optional[str]:
+    """Export format of the preferred media type of an `Accept` header, CSV
+    when there's none. None if no accepted media type can be exported"""
+    if not accept or not accept.strip():
+        return EXPORT_FORMATS["csv"]
+
+    candidates = []
+    for position, media_range in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            candidates.append((-quality, position, media_type.lower()))
+
+    for _, _, media_type in sorted(candidates):
+        if media_type in ACCEPTED_MEDIA_TYPES:
+            return ACCEPTED_MEDIA_TYPES[media_type]
+    return None
+
+
+def rows_batch(
+    days: np.ndarray,
+    keys: Dict[str, pa.Array],
+    amounts: np.ndarray,
+) -> pa.RecordBatch:
+    """Record batch of exported rows from `int32` day numbers, decoded keys
+    and sale amounts"""
+    return pa.RecordBatch.from_arrays(
+        [
+            pa.array(days, type=pa.date32()),
+            keys[KEYS_CONSTANTS["Employee"]],
+            keys[KEYS_CONSTANTS["Product"]],
+            keys[KEYS_CONSTANTS["Store"]],
+            pa.array(amounts, type=pa.float64()),
+        ],
+        schema=EXPORT_SCHEMA,
+    )
+
+
+def _drain(sink: io.BytesIO) -> bytes:
+    chunk = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return chunk
+
+
+def _csv(data, include_header: bool) -> bytes:
+    sink = io.BytesIO()
+    csv.write_csv(data, sink, csv.WriteOptions(include_header=include_header))
+    return sink.getvalue()
+
+
+def csv_chunks(batches: Iterable[pa.RecordBatch]) -> Iterator[bytes]:
+    # The header goes out first, even if no row matches
+    yield _csv(EXPORT_SCHEMA.empty_table(), include_header=True)
+    for batch in batches:
+        yield _csv(batch, include_header=False)
+
+
+def ndjson_chunks(batches: Iterable[pa.RecordBatch]) -> Iterator[bytes]:
+    for batch in batches:
+        yield b"".join(
+            orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE)
+            for row in batch.to_pylist()
+        )
+
+
+def arrow_chunks(batches: Iterable[pa.RecordBatch]) -> Iterator[bytes]:
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, EXPORT_SCHEMA) as writer:
+        yield _drain(sink)
+        for batch in batches:
+            writer.write_batch(batch)
+            yield _drain(sink)
+    # End of stream marker
+    yield _drain(sink)
+
+
+EXPORT_ENCODERS: Dict[str, Callable[[Iterable[pa.RecordBatch]], Iterator[bytes]]] = {
+    EXPORT_FORMATS["csv"]: csv_chunks,
+    EXPORT_FORMATS["ndjson"]: ndjson_chunks,
+    EXPORT_FORMATS["arrow"]: arrow_chunks,
+}
+
+
+def encode_batches(
+    batches: Iterable[pa.RecordBatch], export_format: str
+) -> Iterator[bytes]:
+    """Encodes the batches in the given format, one chunk per batch"""
+    return EXPORT_ENCODERS[export_format](batches)
@@ -0,0 +1,116 @@
+import asyncio
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+import httpx
+
+from app.config import app_settings
+from app.constants import IDENTITY_TOOLKIT_URL
+
+
+class IdentityError(Exception):
+    """Error answered by the Identity Toolkit, `code` being its error message
+    code (e.g. `EMAIL_EXISTS`)"""
+
+    def __init__(self, code: str, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+
+
+class IdentityUnavailableError(Exception):
+    pass
+
+
+class IdentityClient:
+    """Async client of the Firebase Authentication (Identity Toolkit) API.
+
+    Requests go through a pool of at most `max_connections` keep-alive
+    connections, so they don't pay a new TLS handshake each, and never block
+    the event loop. At most `max_concurrency` requests are in flight at once:
+    a request that can't start within `timeout` seconds, times out or can't
+    reach the API raises `IdentityUnavailableError`.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = IDENTITY_TOOLKIT_URL,
+        timeout: float = 10.0,
+        max_connections: int = 20,
+        max_concurrency: int = 20,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ) -> None:
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            params={"key": api_key},
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            transport=transport,
+        )
+        self._timeout = timeout
+        self._max_concurrency = max_concurrency
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def sign_up(self, email: str, password: str) -> Dict[str, Any]:
+        """Creates a user, returning its `localId` (uid) and ID token"""
+        return await self._call(
+            "accounts:signUp",
+            {"email": email, "password": password, "returnSecureToken": True},
+        )
+
+    async def sign_in(self, email: str, password: str) -> Dict[str, Any]:
+        """Signs a user in, returning its `idToken` and `expiresIn` seconds"""
+        return await self._call(
+            "accounts:signInWithPassword",
+            {"email": email, "password": password, "returnSecureToken": True},
+        )
+
+    async def _call(self, method: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_concurrency)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self._timeout)
+        except asyncio.TimeoutError:
+            raise IdentityUnavailableError(
+                "Too many authentication requests in progress, try it later"
+            )
+        try:
+            response = await self._client.post(f"/{method}", json=payload)
+        except httpx.TransportError as e:
+            raise IdentityUnavailableError(
+                f"Authentication service couldn't be reached: {e!r}"
+            )
+        finally:
+            self._slots.release()
+
+        if response.is_error:
+            raise self._error(response)
+        return response.json()
+
+    @staticmethod
+    def _error(response: httpx.Response) -> IdentityError:
+        """Error of a failed response. Messages hold the error code, sometimes
+        followed by details (e.g. `WEAK_PASSWORD : Password should be...`)"""
+        try:
+            message = response.json()["error"]["message"]
+        except (ValueError, KeyError, TypeError):
+            message = f"HTTP {response.status_code}"
+        return IdentityError(message.split(" : ")[0].strip(), message)
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+@lru_cache
+def identity_client() -> IdentityClient:
+    settings = app_settings()
+    return IdentityClient(
+        api_key=settings.FIREBASE_API_KEY,
+        base_url=settings.IDENTITY_TOOLKIT_URL,
+        timeout=settings.IDENTITY_TIMEOUT,
+        max_connections=settings.IDENTITY_MAX_CONNECTIONS,
+        max_concurrency=settings.IDENTITY_MAX_CONCURRENCY,
+    )
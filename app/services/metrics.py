@@ -0,0 +1,168 @@
+"""Latency histograms and Prometheus text exposition of the microservice.
+
+Observations are a bisect and a few additions under a lock, cheap enough to
+leave on for every request. Histograms keep cumulative counts only, they're
+rendered on demand when `/metrics` is scraped.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Upper bounds, in seconds, of the latency buckets
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Sample = Tuple[Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(str(value))}"' for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metric(
+    name: str, kind: str, documentation: str, samples: Iterable[Sample]
+) -> List[str]:
+    """Lines of a metric family in the Prometheus text format"""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+    return lines
+
+
+class Histogram:
+    """Latency histogram with one series per combination of label values"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._label_names = tuple(label_names)
+        self._buckets = tuple(sorted(buckets))
+        # Label values -> [count per bucket (the last one for +Inf), sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        position = bisect_left(self._buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = [[0] * (len(self._buckets) + 1), 0.0, 0]
+                self._series[label_values] = series
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self, *label_values: str) -> Optional[Tuple[List[int], float, int]]:
+        """Cumulative bucket counts, sum and count of a series"""
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                return None
+            counts, total, count = list(series[0]), series[1], series[2]
+        cumulative, running = [], 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return cumulative, total, count
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            label_values = sorted(self._series)
+        for values in label_values:
+            cumulative, total, count = self.snapshot(*values)
+            labels = dict(zip(self._label_names, values))
+            bounds = self._buckets + (float("inf"),)
+            for bound, bucket_count in zip(bounds, cumulative):
+                bucket_labels = _labels({**labels, "le": _number(bound)})
+                lines.append(f"{self.name}_bucket{bucket_labels} {bucket_count}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "sales_stage_duration_seconds",
+    "Latency of the stages of a sales request",
+    ("stage",),
+)
+ROUTE_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Latency of the HTTP requests by route",
+    ("method", "route", "status"),
+)
+
+
+class measure_stage:
+    """Context manager recording the latency of a stage"""
+
+    __slots__ = ("_stage", "_started_at")
+
+    def __init__(self, stage: str) -> None:
+        self._stage = stage
+
+    def __enter__(self) -> None:
+        self._started_at = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        STAGE_SECONDS.observe(time.perf_counter() - self._started_at, self._stage)
+
+
+def timed_stage(stage: str) -> Callable:
+    """Decorator recording the latency of every call as a stage"""
+
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - started_at, stage)
+
+        return wrapper
+
+    return decorator
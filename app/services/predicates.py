@@ -0,0 +1,301 @@
+"""Filters compiled into index lookups and vectorized masks.
+
+Filters are compiled once per query against a dataset version: key values
+are encoded to their dictionary codes, the filters over the same key are
+merged into a single predicate and every predicate gets its number of
+matching rows, exact and cheap to get from the sorted rows and the key
+indexes. The most selective predicate produces the candidate rows and the
+others narrow them down, the most selective first. The given filters are
+never modified.
+"""
+
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from app.constants import FILTER_OPERATORS, KEYS_CONSTANTS
+from app.dataloader import Filter, SalesDataset, period_bounds
+
+# Rows per block of the fused aggregation, its masks and code slices fit in
+# the CPU caches
+AGGREGATE_CHUNK_ROWS = 64 * 1024
+
+# Index lookups matching more than 1/AGGREGATE_SCAN_RATIO of the period rows
+# are aggregated by scanning the period instead
+AGGREGATE_SCAN_RATIO = 8
+
+RANGE_OPERATORS = (
+    FILTER_OPERATORS["gt"],
+    FILTER_OPERATORS["gte"],
+    FILTER_OPERATORS["lt"],
+    FILTER_OPERATORS["lte"],
+)
+
+
+@dataclass
+class CodeSet:
+    """Rows holding one of the given codes of a key (`==` and `in` filters)"""
+
+    key: str
+    codes: np.ndarray
+    rows: int = 0
+
+    def positions(
+        self, dataset: SalesDataset, date_filters: List[Filter]
+    ) -> np.ndarray:
+        index = dataset.indexes[self.key]
+        if self.codes.size == 1:
+            return index.lookup(int(self.codes[0]), date_filters)
+        return np.sort(
+            np.concatenate(
+                [index.lookup(int(code), date_filters) for code in self.codes]
+            )
+        )
+
+    def mask(self, dataset: SalesDataset, positions: np.ndarray) -> np.ndarray:
+        return self.matches(dataset.codes[self.key][positions])
+
+    def matches(self, codes: np.ndarray) -> np.ndarray:
+        if self.codes.size == 1:
+            return codes == self.codes[0]
+        return np.isin(codes, self.codes)
+
+
+@dataclass
+class CodeRange:
+    """Rows holding a code of a key in [low, high). As dictionaries are
+    sorted, comparing codes is the same as comparing the values they encode,
+    so range filters over keys become code ranges"""
+
+    key: str
+    low: int
+    high: int
+    rows: int = 0
+
+    def positions(
+        self, dataset: SalesDataset, date_filters: List[Filter]
+    ) -> np.ndarray:
+        positions = dataset.indexes[self.key].lookup_range(self.low, self.high)
+        first_row, last_row = period_bounds(dataset.days, date_filters)
+        return positions[(positions >= first_row) & (positions < last_row)]
+
+    def mask(self, dataset: SalesDataset, positions: np.ndarray) -> np.ndarray:
+        return self.matches(dataset.codes[self.key][positions])
+
+    def matches(self, codes: np.ndarray) -> np.ndarray:
+        matches = codes >= self.low
+        matches &= codes < self.high
+        return matches
+
+
+@dataclass
+class RowRange:
+    """Rows in [first_row, last_row), the rows of a period as the dataset is
+    sorted by date"""
+
+    first_row: int
+    last_row: int
+
+    @property
+    def rows(self) -> int:
+        return self.last_row - self.first_row
+
+    def mask(self, dataset: SalesDataset, positions: np.ndarray) -> np.ndarray:
+        return (positions >= self.first_row) & (positions < self.last_row)
+
+
+KeyPredicate = Union[CodeSet, CodeRange]
+
+Predicate = Union[CodeSet, CodeRange, RowRange]
+
+
+class CompiledFilters:
+    """Filters of a query compiled against a dataset version"""
+
+    def __init__(self, dataset: SalesDataset, filters: List[Filter]) -> None:
+        self._dataset = dataset
+        self._date_filters: List[Filter] = []
+        key_predicates: Dict[str, KeyPredicate] = {}
+        for filter in filters:
+            if filter.key == KEYS_CONSTANTS["Date"]:
+                if filter.operator == FILTER_OPERATORS["in"]:
+                    raise ValueError(f"Filtering {filter.key} by in is not supported")
+                self._date_filters.append(filter)
+            elif filter.key not in dataset.codes:
+                raise ValueError(f"Filtering by {filter.key} is not supported")
+            else:
+                predicate = self._compile(filter)
+                if filter.key in key_predicates:
+                    predicate = self._merge(key_predicates[filter.key], predicate)
+                key_predicates[filter.key] = predicate
+
+        self.period = RowRange(*period_bounds(dataset.days, self._date_filters))
+        for predicate in key_predicates.values():
+            if isinstance(predicate, CodeSet):
+                predicate.rows = dataset.indexes[predicate.key].count(predicate.codes)
+            else:
+                predicate.rows = dataset.indexes[predicate.key].count_range(
+                    predicate.low, predicate.high
+                )
+        # Most selective first
+        self.predicates: List[KeyPredicate] = sorted(
+            key_predicates.values(), key=lambda predicate: predicate.rows
+        )
+
+    def _compile(self, filter: Filter) -> KeyPredicate:
+        dictionary = self._dataset.dictionaries[filter.key]
+        if filter.operator in (FILTER_OPERATORS["eq"], FILTER_OPERATORS["in"]):
+            values = (
+                [filter.value]
+                if filter.operator == FILTER_OPERATORS["eq"]
+                else list(filter.value)
+            )
+            codes = np.array(
+                [self._dataset.encode(filter.key, value) for value in values],
+                dtype=np.int64,
+            )
+            return CodeSet(filter.key, np.unique(codes[codes >= 0]))
+        if filter.operator not in RANGE_OPERATORS:
+            raise ValueError(f"Filter operator {filter.operator} is not supported")
+
+        low, high = 0, len(dictionary)
+        if filter.operator in (FILTER_OPERATORS["gte"], FILTER_OPERATORS["lt"]):
+            bound = int(np.searchsorted(dictionary, filter.value, side="left"))
+        else:
+            bound = int(np.searchsorted(dictionary, filter.value, side="right"))
+        if filter.operator in (FILTER_OPERATORS["gt"], FILTER_OPERATORS["gte"]):
+            low = bound
+        else:
+            high = bound
+        return CodeRange(filter.key, low, high)
+
+    @staticmethod
+    def _merge(first: KeyPredicate, second: KeyPredicate) -> KeyPredicate:
+        """Single predicate matching the rows of both predicates of a key"""
+        if isinstance(first, CodeRange) and isinstance(second, CodeRange):
+            low = max(first.low, second.low)
+            return CodeRange(first.key, low, max(low, min(first.high, second.high)))
+        if isinstance(first, CodeSet) and isinstance(second, CodeSet):
+            return CodeSet(first.key, np.intersect1d(first.codes, second.codes))
+        code_set, code_range = (
+            (first, second) if isinstance(first, CodeSet) else (second, first)
+        )
+        codes = code_set.codes
+        return CodeSet(
+            code_set.key,
+            codes[(codes >= code_range.low) & (codes < code_range.high)],
+        )
+
+    @property
+    def estimated_rows(self) -> int:
+        """Upper bound of the matching rows"""
+        return min(
+            [self.period.rows, *(predicate.rows for predicate in self.predicates)]
+        )
+
+    def _plan(self) -> Tuple[Optional[KeyPredicate], List[Predicate]]:
+        """Predicate producing the candidate rows (None for the period rows)
+        and the ones narrowing them down, most selective first"""
+        if not self.predicates or self.period.rows <= self.predicates[0].rows:
+            return None, list(self.predicates)
+        driver, *others = self.predicates
+        # Index lookups of code sets already narrow their rows to the period
+        if isinstance(driver, CodeSet):
+            return driver, others
+        return driver, sorted(
+            [self.period, *others], key=lambda predicate: predicate.rows
+        )
+
+    def positions(self) -> np.ndarray:
+        """Ascending positions of the rows matching every filter"""
+        if self.estimated_rows == 0:
+            return np.arange(0)
+        driver, others = self._plan()
+        if driver is None:
+            positions = np.arange(self.period.first_row, self.period.last_row)
+        else:
+            positions = driver.positions(self._dataset, self._date_filters)
+        return self._narrow(positions, others)
+
+    def chunks(self, chunk_size: int) -> Iterator[np.ndarray]:
+        """Ascending positions of the matching rows, in chunks of at most
+        `chunk_size` candidate rows. The rows of a period are read chunk by
+        chunk without materializing their positions"""
+        if self.estimated_rows == 0:
+            return
+        driver, others = self._plan()
+        if driver is None:
+            starts = range(self.period.first_row, self.period.last_row, chunk_size)
+            candidates = (
+                np.arange(start, min(start + chunk_size, self.period.last_row))
+                for start in starts
+            )
+        else:
+            driven = driver.positions(self._dataset, self._date_filters)
+            candidates = (
+                driven[start : start + chunk_size]
+                for start in range(0, driven.size, chunk_size)
+            )
+        for positions in candidates:
+            positions = self._narrow(positions, others)
+            if positions.size:
+                yield positions
+
+    def aggregate(
+        self, values: np.ndarray, chunk_size: int = AGGREGATE_CHUNK_ROWS
+    ) -> Tuple[float, int]:
+        """Sum of `values` over the rows matching every filter and their count.
+
+        When the period drives, the sum and the count are computed in a single
+        pass over blocks of `chunk_size` rows of the period: the predicates
+        are evaluated over views of the key codes into a block mask and the
+        values are summed where the mask holds, so neither the positions nor
+        the values of the matching rows are materialized. The period is also
+        scanned when the most selective index lookup still matches a large
+        share of its rows, otherwise the rows it finds are gathered.
+        """
+        if self.estimated_rows == 0:
+            return 0.0, 0
+        driver, others = self._plan()
+        if (
+            driver is not None
+            and driver.rows * AGGREGATE_SCAN_RATIO >= self.period.rows
+        ):
+            # Scanning the period is cheaper than gathering that many rows
+            driver, others = None, list(self.predicates)
+        if driver is not None:
+            total, count = 0.0, 0
+            for positions in self.chunks(chunk_size):
+                total += float(values[positions].sum())
+                count += positions.size
+            return total, count
+
+        first_row, last_row = self.period.first_row, self.period.last_row
+        if not others:
+            return float(values[first_row:last_row].sum()), last_row - first_row
+        total, count = 0.0, 0
+        for start in range(first_row, last_row, chunk_size):
+            stop = min(start + chunk_size, last_row)
+            first, *rest = others
+            mask = first.matches(self._dataset.codes[first.key][start:stop])
+            for predicate in rest:
+                mask &= predicate.matches(
+                    self._dataset.codes[predicate.key][start:stop]
+                )
+            total += float(np.sum(values[start:stop], where=mask))
+            count += int(np.count_nonzero(mask))
+        return total, count
+
+    def _narrow(self, positions: np.ndarray, predicates: List[Predicate]) -> np.ndarray:
+        for predicate in predicates:
+            if positions.size == 0:
+                break
+            positions = positions[predicate.mask(self._dataset, positions)]
+        return positions
+
+
+def compile_filters(dataset: SalesDataset, filters: List[Filter]) -> CompiledFilters:
+    """Compiles the filters against the dataset. Raises ValueError for the
+    filters that aren't supported"""
+    return CompiledFilters(dataset, filters)
@@ -0,0 +1,151 @@
+"""Opt-in profiling of sales queries.
+
+A profiled query runs under `cProfile` in the queries executor, so the
+profile covers the `SalesService` computations whichever pool runs them.
+The latest profiles are kept in a bounded ring buffer, to be retrieved from
+the admin endpoints.
+"""
+
+import cProfile
+import io
+import itertools
+import pstats
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.config import app_settings
+
+# Functions listed in a profile report, by cumulative time
+PROFILE_TOP_FUNCTIONS = 40
+
+PROFILE_REASONS = {
+    "header": "header",
+    "sampled": "sampled",
+}
+
+# A single profiler runs at a time in a process, other queries run as usual
+_profiler_lock = threading.Lock()
+
+
+@dataclass
+class ProfileRequest:
+    """Profiling asked for the sales request of the current context"""
+
+    path: str
+    reason: str
+    profile_ids: List[int] = field(default_factory=list)
+
+
+@dataclass
+class RequestProfile:
+    id: int
+    path: str
+    reason: str
+    function: str
+    started_at: datetime
+    duration_seconds: float
+    report: str
+
+    def summary(self) -> Dict[str, Any]:
+        summary = asdict(self)
+        del summary["report"]
+        return summary
+
+
+profile_request: ContextVar[Optional[ProfileRequest]] = ContextVar(
+    "profile_request", default=None
+)
+
+
+def run_profiled(function: Callable, *args: Any) -> Tuple[Any, Optional[str]]:
+    """Runs the function under `cProfile`, returning its result and the
+    profile report. The report is None if another query is being profiled"""
+    if not _profiler_lock.acquire(blocking=False):
+        return function(*args), None
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            result = function(*args)
+        finally:
+            profiler.disable()
+    finally:
+        _profiler_lock.release()
+
+    report = io.StringIO()
+    stats = pstats.Stats(profiler, stream=report)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP_FUNCTIONS)
+    return result, report.getvalue()
+
+
+class ProfileBuffer:
+    """Ring buffer with the latest `max_size` profiles"""
+
+    def __init__(self, max_size: int = 20) -> None:
+        self._profiles: deque = deque(maxlen=max_size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        request: ProfileRequest,
+        function: str,
+        started_at: datetime,
+        duration: float,
+        report: str,
+    ) -> int:
+        with self._lock:
+            profile = RequestProfile(
+                id=next(self._ids),
+                path=request.path,
+                reason=request.reason,
+                function=function,
+                started_at=started_at,
+                duration_seconds=duration,
+                report=report,
+            )
+            self._profiles.append(profile)
+        request.profile_ids.append(profile.id)
+        return profile.id
+
+    def list(self) -> List[RequestProfile]:
+        """Profiles from the newest to the oldest"""
+        with self._lock:
+            return list(reversed(self._profiles))
+
+    def get(self, profile_id: int) -> Optional[RequestProfile]:
+        with self._lock:
+            for profile in self._profiles:
+                if profile.id == profile_id:
+                    return profile
+        return None
+
+
+async def run_with_profile(
+    request: ProfileRequest, run: Callable, function: Callable, *args: Any
+) -> Any:
+    """Runs a query through `run` (an executor) under the profiler, storing
+    its profile in the profiles buffer"""
+    started_at = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    result, report = await run(run_profiled, function, *args)
+    if report is not None:
+        profile_buffer().add(
+            request,
+            getattr(function, "__qualname__", repr(function)),
+            started_at,
+            time.perf_counter() - started,
+            report,
+        )
+    return result
+
+
+@lru_cache
+def profile_buffer() -> ProfileBuffer:
+    return ProfileBuffer(max_size=app_settings().PROFILE_BUFFER_SIZE)
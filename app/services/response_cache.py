@@ -0,0 +1,85 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+
+from app.config import app_settings
+
+
+class ResponseCache:
+    """Serialized sales responses by query and data version.
+
+    Entries live in a bounded LRU for at most `ttl` seconds. The data
+    version (the fingerprint of the data files, See `data_version`) is part
+    of every key and the whole cache is dropped as soon as a lookup comes
+    with another version, so a response never outlives the data it was
+    computed from.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._cache: OrderedDict[str, Tuple[float, bytes]] = OrderedDict()
+        self._version: Optional[str] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    @staticmethod
+    def etag(query: str, version: str) -> str:
+        """Strong ETag of the response to a query over a data version"""
+        digest = hashlib.sha256(f"{version}:{query}".encode()).hexdigest()
+        return f'"{digest[:32]}"'
+
+    def get(self, query: str, version: str) -> Optional[bytes]:
+        now = time.monotonic()
+        with self._lock:
+            self._track_version(version)
+            cached = self._cache.get(query)
+            if version == self._version and cached is not None and cached[0] > now:
+                self._cache.move_to_end(query)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        return None
+
+    def put(self, query: str, version: str, body: bytes) -> None:
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            if self._version is None:
+                self._version = version
+            if version != self._version:
+                # Computed over a version that has already been replaced
+                return
+            self._cache[query] = (time.monotonic() + self._ttl, body)
+            self._cache.move_to_end(query)
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+
+    def _track_version(self, version: str) -> None:
+        if version != self._version:
+            self._cache.clear()
+            self._version = version
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "size": len(self._cache),
+            "version": self._version,
+        }
+
+
+@lru_cache
+def response_cache() -> ResponseCache:
+    settings = app_settings()
+    return ResponseCache(
+        max_size=settings.RESPONSE_CACHE_SIZE, ttl=settings.RESPONSE_CACHE_TTL
+    )
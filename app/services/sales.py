@@ -1,10 +1,86 @@
-from typing import List
+from collections import defaultdict
+from datetime import date
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
-from app.constants import KEYS_CONSTANTS
-from app.dataloader import Filter, load_data
-from app.schemas.sales_response import TotalAvgSales
+from app.config import app_settings
+from app.constants import (
+    FILTER_OPERATORS,
+    KEYS_CONSTANTS,
+    SALES_ENGINES,
+    SERIES_BUCKETS,
+)
+from app.dataloader import (
+    Filter,
+    LoadProgress,
+    SalesDataset,
+    dataset_store,
+    day_range,
+    load_dataset,
+)
+from app.schemas.sales_response import SalesGroup, SalesPoint, TotalAvgSales
+from app.services.arrow_engine import arrow_engine
+from app.services.export import EXPORT_CHUNK_ROWS, rows_batch
+from app.services.metrics import timed_stage
+from app.services.predicates import compile_filters
+from app.services.sharded_engine import sharded_engine
+
+
+def data_ready() -> bool:
+    """Whether sales can be computed without waiting for the data to load"""
+    settings = app_settings()
+    if settings.SALES_ENGINE == SALES_ENGINES["arrow"]:
+        return arrow_engine().ready
+    if settings.SALES_ENGINE == SALES_ENGINES["sharded"]:
+        return sharded_engine().ready
+    return dataset_store.ready
+
+
+def data_progress() -> LoadProgress:
+    """Progress of the latest data load of the configured sales engine"""
+    settings = app_settings()
+    if settings.SALES_ENGINE == SALES_ENGINES["arrow"]:
+        return arrow_engine().progress
+    if settings.SALES_ENGINE == SALES_ENGINES["sharded"]:
+        return sharded_engine().progress
+    return dataset_store.progress
+
+
+def data_version() -> str:
+    """Version of the data the sales are computed from: the fingerprint of
+    the data files, the same in every worker reading the same files. Data
+    files are discovered by the background refreshers, never here"""
+    settings = app_settings()
+    if settings.SALES_ENGINE == SALES_ENGINES["arrow"]:
+        return arrow_engine().fingerprint
+    if settings.SALES_ENGINE == SALES_ENGINES["sharded"]:
+        return sharded_engine().fingerprint
+    return load_dataset().fingerprint
+
+
+def at_data_version(version: str, function: Callable, *args: Any) -> Any:
+    """Runs a sales query once the data of the process is at `version`.
+
+    Processes of a `process` query executor hold their own dataset (or
+    discovered data files) and the refresher only runs in the app process,
+    so every query carries the version of the app process and the data of
+    the pool process is refreshed first when it's behind. Shard workers of
+    the sharded engine already follow the version of the engine.
+    """
+    settings = app_settings()
+    if (
+        settings.SALES_ENGINE != SALES_ENGINES["sharded"]
+        and data_ready()
+        and data_version() != version
+    ):
+        if settings.SALES_ENGINE == SALES_ENGINES["arrow"]:
+            arrow_engine().refresh()
+        else:
+            dataset_store.refresh()
+    return function(*args)
 
 
 class SalesService:
@@ -13,45 +89,426 @@ class SalesService:
 
     def sales_by_period(self) -> float:
         """Calcs sales in a period"""
-        filtered_data = self._filter_data(load_data())
-        if filtered_data.empty:
-            return 0.0
-        return self._calc_total(filtered_data)
+        total, _ = self._totals()
+        return total
 
     def total_avg_sales(self) -> TotalAvgSales:
         """Calcs total and average sales"""
-        filtered_data = self._filter_data(load_data())
-        if filtered_data.empty:
+        return self._total_avg(*self._totals())
+
+    def breakdown(
+        self, group_by: str, top: Optional[int] = None, ascending: bool = False
+    ) -> List[SalesGroup]:
+        """Calcs total, count and average sales per value of the `group_by`
+        key, ranked by total and limited to the `top` ones"""
+        values, totals, counts = self._group_totals(group_by)
+        groups = self._select_top(totals, counts, top, ascending)
+        breakdown = []
+        for value, total, count in zip(values[groups], totals[groups], counts[groups]):
+            total_avg = self._total_avg(round(float(total), 2), int(count))
+            breakdown.append(
+                SalesGroup.model_construct(
+                    key=str(value),
+                    total=total_avg.total,
+                    count=int(count),
+                    average=total_avg.average,
+                )
+            )
+        return breakdown
+
+    def _group_totals(self, group_by: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the values of the `group_by` key along with the sales
+        amount and the number of sales of each one matching the filters"""
+        settings = app_settings()
+        if settings.SALES_ENGINE == SALES_ENGINES["arrow"]:
+            engine = arrow_engine()
+            return engine.group_totals(self._filters, group_by)
+        if settings.SALES_ENGINE == SALES_ENGINES["sharded"]:
+            partials = sharded_engine().scatter(
+                SalesService._shard_group_totals, self._filters, group_by
+            )
+            values, totals, counts = map(np.concatenate, zip(*partials))
+            # Groups of different shards are summed up by value
+            values, groups = np.unique(values, return_inverse=True)
+            return (
+                values,
+                np.bincount(groups, weights=totals, minlength=len(values)),
+                np.bincount(groups, weights=counts, minlength=len(values)),
+            )
+        return self._dataset_group_totals(load_dataset(), group_by)
+
+    def _dataset_group_totals(
+        self, dataset: SalesDataset, group_by: str
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if group_by not in dataset.codes:
+            raise ValueError(f"Grouping by {group_by} is not supported")
+        values = dataset.dictionaries[group_by]
+        date_filters = [
+            filter for filter in self._filters if filter.key == KEYS_CONSTANTS["Date"]
+        ]
+        if len(date_filters) == len(self._filters) and group_by in dataset.rollups:
+            # Every group of a period comes straight from the rollups
+            first_day, last_day = day_range(date_filters)
+            totals, counts = dataset.rollups[group_by].lookup_many(
+                np.arange(len(values)), first_day, last_day
+            )
+            return values, totals, counts
+
+        positions = self._filter_data(dataset)
+        codes = dataset.codes[group_by][positions]
+        totals = np.bincount(
+            codes, weights=dataset.amounts[positions], minlength=len(values)
+        )
+        counts = np.bincount(codes, minlength=len(values))
+        return values, totals, counts
+
+    def series(
+        self, bucket: str = SERIES_BUCKETS["day"], rolling: Optional[int] = None
+    ) -> List[SalesPoint]:
+        """Calcs total and count sales per day, week or month of the filters
+        period, along with the average total of the last `rolling` buckets"""
+        date_filters = [
+            filter for filter in self._filters if filter.key == KEYS_CONSTANTS["Date"]
+        ]
+        first_day, last_day = day_range(date_filters)
+        bounds = np.iinfo(np.int32)
+        if first_day == bounds.min or last_day == bounds.max:
+            raise ValueError("Sales series require a start and an end period")
+        if first_day > last_day:
+            return []
+
+        days, totals, counts = self._daily_totals(first_day, last_day)
+        # Every bucket of the period is returned, even those without sales
+        periods = np.unique(
+            self._bucket_start(np.arange(first_day, last_day + 1), bucket)
+        )
+        buckets = np.searchsorted(periods, self._bucket_start(days, bucket))
+        totals = np.bincount(buckets, weights=totals, minlength=len(periods))
+        counts = np.bincount(buckets, weights=counts, minlength=len(periods))
+        averages = self._rolling_average(totals, rolling) if rolling else None
+
+        series = []
+        for position, (period, total, count) in enumerate(
+            zip(periods.astype("datetime64[D]").tolist(), totals, counts)
+        ):
+            series.append(
+                SalesPoint.model_construct(
+                    period=period,
+                    total=round(float(total), 2),
+                    count=int(count),
+                    rolling_average=(
+                        None if averages is None else float(averages[position])
+                    ),
+                )
+            )
+        return series
+
+    def _daily_totals(
+        self, first_day: int, last_day: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the days of the period with sales matching the filters,
+        along with the sales amount and the number of sales of each day"""
+        settings = app_settings()
+        if settings.SALES_ENGINE == SALES_ENGINES["arrow"]:
+            engine = arrow_engine()
+            values, totals, counts = engine.group_totals(
+                self._filters, KEYS_CONSTANTS["Date"]
+            )
+            days = pd.to_datetime(values).to_numpy().astype("datetime64[D]")
+            return days.astype(np.int64), totals, counts
+        if settings.SALES_ENGINE == SALES_ENGINES["sharded"]:
+            partials = sharded_engine().scatter(
+                SalesService._shard_daily_totals, self._filters, first_day, last_day
+            )
+            days, totals, counts = map(np.concatenate, zip(*partials))
+            offsets = days - first_day
+            size = last_day - first_day + 1
+            return (
+                np.arange(first_day, last_day + 1),
+                np.bincount(offsets, weights=totals, minlength=size),
+                np.bincount(offsets, weights=counts, minlength=size),
+            )
+        return self._dataset_daily_totals(load_dataset(), first_day, last_day)
+
+    def _dataset_daily_totals(
+        self, dataset: SalesDataset, first_day: int, last_day: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        plan = self._rollup_plan(dataset)
+        if plan is not None:
+            key, code, _ = plan
+            return dataset.rollups[key].daily(code, first_day, last_day)
+
+        positions = self._filter_data(dataset)
+        offsets = dataset.days[positions] - first_day
+        size = last_day - first_day + 1
+        totals = np.bincount(
+            offsets, weights=dataset.amounts[positions], minlength=size
+        )
+        counts = np.bincount(offsets, minlength=size)
+        return np.arange(first_day, last_day + 1), totals, counts
+
+    @staticmethod
+    def _bucket_start(days: np.ndarray, bucket: str) -> np.ndarray:
+        """Day numbers of the first day of the buckets holding the days.
+        Weeks start on Monday"""
+        days = np.asarray(days, dtype=np.int64)
+        if bucket == SERIES_BUCKETS["day"]:
+            return days
+        if bucket == SERIES_BUCKETS["week"]:
+            # The day number 0 (1970-01-01) is a Thursday
+            return days - (days + 3) % 7
+        if bucket == SERIES_BUCKETS["month"]:
+            months = days.astype("datetime64[D]").astype("datetime64[M]")
+            return months.astype("datetime64[D]").astype(np.int64)
+        raise ValueError(f"Bucketing by {bucket} is not supported")
+
+    @staticmethod
+    def bucket_count(start_period: date, end_period: date, bucket: str) -> int:
+        """Number of buckets of the series of a period, without querying"""
+        if start_period > end_period:
+            return 0
+        first, last = SalesService._bucket_start(
+            np.array([start_period, end_period], dtype="datetime64[D]").astype(
+                np.int64
+            ),
+            bucket,
+        )
+        if bucket == SERIES_BUCKETS["week"]:
+            return int((last - first) // 7 + 1)
+        if bucket == SERIES_BUCKETS["month"]:
+            months = np.array([first, last], dtype="datetime64[D]").astype(
+                "datetime64[M]"
+            )
+            return int((months[1] - months[0]).astype(np.int64) + 1)
+        return int(last - first + 1)
+
+    @staticmethod
+    def _rolling_average(totals: np.ndarray, window: int) -> np.ndarray:
+        """Average of every total and the previous ones within the window.
+        The first buckets average the ones available"""
+        running = np.cumsum(totals)
+        windowed = running.copy()
+        windowed[window:] -= running[:-window]
+        sizes = np.minimum(np.arange(1, len(totals) + 1), window)
+        return np.round(windowed / sizes, 2)
+
+    @staticmethod
+    def _select_top(
+        totals: np.ndarray, counts: np.ndarray, top: Optional[int], ascending: bool
+    ) -> np.ndarray:
+        """Returns the positions of the ranked groups with sales. Only the
+        `top` groups are selected (partial selection) and sorted"""
+        groups = np.flatnonzero(counts > 0)
+        scores = totals[groups] if ascending else -totals[groups]
+        if top is not None and top < groups.size:
+            selected = np.argpartition(scores, top - 1)[:top]
+            groups, scores = groups[selected], scores[selected]
+        return groups[np.argsort(scores, kind="stable")]
+
+    @staticmethod
+    def _total_avg(total: float, count: int) -> TotalAvgSales:
+        if count == 0:
             return TotalAvgSales(total=0.0, average=0.0)
-        total = self._calc_total(filtered_data)
-        avg = total / len(filtered_data.index)
+        avg = total / count
         return TotalAvgSales(total=total, average=avg)
 
-    def _filter_data(self, data: pd.DataFrame) -> pd.DataFrame:
-        """This method allows to apply the list of filters to a given data frame"""
-
-        # In order to build a correct query the dates related values
-        # must be parsed to a valid pandas query values
-        for filter in self._filters:
-            if filter.key == KEYS_CONSTANTS["Date"]:
-                filter.value = f"@pd.to_datetime('{filter.value}').date()"
-                continue
-            filter.value = f"'{filter.value}'"
-
-        query = " & ".join(
-            [
-                f"{filter.key} {filter.operator} {filter.value}"
-                for filter in self._filters
-            ]
+    def export_batches(
+        self, chunk_size: int = EXPORT_CHUNK_ROWS
+    ) -> Iterator[pa.RecordBatch]:
+        """Record batches of at most `chunk_size` rows matching the filters,
+        their keys decoded. Filters are checked right away and the rows are
+        read batch by batch as the result is iterated"""
+        settings = app_settings()
+        if settings.SALES_ENGINE == SALES_ENGINES["arrow"]:
+            return arrow_engine().export_batches(self._filters, chunk_size)
+        if settings.SALES_ENGINE == SALES_ENGINES["sharded"]:
+            return sharded_engine().export_batches(self._filters, chunk_size)
+
+        dataset = load_dataset()
+        compiled = compile_filters(dataset, self._filters)
+        return self._dataset_batches(dataset, compiled.chunks(chunk_size))
+
+    def _dataset_batches(
+        self,
+        dataset: SalesDataset,
+        chunks: Iterator[np.ndarray],
+    ) -> Iterator[pa.RecordBatch]:
+        dictionaries = {
+            key: pa.array(dictionary)
+            for key, dictionary in dataset.dictionaries.items()
+        }
+        for positions in chunks:
+            yield rows_batch(
+                dataset.days[positions],
+                {
+                    key: dictionary.take(dataset.codes[key][positions])
+                    for key, dictionary in dictionaries.items()
+                },
+                dataset.amounts[positions],
+            )
+
+    def _totals(self) -> Tuple[float, int]:
+        """Returns the rounded sales total and the number of sales matching
+        the filters using the configured sales engine"""
+        settings = app_settings()
+        if settings.SALES_ENGINE == SALES_ENGINES["arrow"]:
+            engine = arrow_engine()
+            total, count = engine.aggregate(self._filters)
+            return round(total, 2), count
+        if settings.SALES_ENGINE == SALES_ENGINES["sharded"]:
+            partials = sharded_engine().scatter(
+                SalesService._shard_totals, self._filters
+            )
+            return (
+                round(sum(total for total, _ in partials), 2),
+                sum(count for _, count in partials),
+            )
+        return self._aggregate(load_dataset())
+
+    def _aggregate(self, dataset: SalesDataset) -> Tuple[float, int]:
+        """Returns the rounded sales total and the number of sales matching
+        the filters. Filters over a single key and a period are answered by
+        the daily rollups, any other combination falls back to the raw rows
+        """
+        rolled_up = self._rollup_total(dataset)
+        if rolled_up is not None:
+            total, count = rolled_up
+            return round(total, 2), count
+
+        total, count = self._filter_total(dataset)
+        return round(total, 2), count
+
+    @timed_stage("rollup_lookup")
+    def _rollup_total(self, dataset: SalesDataset) -> Optional[Tuple[float, int]]:
+        """Returns the rollup sales total and count, or None when the rollups
+        don't cover the filters"""
+        plan = self._rollup_plan(dataset)
+        if plan is None:
+            return None
+        key, code, date_filters = plan
+        return dataset.rollups[key].lookup(code, date_filters)
+
+    def _rollup_plan(
+        self, dataset: SalesDataset
+    ) -> Optional[Tuple[str, int, List[Filter]]]:
+        """Returns the rolled up key, the code of its value and the date
+        filters when the filters are a single key equality and a period,
+        None otherwise"""
+        key_filters = [
+            filter for filter in self._filters if filter.key != KEYS_CONSTANTS["Date"]
+        ]
+        if len(key_filters) != 1:
+            return None
+        key_filter = key_filters[0]
+        if (
+            key_filter.key not in dataset.rollups
+            or key_filter.operator != FILTER_OPERATORS["eq"]
+        ):
+            return None
+        date_filters = [
+            filter for filter in self._filters if filter.key == KEYS_CONSTANTS["Date"]
+        ]
+        code = dataset.encode(key_filter.key, key_filter.value)
+        return key_filter.key, code, date_filters
+
+    @timed_stage("filter_data")
+    def _filter_data(self, dataset: SalesDataset) -> np.ndarray:
+        """This method allows to apply the list of filters to a given dataset
+        and returns the positions of the matching rows.
+        Filters are compiled into index lookups and masks over the key codes,
+        see `app.services.predicates`
+        """
+        return compile_filters(dataset, self._filters).positions()
+
+    @timed_stage("filter_total")
+    def _filter_total(self, dataset: SalesDataset) -> Tuple[float, int]:
+        """Returns the unrounded sales total and the number of sales matching
+        the filters, summed in a single pass over the dataset amounts without
+        materializing the matching rows"""
+        return compile_filters(dataset, self._filters).aggregate(dataset.amounts)
+
+    @staticmethod
+    def _shard_totals(
+        dataset: SalesDataset, filters: List[Filter]
+    ) -> Tuple[float, int]:
+        """Unrounded sales total and count of the rows of a shard"""
+        service = SalesService(filters=filters)
+        rolled_up = service._rollup_total(dataset)
+        if rolled_up is not None:
+            return rolled_up
+        return service._filter_total(dataset)
+
+    @staticmethod
+    def _shard_group_totals(
+        dataset: SalesDataset, filters: List[Filter], group_by: str
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Groups with sales of the rows of a shard"""
+        values, totals, counts = SalesService(filters=filters)._dataset_group_totals(
+            dataset, group_by
+        )
+        groups = np.flatnonzero(counts)
+        return values[groups], totals[groups], counts[groups]
+
+    @staticmethod
+    def _shard_daily_totals(
+        dataset: SalesDataset, filters: List[Filter], first_day: int, last_day: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Days with sales of the rows of a shard"""
+        days, totals, counts = SalesService(filters=filters)._dataset_daily_totals(
+            dataset, first_day, last_day
+        )
+        sold = np.flatnonzero(counts)
+        return days[sold], totals[sold], counts[sold]
+
+
+class SalesBatchService:
+    """Evaluates many filter sets together over the same dataset version.
+
+    Filter sets covered by the daily rollups are grouped by key and answered
+    by one vectorized binary search per key, the other ones go through the
+    indexes one by one. A failing filter set doesn't fail the others: its
+    result is the raised exception.
+    """
+
+    def __init__(self, filter_sets: List[List[Filter]]) -> None:
+        self._services = [SalesService(filters=filters) for filters in filter_sets]
+
+    def total_avg_sales(self) -> List[Union[TotalAvgSales, Exception]]:
+        """Calcs total and average sales of every filter set, in order"""
+        settings = app_settings()
+        if settings.SALES_ENGINE != SALES_ENGINES["memory"]:
+            return [self._run(service.total_avg_sales) for service in self._services]
+
+        dataset = load_dataset()
+        results: List[Union[TotalAvgSales, Exception, None]] = [None] * len(
+            self._services
         )
-        filtered_data = data.query(query)
-        return filtered_data
+        rolled_up: Dict[str, List[Tuple[int, int, int, int]]] = defaultdict(list)
+        for position, service in enumerate(self._services):
+            try:
+                plan = service._rollup_plan(dataset)
+                if plan is None:
+                    results[position] = service._total_avg(*service._aggregate(dataset))
+                    continue
+                key, code, date_filters = plan
+                rolled_up[key].append((position, code, *day_range(date_filters)))
+            except Exception as e:
+                results[position] = e
+
+        for key, items in rolled_up.items():
+            positions, codes, first_days, last_days = map(np.array, zip(*items))
+            totals, counts = dataset.rollups[key].lookup_many(
+                codes, first_days, last_days
+            )
+            for position, total, count in zip(positions, totals, counts):
+                results[position] = SalesService._total_avg(
+                    round(float(total), 2), int(count)
+                )
+        return results
 
     @staticmethod
-    def _calc_total(data: pd.DataFrame) -> float:
-        total_df = (
-            pd.DataFrame()
-        )  # Creates new dataframe to avoiding dataframe copy warning
-        total_df["Total"] = data["Qty"] * data["CostAmount"]
-        total = total_df["Total"].sum()
-        return round(total, 2)
+    def _run(function) -> Union[TotalAvgSales, Exception]:
+        try:
+            return function()
+        except Exception as e:
+            return e
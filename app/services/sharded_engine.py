@@ -0,0 +1,272 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+import pyarrow as pa
+
+from app.config import app_settings
+from app.constants import FILTER_OPERATORS, KEYS_CONSTANTS
+from app.dataloader import (
+    DATA_DIR,
+    LOAD_STAGES,
+    DataFile,
+    DatasetStore,
+    Filter,
+    LoadProgress,
+    SalesDataset,
+    data_fingerprint,
+    scan_data_files,
+    shard_of,
+)
+from app.services.arrow_engine import ArrowSalesEngine
+
+logger = logging.getLogger(__name__)
+
+# Key the sales rows are partitioned by
+SHARD_KEY = KEYS_CONSTANTS["Store"]
+
+
+def default_shards() -> int:
+    """Shards per app worker process so the shards of every app worker on
+    the host add up to a shard per CPU rather than one per CPU each"""
+    workers = max(app_settings().WEB_CONCURRENCY, 1)
+    return max((os.cpu_count() or 1) // workers, 1)
+
+
+class DatasetShard:
+    """Rows of a shard of the dataset, living in a shard worker process.
+
+    The whole dataset is opened from its memory-mapped snapshot, so the
+    workers share its pages through the OS page cache, and the rows of the
+    shard are copied out along with their own indexes and rollups.
+    """
+
+    def __init__(self, shard: int, shards: int, data_dir: str = DATA_DIR) -> None:
+        self._shard = shard
+        self._shards = shards
+        self._store = DatasetStore(data_dir)
+        self._dataset: Optional[SalesDataset] = None
+        self._version = -1
+
+    def dataset(self, version: int) -> SalesDataset:
+        """Rows of the shard, reloaded first if the data files changed since
+        the last query (the engine `version` increased)"""
+        if self._dataset is not None and version > self._version:
+            self._store.refresh()
+        dataset = self._store.dataset
+        if self._dataset is None or self._dataset.version != dataset.version:
+            self._dataset = dataset.shard(SHARD_KEY, self._shard, self._shards)
+        self._version = max(self._version, version)
+        return self._dataset
+
+
+# Shard of the dataset held by a shard worker process
+_shard: Optional[DatasetShard] = None
+
+
+def _init_shard(shard: int, shards: int, data_dir: str) -> None:
+    global _shard
+    _shard = DatasetShard(shard, shards, data_dir)
+
+
+def _load_shard(version: int) -> int:
+    return len(_shard.dataset(version))
+
+
+def _run_shard_task(version: int, task: Callable, filters: List[Filter], *args) -> Any:
+    return task(_shard.dataset(version), filters, *args)
+
+
+class ShardedSalesEngine:
+    """Scatter-gather sales queries over store shards of the dataset.
+
+    Rows are partitioned by `KeyStore` hash across `shards` long-lived worker
+    processes, one per shard, so a query is computed by several cores at
+    once. Queries filtering stores only run in the shards of those stores,
+    the rest are scattered to every shard and their partial results merged.
+    Shards are loaded in the background and failed loads are retried; a
+    shard worker that dies is replaced and its shard loaded again.
+    """
+
+    # Seconds between attempts to load the shards that failed to
+    RETRY_INTERVAL = 5.0
+
+    def __init__(self, shards: int = 0, data_dir: str = DATA_DIR) -> None:
+        self.shards = shards or default_shards()
+        self._data_dir = data_dir
+        self._files: Optional[List[DataFile]] = None
+        self._lock = threading.Lock()
+        # Increased every time the discovered data files change
+        self.version = -1
+        # Fingerprint of the discovered data files (See `data_fingerprint`)
+        self.fingerprint: Optional[str] = None
+        # Exports stream the parquet files rather than the rows of the shards
+        self._exports = ArrowSalesEngine(data_dir)
+        self._pools = [self._pool(shard) for shard in range(self.shards)]
+        self._pools_lock = threading.Lock()
+        # Files of the shards are loaded by the shard workers, so the files
+        # loaded only add up once every shard is
+        self.progress = LoadProgress()
+        self._loaded = [False] * self.shards
+        self._stopped = threading.Event()
+        self._loader: Optional[threading.Thread] = None
+
+    def _pool(self, shard: int) -> ProcessPoolExecutor:
+        # Spawned workers don't inherit the threads and locks of the app
+        return ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_shard,
+            initargs=(shard, self.shards, self._data_dir),
+        )
+
+    def start(self) -> None:
+        """Loads the shards in the background"""
+        self._start_loader(range(self.shards))
+
+    def _start_loader(self, shards: Iterable[int]) -> None:
+        self._loader = threading.Thread(
+            target=self._load_shards,
+            args=(list(shards),),
+            name="shards-loader",
+            daemon=True,
+        )
+        self._loader.start()
+
+    def _load_shards(self, pending: List[int]) -> None:
+        while pending and not self._stopped.is_set():
+            self.progress.start()
+            error: Optional[Exception] = None
+            try:
+                self.refresh()
+                self.progress.stage = LOAD_STAGES["shards"]
+                self.progress.files_total = len(self._files)
+                pools = {shard: self._pools[shard] for shard in pending}
+                loads = {
+                    shard: (pool, self._submit(pool, _load_shard, self.version))
+                    for shard, pool in pools.items()
+                }
+            except Exception as e:
+                logger.error(msg="Sales data shards couldn't be loaded", exc_info=e)
+                error, loads = e, {}
+            failed = [] if loads else pending
+            for shard, (pool, load) in loads.items():
+                try:
+                    load.result()
+                    # Unless the worker was replaced while loading
+                    self._loaded[shard] = self._pools[shard] is pool
+                except Exception as e:
+                    logger.error(
+                        msg=f"Sales data shard {shard} couldn't be loaded", exc_info=e
+                    )
+                    if isinstance(e, BrokenProcessPool):
+                        self._renew_pool(shard, pool)
+                    error = e
+                    failed.append(shard)
+            pending = failed
+            if pending:
+                self.progress.finish(error=error)
+                self._stopped.wait(self.RETRY_INTERVAL)
+            else:
+                self.progress.files_loaded = self.progress.files_total
+                self.progress.finish()
+
+    def _renew_pool(self, shard: int, pool: ProcessPoolExecutor) -> bool:
+        """Replaces the dead worker of a shard by a new one, unless it was
+        already replaced. Returns whether it was"""
+        with self._pools_lock:
+            if self._pools[shard] is not pool or self._stopped.is_set():
+                return False
+            self._pools[shard] = self._pool(shard)
+            self._loaded[shard] = False
+        pool.shutdown(wait=False, cancel_futures=True)
+        return True
+
+    @property
+    def ready(self) -> bool:
+        """Whether every shard is loaded, without waiting for them"""
+        return all(self._loaded)
+
+    def refresh(self) -> bool:
+        """Discovers the data files again, returning whether they changed.
+        Shards reload their rows before answering the first query of a new
+        version. It scans the data directory, so it runs in a background
+        thread (See `DatasetRefresher`) rather than on the event loop"""
+        with self._lock:
+            self._exports.refresh()
+            files = scan_data_files(self._data_dir)
+            if files == self._files:
+                return False
+            self._files = files
+            self.fingerprint = data_fingerprint(files)
+            self.version += 1
+            return True
+
+    def shards_of(self, filters: List[Filter]) -> List[int]:
+        """Shards holding the rows that may match the filters"""
+        shards = set(range(self.shards))
+        for filter in filters:
+            if filter.key != SHARD_KEY:
+                continue
+            if filter.operator == FILTER_OPERATORS["eq"]:
+                shards &= {shard_of(filter.value, self.shards)}
+            elif filter.operator == FILTER_OPERATORS["in"]:
+                shards &= {shard_of(value, self.shards) for value in filter.value}
+        # A shard answers the queries no row can match, with its empty result
+        return sorted(shards) or [0]
+
+    def scatter(self, task: Callable, filters: List[Filter], *args: Any) -> List[Any]:
+        """Runs `task(dataset, filters, *args)` over the dataset of every shard
+        that may match the filters, in parallel, and returns their results.
+        The task must be picklable (e.g. a module function)"""
+        if self.fingerprint is None:
+            self.refresh()
+        calls = [(shard, self._pools[shard]) for shard in self.shards_of(filters)]
+        futures = [
+            self._submit(pool, _run_shard_task, self.version, task, filters, *args)
+            for _, pool in calls
+        ]
+        results = []
+        for (shard, pool), future in zip(calls, futures):
+            try:
+                results.append(future.result())
+            except BrokenProcessPool:
+                if self._renew_pool(shard, pool):
+                    logger.error(msg=f"Sales data shard {shard} worker died")
+                    self._start_loader([shard])
+                raise
+        return results
+
+    @staticmethod
+    def _submit(pool: ProcessPoolExecutor, function: Callable, *args: Any) -> Future:
+        """Submits a call, a pool already broken failing its future rather
+        than raising right away"""
+        try:
+            return pool.submit(function, *args)
+        except BrokenProcessPool as e:
+            future: Future = Future()
+            future.set_exception(e)
+            return future
+
+    def export_batches(
+        self, filters: List[Filter], chunk_size: int
+    ) -> Iterator[pa.RecordBatch]:
+        """Record batches of the rows matching the filters, streamed from the
+        data files discovered along with those of the shards"""
+        return self._exports.export_batches(filters, chunk_size)
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        for pool in self._pools:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+@lru_cache
+def sharded_engine() -> ShardedSalesEngine:
+    settings = app_settings()
+    return ShardedSalesEngine(shards=settings.SALES_SHARDS)
@@ -0,0 +1,49 @@
+import asyncio
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls into a single one.
+
+    The first call of a key starts the computation and every identical call
+    arriving while it's in flight awaits that same result (or exception)
+    instead of computing it again. The computation runs as its own task, so
+    a caller going away doesn't cancel it for the others.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[str, asyncio.Task] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    async def run(self, key: str, function: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.executions += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        self._calls.pop(key, None)
+        if not task.cancelled():
+            # Retrieved so it isn't logged when every caller went away
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        calls = self.executions + self.coalesced
+        return {
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "coalesced_ratio": self.coalesced / calls if calls else 0.0,
+            "in_flight": len(self._calls),
+        }
+
+
+@lru_cache
+def single_flight() -> SingleFlight:
+    return SingleFlight()
@@ -0,0 +1,214 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import jwt
+import requests
+from cryptography.x509 import load_pem_x509_certificate
+
+logger = logging.getLogger(__name__)
+
+# Google certificates used to sign Firebase ID tokens
+FIREBASE_CERTS_URL = (
+    "https://www.googleapis.com/robot/v1/metadata/x509/"
+    "securetoken@system.gserviceaccount.com"
+)
+FIREBASE_ISSUER = "https://securetoken.google.com/{project_id}"
+
+CertsFetcher = Callable[[], Tuple[Dict[str, str], float]]
+
+
+class InvalidTokenError(Exception):
+    pass
+
+
+class ExpiredTokenError(InvalidTokenError):
+    pass
+
+
+def fetch_certificates(
+    url: str = FIREBASE_CERTS_URL, timeout: float = 10.0
+) -> Tuple[Dict[str, str], float]:
+    """Fetches the PEM certificates by key id along with how many seconds
+    they can be cached for (Cache-Control max-age)"""
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    max_age = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+    return response.json(), float(max_age.group(1)) if max_age else 0.0
+
+
+class SigningKeys:
+    """Public keys that sign the tokens, by key id.
+
+    Keys are fetched once and then refreshed by a background thread before
+    they expire, so verifying a token never waits for a certificates fetch
+    unless a token is signed by a key that isn't known yet. Those fetch the
+    keys again (in case they were rotated) at most once every
+    `REFETCH_INTERVAL` seconds, so forged tokens can't trigger a fetch each.
+    """
+
+    # Seconds before expiring keys are refreshed, and between failed fetches
+    REFRESH_MARGIN = 60.0
+    RETRY_INTERVAL = 30.0
+    # Minimum seconds between fetches triggered by unknown key ids
+    REFETCH_INTERVAL = 30.0
+
+    def __init__(self, fetch: CertsFetcher) -> None:
+        self._fetch = fetch
+        self._keys: Dict[str, Any] = {}
+        self._expires_at = 0.0
+        self._fetched_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._refresher: Optional[threading.Thread] = None
+
+    def get(self, key_id: str) -> Any:
+        """Returns the public key of a key id, None if it isn't a signing key"""
+        self._start_refresher()
+        key = self._keys.get(key_id)
+        if key is None:
+            self._refetch()
+            key = self._keys.get(key_id)
+        return key
+
+    def refresh(self) -> None:
+        with self._lock:
+            self._refresh()
+
+    def _refetch(self) -> None:
+        with self._lock:
+            # Another thread may have just fetched them while this one waited
+            if (
+                self._fetched_at is not None
+                and time.monotonic() - self._fetched_at < self.REFETCH_INTERVAL
+            ):
+                if not self._keys:
+                    raise RuntimeError("Signing keys couldn't be fetched")
+                return
+            self._refresh()
+
+    def _refresh(self) -> None:
+        self._fetched_at = time.monotonic()
+        certificates, max_age = self._fetch()
+        self._keys = {
+            key_id: load_pem_x509_certificate(pem.encode()).public_key()
+            for key_id, pem in certificates.items()
+        }
+        self._expires_at = time.monotonic() + max_age
+
+    def _start_refresher(self) -> None:
+        if self._refresher is None:
+            with self._lock:
+                if self._refresher is None:
+                    self._refresher = threading.Thread(
+                        target=self._refresh_periodically,
+                        name="signing-keys-refresher",
+                        daemon=True,
+                    )
+                    self._refresher.start()
+
+    def _refresh_periodically(self) -> None:
+        while True:
+            delay = self._expires_at - time.monotonic() - self.REFRESH_MARGIN
+            time.sleep(max(delay, self.RETRY_INTERVAL))
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(msg="Signing keys couldn't be refreshed", exc_info=e)
+
+
+class TokenVerifier:
+    """Verifies Firebase ID tokens and caches the verified claims.
+
+    Claims are cached by the SHA-256 of the token in a bounded LRU, for at
+    most `ttl` seconds and never beyond the token's own `exp`, so repeated
+    calls with the same token are a dictionary lookup.
+    """
+
+    def __init__(
+        self,
+        signing_keys: SigningKeys,
+        project_id: str,
+        max_size: int = 10000,
+        ttl: float = 300.0,
+    ) -> None:
+        self._signing_keys = signing_keys
+        self._project_id = project_id
+        self._max_size = max_size
+        self._ttl = ttl
+        self._cache: OrderedDict[str, Tuple[float, Dict[str, Any]]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cached_claims(self, token: str) -> Optional[Dict[str, Any]]:
+        """Returns the cached claims of a verified token, None if the token
+        has to be verified. Never blocks on a certificates fetch"""
+        return self._cached(hashlib.sha256(token.encode()).hexdigest())
+
+    def verify(self, token: str) -> Dict[str, Any]:
+        """Returns the claims of a valid token, raises `ExpiredTokenError` or
+        `InvalidTokenError` otherwise. It may fetch the signing keys, so it
+        shouldn't run on the event loop"""
+        cache_key = hashlib.sha256(token.encode()).hexdigest()
+        claims = self._cached(cache_key)
+        if claims is not None:
+            return claims
+        with self._lock:
+            self.misses += 1
+
+        now = time.time()
+        claims = self._decode(token)
+        expires_at = min(claims["exp"], now + self._ttl)
+        with self._lock:
+            self._cache[cache_key] = (expires_at, claims)
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+        return claims
+
+    def _cached(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            cached = self._cache.get(cache_key)
+            if cached is not None and cached[0] > time.time():
+                self._cache.move_to_end(cache_key)
+                self.hits += 1
+                return cached[1]
+        return None
+
+    def _decode(self, token: str) -> Dict[str, Any]:
+        try:
+            key_id = jwt.get_unverified_header(token).get("kid")
+        except jwt.InvalidTokenError as e:
+            raise InvalidTokenError(str(e))
+        key = self._signing_keys.get(key_id) if key_id else None
+        if key is None:
+            raise InvalidTokenError("Token isn't signed by a known key")
+        try:
+            claims = jwt.decode(
+                token,
+                key,
+                algorithms=["RS256"],
+                audience=self._project_id,
+                issuer=FIREBASE_ISSUER.format(project_id=self._project_id),
+                options={"require": ["exp", "iat", "sub"]},
+            )
+        except jwt.ExpiredSignatureError as e:
+            raise ExpiredTokenError(str(e))
+        except jwt.InvalidTokenError as e:
+            raise InvalidTokenError(str(e))
+        if not claims["sub"]:
+            raise InvalidTokenError("Token has an empty subject")
+        return claims
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "size": len(self._cache),
+        }
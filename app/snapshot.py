@@ -0,0 +1,105 @@
+"""Arrow IPC snapshots of the post-processed sales dataset.
+
+A snapshot is a directory holding one uncompressed Arrow IPC file per array
+and a `manifest.json` with the metadata needed to rebuild the dataset. The
+`LATEST` file names the current snapshot directory. Snapshots are opened
+memory-mapped, so numeric arrays are zero-copy views over pages shared by
+every worker through the OS page cache.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+LATEST_FILE = "LATEST"
+LOCK_FILE = ".lock"
+
+
+@contextmanager
+def snapshot_lock(snapshot_dir: str) -> Iterator[None]:
+    """Cross-process lock so a single worker builds and writes a snapshot
+    while the others wait to open it"""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with open(os.path.join(snapshot_dir, LOCK_FILE), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_snapshot(
+    snapshot_dir: str, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]
+) -> str:
+    """Writes the arrays into a new snapshot directory, points `LATEST` to it
+    and removes the previous snapshots. Returns the snapshot path"""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    name = uuid.uuid4().hex
+    staging_path = os.path.join(snapshot_dir, f".{name}")
+    os.makedirs(staging_path)
+    for array_name, values in arrays.items():
+        table = pa.table({array_name: pa.array(values)})
+        with pa.OSFile(os.path.join(staging_path, f"{array_name}.arrow"), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    manifest = {"format": FORMAT_VERSION, "arrays": list(arrays), **metadata}
+    with open(os.path.join(staging_path, MANIFEST_FILE), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    path = os.path.join(snapshot_dir, name)
+    os.rename(staging_path, path)
+    latest_path = os.path.join(snapshot_dir, f".{LATEST_FILE}-{name}")
+    with open(latest_path, "w") as latest_file:
+        latest_file.write(name)
+    os.replace(latest_path, os.path.join(snapshot_dir, LATEST_FILE))
+
+    # Workers still using a previous snapshot keep their mappings valid
+    for entry in os.listdir(snapshot_dir):
+        if entry not in (name, LATEST_FILE, LOCK_FILE):
+            entry_path = os.path.join(snapshot_dir, entry)
+            if os.path.isdir(entry_path):
+                shutil.rmtree(entry_path, ignore_errors=True)
+    return path
+
+
+def read_snapshot(
+    snapshot_dir: str,
+) -> Optional[Tuple[Dict[str, np.ndarray], Dict[str, Any]]]:
+    """Opens the latest snapshot memory-mapped. Returns its arrays and
+    metadata, or None if there isn't a readable snapshot"""
+    try:
+        with open(os.path.join(snapshot_dir, LATEST_FILE)) as latest_file:
+            path = os.path.join(snapshot_dir, latest_file.read().strip())
+        with open(os.path.join(path, MANIFEST_FILE)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("format") != FORMAT_VERSION:
+        return None
+
+    arrays = {
+        name: _read_array(os.path.join(path, f"{name}.arrow"))
+        for name in manifest.pop("arrays")
+    }
+    manifest.pop("format")
+    return arrays, manifest
+
+
+def _read_array(path: str) -> np.ndarray:
+    column = pa.ipc.open_file(pa.memory_map(path, "r")).read_all().column(0)
+    if column.num_chunks == 0:
+        return np.empty(0, dtype=column.type.to_pandas_dtype())
+    chunk = column.chunk(0)
+    if pa.types.is_integer(chunk.type) or pa.types.is_floating(chunk.type):
+        return chunk.to_numpy(zero_copy_only=True)
+    # Dictionaries of key values are materialized as python objects
+    return chunk.to_numpy(zero_copy_only=False)
@@ -0,0 +1,68 @@
+"""Sales API Test"""
+
+from datetime import date
+from typing import Iterator
+from unittest.mock import patch
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from app.api.auth import validate_token
+from app.api.sales import router, series_validator
+from app.dataloader import SalesDataset
+from app.services.admission import FairQueue
+from app.services.executor import QueryExecutor
+
+
+class TestSeriesValidator:
+    """Test the cap on the number of buckets of a sales series"""
+
+    def test_rejects_too_many_buckets(self):
+        with pytest.raises(HTTPException) as e:
+            series_validator(date(1, 1, 1), date(9999, 12, 31), "day")
+        assert e.value.status_code == 400
+
+    def test_larger_buckets_fit(self):
+        series_validator(date(2000, 1, 1), date(2020, 12, 31), "week")
+        series_validator(date(1, 1, 1), date(99, 12, 31), "month")
+
+
+@pytest.fixture
+def client(testing_dataset: SalesDataset) -> Iterator[TestClient]:
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[validate_token] = lambda: True
+    with patch("app.api.sales.data_ready", return_value=True), patch(
+        "app.services.sales.load_dataset", return_value=testing_dataset
+    ):
+        yield TestClient(app)
+
+
+class TestExportAdmission:
+    """Test exports go through the admission of the other sales queries"""
+
+    def test_releases_its_places_once_sent(self, client: TestClient):
+        queue, executor = FairQueue(slots=1), QueryExecutor(workers=1, queue_size=0)
+        with patch("app.api.sales.fair_queue", return_value=queue), patch(
+            "app.api.sales.query_executor", return_value=executor
+        ):
+            for _ in range(2):
+                response = client.get("/sales/export?key_store=S1")
+                assert response.status_code == 200
+                assert len(response.text.splitlines()) == 4
+        assert queue.stats()["running"] == 0
+        assert executor.stats()["in_flight"] == 0
+
+    def test_user_over_their_share(self, client: TestClient):
+        queue = FairQueue(slots=0, max_queued=0)
+        with patch("app.api.sales.fair_queue", return_value=queue):
+            response = client.get("/sales/export?key_store=S1")
+        assert response.status_code == 429
+
+    def test_overloaded(self, client: TestClient):
+        queue = FairQueue(slots=0, timeout=0.01)
+        with patch("app.api.sales.fair_queue", return_value=queue):
+            response = client.get("/sales/export?key_store=S1")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"]
@@ -2,6 +2,7 @@ import pandas as pd
 import pytest
 
 from app.constants import KEYS_CONSTANTS
+from app.dataloader import SalesDataset
 from app.schemas.sales_response import TotalAvgSales
 
 
@@ -65,3 +66,8 @@ def testing_data(
     df = pd.DataFrame(data, index=data["Index"])
     df[KEYS_CONSTANTS["Date"]] = pd.to_datetime(df[KEYS_CONSTANTS["Date"]])
     return df
+
+
+@pytest.fixture
+def testing_dataset(testing_data) -> SalesDataset:
+    return SalesDataset(testing_data)
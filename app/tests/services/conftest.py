@@ -77,3 +77,26 @@ def sales_service_store_key(period_filters, store_filter) -> SalesService:
     filters.extend(period_filters)
     filters.append(store_filter)
     return SalesService(filters=filters)
+
+
+@pytest.fixture
+def sales_service_employee_store_key(
+    period_filters, employee_filter, store_filter
+) -> SalesService:
+    filters = []
+    filters.extend(period_filters)
+    filters.extend([employee_filter, store_filter])
+    return SalesService(filters=filters)
+
+
+@pytest.fixture
+def sales_service_unknown_employee_key(period_filters) -> SalesService:
+    unknown_employee_filter = Filter(
+        key=KEYS_CONSTANTS["Employee"],
+        operator=FILTER_OPERATORS["eq"],
+        value="E9",
+    )
+    filters = []
+    filters.extend(period_filters)
+    filters.append(unknown_employee_filter)
+    return SalesService(filters=filters)
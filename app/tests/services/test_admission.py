@@ -0,0 +1,166 @@
+"""Admission control Test"""
+
+import asyncio
+
+import pytest
+
+from app.services.admission import (
+    AdmissionRejectedError,
+    AdmissionTimeoutError,
+    FairQueue,
+    RateLimiter,
+    parse_weights,
+)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+async def run_queued(queue: FairQueue, users: list, order: list) -> list:
+    """Runs a query per user while a blocker holds the only slot, recording
+    the order they get their slot in"""
+    release = asyncio.Event()
+
+    async def blocker():
+        async with queue.slot("blocker"):
+            await release.wait()
+
+    async def query(user: str):
+        async with queue.slot(user):
+            order.append(user)
+
+    blocking = asyncio.create_task(blocker())
+    await asyncio.sleep(0)
+    queries = [asyncio.create_task(query(user)) for user in users]
+    await asyncio.sleep(0)
+    release.set()
+    await blocking
+    return await asyncio.gather(*queries, return_exceptions=True)
+
+
+class TestRateLimiter:
+    """Test the token bucket rate limit per user"""
+
+    def test_burst_then_rate(self):
+        clock = FakeClock()
+        limiter = RateLimiter(rate=2, burst=3, clock=clock)
+        assert [limiter.acquire("user") for _ in range(3)] == [0, 0, 0]
+        assert limiter.acquire("user") == pytest.approx(0.5)
+        # Other users have their own bucket
+        assert limiter.acquire("other") == 0
+        clock.now = 0.5
+        assert limiter.acquire("user") == 0
+        assert limiter.acquire("user") == pytest.approx(0.5)
+        assert limiter.stats()["limited"] == 2
+
+    def test_disabled(self):
+        limiter = RateLimiter(rate=0, burst=1)
+        assert all(limiter.acquire("user") == 0 for _ in range(100))
+
+    def test_evicts_least_recent_users(self):
+        limiter = RateLimiter(rate=1, burst=1, max_users=2, clock=FakeClock())
+        for user in ("first", "second", "first", "third"):
+            limiter.acquire(user)
+        assert limiter.stats()["users"] == 2
+        # The least recent user was evicted and starts with a full bucket
+        assert limiter.acquire("second") == 0
+        assert limiter.acquire("third") > 0
+
+
+class TestFairQueue:
+    """Test the weighted fair queuing of the queries of different users"""
+
+    def test_runs_right_away_with_free_slots(self):
+        queue = FairQueue(slots=2)
+
+        async def run():
+            async with queue.slot("user"):
+                return queue.stats()["running"]
+
+        assert asyncio.run(run()) == 1
+        assert queue.stats()["running"] == 0
+
+    def test_interleaves_users(self):
+        queue = FairQueue(slots=1, max_queued=10)
+        order = []
+        users = ["flooder"] * 4 + ["quiet"]
+        asyncio.run(run_queued(queue, users, order))
+        # The quiet user doesn't wait for every query of the flooder
+        assert order == ["flooder", "quiet", "flooder", "flooder", "flooder"]
+
+    def test_weights(self):
+        queue = FairQueue(slots=1, max_queued=10, weights={"heavy": 2})
+        order = []
+        users = ["light"] * 3 + ["heavy"] * 4
+        asyncio.run(run_queued(queue, users, order))
+        assert order == ["heavy", "light", "heavy", "heavy", "light", "heavy", "light"]
+
+    def test_rejects_when_user_queue_is_full(self):
+        queue = FairQueue(slots=1, max_queued=2)
+        results = asyncio.run(run_queued(queue, ["user"] * 3 + ["other"], []))
+        assert isinstance(results[2], AdmissionRejectedError)
+        assert not any(isinstance(result, Exception) for result in results[:2])
+        assert results[3] is None
+        assert queue.stats()["rejected"] == 1
+
+    def test_rejects_after_timeout(self):
+        queue = FairQueue(slots=1, timeout=0.05)
+
+        async def run():
+            async def hold():
+                async with queue.slot("first"):
+                    await asyncio.sleep(0.3)
+
+            holder = asyncio.create_task(hold())
+            await asyncio.sleep(0)
+            with pytest.raises(AdmissionTimeoutError) as e:
+                async with queue.slot("second"):
+                    pass
+            await holder
+            return e.value
+
+        assert asyncio.run(run()).retry_after == 0.05
+        stats = queue.stats()
+        assert stats["running"] == 0
+        assert stats["queued"] == 0
+
+    def test_cancelled_waiters_free_their_place(self):
+        queue = FairQueue(slots=1)
+
+        async def run():
+            release = asyncio.Event()
+
+            async def hold():
+                async with queue.slot("first"):
+                    await release.wait()
+
+            async def wait():
+                async with queue.slot("second"):
+                    pass
+
+            holder = asyncio.create_task(hold())
+            await asyncio.sleep(0)
+            waiter = asyncio.create_task(wait())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.sleep(0)
+            release.set()
+            await holder
+            async with queue.slot("third"):
+                return queue.stats()
+
+        stats = asyncio.run(run())
+        assert stats["running"] == 1
+        assert stats["queued"] == 0
+
+
+def test_parse_weights():
+    assert parse_weights("") == {}
+    assert parse_weights("uid1:4, uid2:0.5") == {"uid1": 4.0, "uid2": 0.5}
+    with pytest.raises(ValueError):
+        parse_weights("uid1:0")
@@ -0,0 +1,137 @@
+"""ArrowSalesEngine Test"""
+
+import pandas as pd
+import pytest
+
+from app.constants import FILTER_OPERATORS, KEYS_CONSTANTS
+from app.dataloader import LOAD_STAGES, Filter
+from app.services.arrow_engine import (
+    MONTH_PARTITION,
+    ArrowSalesEngine,
+    write_partitioned_data,
+)
+from app.services.export import EXPORT_SCHEMA
+
+
+@pytest.fixture
+def data_dir(testing_data: pd.DataFrame, tmp_path) -> str:
+    path = tmp_path / "data"
+    path.mkdir()
+    testing_data.drop(columns="Index").to_parquet(path / "sales.parquet")
+    return str(path)
+
+
+@pytest.fixture
+def partitioned_data_dir(data_dir: str, tmp_path) -> str:
+    path = tmp_path / "partitioned"
+    write_partitioned_data(data_dir, str(path))
+    return str(path)
+
+
+class TestArrowSalesEngine:
+    """Test out-of-core aggregation"""
+
+    def test_period_employee(
+        self, data_dir, period_filters, employee_filter, total_sales_period_employee
+    ):
+        engine = ArrowSalesEngine(data_dir)
+        total, count = engine.aggregate([*period_filters, employee_filter])
+        assert round(total, 2) == total_sales_period_employee
+        assert count == 2
+
+    def test_store(self, data_dir, store_filter, total_avg_sales_store):
+        engine = ArrowSalesEngine(data_dir)
+        total, count = engine.aggregate([store_filter])
+        assert round(total, 2) == total_avg_sales_store.total
+        assert count == 2
+
+    def test_no_matches(self, data_dir, sales_service_unknown_employee_key):
+        engine = ArrowSalesEngine(data_dir)
+        assert engine.aggregate(sales_service_unknown_employee_key._filters) == (
+            0.0,
+            0,
+        )
+
+    def test_group_totals(self, data_dir, period_filters, total_sales_period_employee):
+        engine = ArrowSalesEngine(data_dir)
+        values, totals, counts = engine.group_totals(
+            period_filters, KEYS_CONSTANTS["Employee"]
+        )
+        groups = dict(zip(values, zip(totals, counts)))
+        assert set(groups) == {"E2", "E3"}
+        assert round(groups["E3"][0], 2) == total_sales_period_employee
+        assert groups["E3"][1] == 2
+
+    def test_export_batches(self, data_dir, store_filter, total_avg_sales_store):
+        engine = ArrowSalesEngine(data_dir)
+        batches = list(engine.export_batches([store_filter]))
+        assert all(batch.schema == EXPORT_SCHEMA for batch in batches)
+        rows = [row for batch in batches for row in batch.to_pylist()]
+        assert len(rows) == 2
+        assert round(sum(row["SaleAmount"] for row in rows), 2) == (
+            total_avg_sales_store.total
+        )
+
+    def test_version(self, data_dir, testing_data: pd.DataFrame):
+        engine = ArrowSalesEngine(data_dir)
+        assert not engine.ready
+        engine.dataset
+        assert engine.version == 0
+        fingerprint = engine.fingerprint
+        assert not engine.refresh()
+        testing_data.drop(columns="Index").to_parquet(f"{data_dir}/sales-2.parquet")
+        assert engine.refresh()
+        assert engine.version == 1
+        assert engine.fingerprint != fingerprint
+        # Any process discovering the same files gets the same fingerprint
+        other = ArrowSalesEngine(data_dir)
+        other.refresh()
+        assert other.fingerprint == engine.fingerprint
+
+    def test_progress(self, data_dir):
+        engine = ArrowSalesEngine(data_dir)
+        assert engine.progress.stage == LOAD_STAGES["pending"]
+        engine.refresh()
+        progress = engine.progress.to_dict()
+        assert progress["stage"] == LOAD_STAGES["ready"]
+        assert progress["files_loaded"] == progress["files_total"] == 1
+
+    def test_partitioned_data(
+        self,
+        partitioned_data_dir,
+        period_filters,
+        store_filter,
+        total_avg_sales_store,
+    ):
+        engine = ArrowSalesEngine(partitioned_data_dir)
+        assert MONTH_PARTITION in engine.dataset.schema.names
+        total, count = engine.aggregate([*period_filters, store_filter])
+        assert round(total, 2) == total_avg_sales_store.total
+        assert count == 2
+
+    def test_partition_pruning(
+        self, partitioned_data_dir, period_filters, store_filter
+    ):
+        engine = ArrowSalesEngine(partitioned_data_dir)
+        expression = engine.build_expression(
+            engine.dataset.schema, [*period_filters, store_filter]
+        )
+        fragments = list(engine.dataset.get_fragments(filter=expression))
+        assert len(fragments) == 1
+
+    def test_store_list_partition_pruning(
+        self, partitioned_data_dir, period_filters, stores
+    ):
+        engine = ArrowSalesEngine(partitioned_data_dir)
+        store_list = Filter(
+            key=KEYS_CONSTANTS["Store"],
+            operator=FILTER_OPERATORS["in"],
+            value=(stores[0], "S9"),
+        )
+        expression = engine.build_expression(
+            engine.dataset.schema, [*period_filters, store_list]
+        )
+        fragments = list(engine.dataset.get_fragments(filter=expression))
+        assert len(fragments) == 1
+        total, count = engine.aggregate([*period_filters, store_list])
+        assert count == 1
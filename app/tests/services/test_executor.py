@@ -0,0 +1,55 @@
+"""QueryExecutor Test"""
+
+import asyncio
+import time
+
+import pytest
+
+from app.services.executor import QueryExecutor, QueryRejectedError
+
+
+class TestQueryExecutor:
+    """Test bounded execution of queries"""
+
+    def test_run(self):
+        executor = QueryExecutor(workers=2, queue_size=2)
+        assert asyncio.run(executor.run(pow, 2, 10)) == 1024
+        stats = executor.stats()
+        assert stats["completed"] == 1
+        assert stats["in_flight"] == 0
+
+    def test_errors_are_raised(self):
+        executor = QueryExecutor(workers=1, queue_size=0)
+        with pytest.raises(ZeroDivisionError):
+            asyncio.run(executor.run(divmod, 1, 0))
+        assert executor.stats()["in_flight"] == 0
+
+    def test_rejects_when_full(self):
+        executor = QueryExecutor(workers=1, queue_size=0, admission_timeout=0.05)
+
+        async def run_two():
+            return await asyncio.gather(
+                executor.run(time.sleep, 0.3),
+                executor.run(time.sleep, 0),
+                return_exceptions=True,
+            )
+
+        first, second = asyncio.run(run_two())
+        assert first is None
+        assert isinstance(second, QueryRejectedError)
+        assert executor.stats()["rejected"] == 1
+
+    def test_queue_wait(self):
+        executor = QueryExecutor(workers=1, queue_size=1)
+
+        async def run_two():
+            await asyncio.gather(
+                executor.run(time.sleep, 0.2), executor.run(time.sleep, 0)
+            )
+
+        asyncio.run(run_two())
+        assert executor.stats()["max_wait_seconds"] >= 0.1
+
+    def test_process_pool(self):
+        executor = QueryExecutor(kind="process", workers=1, queue_size=1)
+        assert asyncio.run(executor.run(pow, 3, 3)) == 27
@@ -0,0 +1,99 @@
+"""Export Test"""
+
+import io
+
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.csv as csv
+import pytest
+
+from app.constants import KEYS_CONSTANTS
+from app.services.export import (
+    EXPORT_FORMATS,
+    EXPORT_SCHEMA,
+    encode_batches,
+    negotiate_format,
+    rows_batch,
+)
+
+
+@pytest.fixture
+def batches():
+    def batch(days, stores, amounts):
+        stores = pa.array(stores)
+        return rows_batch(
+            np.array(days, dtype=np.int32),
+            {
+                KEYS_CONSTANTS["Employee"]: pa.array(["E1"] * len(days)),
+                KEYS_CONSTANTS["Product"]: pa.array(["P1"] * len(days)),
+                KEYS_CONSTANTS["Store"]: stores,
+            },
+            np.array(amounts),
+        )
+
+    # 2024-01-01 is the day 19723
+    return [
+        batch([19723, 19724], ["S1", "S2"], [1.5, 2.0]),
+        batch([19725], ["S1"], [3.0]),
+    ]
+
+
+class TestNegotiateFormat:
+    """Test picking the export format from the Accept header"""
+
+    @pytest.mark.parametrize(
+        "accept, export_format",
+        [
+            (None, EXPORT_FORMATS["csv"]),
+            ("*/*", EXPORT_FORMATS["csv"]),
+            ("text/csv", EXPORT_FORMATS["csv"]),
+            ("application/x-ndjson", EXPORT_FORMATS["ndjson"]),
+            ("application/vnd.apache.arrow.stream", EXPORT_FORMATS["arrow"]),
+            (
+                "text/csv;q=0.5, application/vnd.apache.arrow.stream",
+                EXPORT_FORMATS["arrow"],
+            ),
+            ("application/json, application/x-ndjson;q=0.1", EXPORT_FORMATS["ndjson"]),
+            ("application/json", None),
+            ("text/csv;q=0", None),
+        ],
+    )
+    def test_negotiate_format(self, accept, export_format):
+        assert negotiate_format(accept) == export_format
+
+
+class TestEncodeBatches:
+    """Test encoding the exported rows"""
+
+    def test_csv(self, batches):
+        body = b"".join(encode_batches(batches, EXPORT_FORMATS["csv"]))
+        table = csv.read_csv(io.BytesIO(body))
+        assert table.column_names == EXPORT_SCHEMA.names
+        assert table["KeyStore"].to_pylist() == ["S1", "S2", "S1"]
+        assert table["SaleAmount"].to_pylist() == [1.5, 2.0, 3.0]
+
+    def test_csv_header_without_rows(self):
+        body = b"".join(encode_batches([], EXPORT_FORMATS["csv"]))
+        assert body.decode().strip().replace('"', "").split(",") == EXPORT_SCHEMA.names
+
+    def test_ndjson(self, batches):
+        chunks = list(encode_batches(batches, EXPORT_FORMATS["ndjson"]))
+        assert len(chunks) == 2
+        rows = [orjson.loads(line) for line in b"".join(chunks).splitlines()]
+        assert rows[0] == {
+            "KeyDate": "2024-01-01",
+            "KeyEmployee": "E1",
+            "KeyProduct": "P1",
+            "KeyStore": "S1",
+            "SaleAmount": 1.5,
+        }
+        assert len(rows) == 3
+
+    def test_arrow_stream(self, batches):
+        chunks = list(encode_batches(batches, EXPORT_FORMATS["arrow"]))
+        # Schema, one chunk per batch and the end of stream marker
+        assert len(chunks) == 4
+        table = pa.ipc.open_stream(b"".join(chunks)).read_all()
+        assert table.schema == EXPORT_SCHEMA
+        assert table.num_rows == 3
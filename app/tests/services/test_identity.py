@@ -0,0 +1,101 @@
+"""IdentityClient Test"""
+
+import asyncio
+
+import httpx
+import orjson
+import pytest
+
+from app.services.identity import (
+    IdentityClient,
+    IdentityError,
+    IdentityUnavailableError,
+)
+
+BASE_URL = "http://identity.test/v1"
+
+
+def client(handler, **options) -> IdentityClient:
+    return IdentityClient(
+        api_key="api-key",
+        base_url=BASE_URL,
+        transport=httpx.MockTransport(handler),
+        **options,
+    )
+
+
+def error(message: str) -> httpx.Response:
+    return httpx.Response(400, json={"error": {"code": 400, "message": message}})
+
+
+class TestIdentityClient:
+    """Test the Identity Toolkit calls of login and signup"""
+
+    def test_sign_up(self):
+        requests = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            return httpx.Response(200, json={"localId": "uid", "idToken": "token"})
+
+        user = asyncio.run(client(handler).sign_up("user@celes.com", "secret"))
+        assert user["localId"] == "uid"
+        request = requests[0]
+        assert str(request.url) == f"{BASE_URL}/accounts:signUp?key=api-key"
+        assert orjson.loads(request.content) == {
+            "email": "user@celes.com",
+            "password": "secret",
+            "returnSecureToken": True,
+        }
+
+    def test_sign_in(self):
+        def handler(request: httpx.Request) -> httpx.Response:
+            assert request.url.path == "/v1/accounts:signInWithPassword"
+            return httpx.Response(200, json={"idToken": "token", "expiresIn": "3600"})
+
+        user = asyncio.run(client(handler).sign_in("user@celes.com", "secret"))
+        assert user == {"idToken": "token", "expiresIn": "3600"}
+
+    @pytest.mark.parametrize(
+        "response, code",
+        [
+            (error("EMAIL_EXISTS"), "EMAIL_EXISTS"),
+            (
+                error("WEAK_PASSWORD : Password should be at least 6 characters"),
+                "WEAK_PASSWORD",
+            ),
+            (httpx.Response(500, text="Internal error"), "HTTP 500"),
+        ],
+    )
+    def test_error_code(self, response: httpx.Response, code: str):
+        with pytest.raises(IdentityError) as e:
+            asyncio.run(client(lambda _: response).sign_up("user@celes.com", "pw"))
+        assert e.value.code == code
+
+    def test_unreachable(self):
+        def handler(request: httpx.Request) -> httpx.Response:
+            raise httpx.ConnectTimeout("Timed out", request=request)
+
+        with pytest.raises(IdentityUnavailableError):
+            asyncio.run(client(handler).sign_in("user@celes.com", "secret"))
+
+    def test_bounded_concurrency(self):
+        in_flight = []
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            in_flight.append(request)
+            await asyncio.sleep(0.2)
+            return httpx.Response(200, json={"idToken": "token"})
+
+        async def sign_in_twice():
+            identity = client(handler, timeout=0.05, max_concurrency=1)
+            return await asyncio.gather(
+                identity.sign_in("first@celes.com", "secret"),
+                identity.sign_in("second@celes.com", "secret"),
+                return_exceptions=True,
+            )
+
+        first, second = asyncio.run(sign_in_twice())
+        assert first == {"idToken": "token"}
+        assert isinstance(second, IdentityUnavailableError)
+        assert len(in_flight) == 1
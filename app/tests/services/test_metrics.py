@@ -0,0 +1,79 @@
+"""Metrics Test"""
+
+import pytest
+
+from app.services.metrics import (
+    STAGE_SECONDS,
+    Histogram,
+    measure_stage,
+    render_metric,
+    timed_stage,
+)
+
+
+class TestHistogram:
+    """Test latency histograms and their text exposition"""
+
+    def test_observations_are_cumulative(self):
+        histogram = Histogram("latency_seconds", "Latency", ("route",), (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, "/sales/")
+
+        cumulative, total, count = histogram.snapshot("/sales/")
+        assert cumulative == [2, 3, 4]
+        assert total == pytest.approx(2.65)
+        assert count == 4
+        assert histogram.snapshot("/sales/period") is None
+
+    def test_render(self):
+        histogram = Histogram("latency_seconds", "Latency", ("route",), (0.1,))
+        histogram.observe(0.05, "/sales/")
+        histogram.observe(0.5, '/a"b')
+
+        assert histogram.render() == [
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{route="/a\\"b",le="0.1"} 0',
+            'latency_seconds_bucket{route="/a\\"b",le="+Inf"} 1',
+            'latency_seconds_sum{route="/a\\"b"} 0.5',
+            'latency_seconds_count{route="/a\\"b"} 1',
+            'latency_seconds_bucket{route="/sales/",le="0.1"} 1',
+            'latency_seconds_bucket{route="/sales/",le="+Inf"} 1',
+            'latency_seconds_sum{route="/sales/"} 0.05',
+            'latency_seconds_count{route="/sales/"} 1',
+        ]
+
+    def test_render_metric(self):
+        assert render_metric(
+            "rows", "gauge", "Rows", [({}, 3), ({"column": "Sales"}, 0.5)]
+        ) == [
+            "# HELP rows Rows",
+            "# TYPE rows gauge",
+            "rows 3",
+            'rows{column="Sales"} 0.5',
+        ]
+
+
+class TestStageTiming:
+    """Test stage timing helpers record into the stages histogram"""
+
+    @staticmethod
+    def count(stage: str) -> int:
+        snapshot = STAGE_SECONDS.snapshot(stage)
+        return snapshot[2] if snapshot else 0
+
+    def test_timed_stage(self):
+        @timed_stage("test_decorated")
+        def fail():
+            raise ValueError
+
+        before = self.count("test_decorated")
+        with pytest.raises(ValueError):
+            fail()
+        assert self.count("test_decorated") == before + 1
+
+    def test_measure_stage(self):
+        before = self.count("test_block")
+        with measure_stage("test_block"):
+            pass
+        assert self.count("test_block") == before + 1
@@ -0,0 +1,126 @@
+"""Compiled predicates Test"""
+
+from typing import List
+
+import pytest
+
+from app.constants import FILTER_OPERATORS, KEYS_CONSTANTS
+from app.dataloader import Filter, SalesDataset
+from app.services import predicates
+from app.services.predicates import (
+    AGGREGATE_SCAN_RATIO,
+    CodeRange,
+    CodeSet,
+    compile_filters,
+)
+
+
+def key_filter(key: str, operator: str, value) -> Filter:
+    return Filter(
+        key=KEYS_CONSTANTS[key], operator=FILTER_OPERATORS[operator], value=value
+    )
+
+
+# Filters over the testing dataset and the positions of their matching rows
+FILTER_CASES = [
+    ([], [0, 1, 2, 3, 4]),
+    ([key_filter("Store", "in", ("S2", "S9"))], [3, 4]),
+    ([key_filter("Employee", "in", ("E1", "E3"))], [0, 1, 3, 4]),
+    ([key_filter("Employee", "in", ("E8", "E9"))], []),
+    (
+        [key_filter("Product", "gte", "P2"), key_filter("Product", "lt", "P4")],
+        [1, 2],
+    ),
+    ([key_filter("Product", "gt", "P3")], [3, 4]),
+    (
+        [
+            key_filter("Store", "eq", "S1"),
+            key_filter("Product", "in", ("P2", "P3", "P4")),
+            key_filter("Date", "gte", "2024-01-02"),
+        ],
+        [2],
+    ),
+    (
+        [
+            key_filter("Employee", "in", ("E1", "E2")),
+            key_filter("Employee", "in", ("E2", "E3")),
+        ],
+        [2],
+    ),
+    (
+        [
+            key_filter("Product", "in", ("P1", "P3", "P5")),
+            key_filter("Product", "lte", "P3"),
+        ],
+        [0, 2],
+    ),
+    ([key_filter("Date", "lte", "2024-01-02")], [0, 1, 2]),
+]
+
+
+class TestCompileFilters:
+    """Test compiling filters into index lookups and masks"""
+
+    @pytest.mark.parametrize("filters, positions", FILTER_CASES)
+    def test_positions(
+        self, testing_dataset: SalesDataset, filters: List[Filter], positions
+    ):
+        compiled = compile_filters(testing_dataset, filters)
+        assert compiled.positions().tolist() == positions
+        chunks = list(compiled.chunks(chunk_size=2))
+        assert [position for chunk in chunks for position in chunk] == positions
+        assert all(0 < chunk.size <= 2 for chunk in chunks)
+
+    @pytest.mark.parametrize("filters, positions", FILTER_CASES)
+    @pytest.mark.parametrize("scan_ratio", [0, AGGREGATE_SCAN_RATIO])
+    def test_aggregate(
+        self,
+        testing_dataset: SalesDataset,
+        filters: List[Filter],
+        positions,
+        scan_ratio,
+        monkeypatch,
+    ):
+        # A null ratio never scans the period when an index lookup drives
+        monkeypatch.setattr(predicates, "AGGREGATE_SCAN_RATIO", scan_ratio)
+        compiled = compile_filters(testing_dataset, filters)
+        total, count = compiled.aggregate(testing_dataset.amounts, chunk_size=2)
+        assert count == len(positions)
+        assert total == pytest.approx(testing_dataset.amounts[positions].sum())
+
+    def test_selectivity_order(self, testing_dataset: SalesDataset):
+        compiled = compile_filters(
+            testing_dataset,
+            [
+                key_filter("Store", "eq", "S1"),
+                key_filter("Product", "gte", "P4"),
+                key_filter("Employee", "in", ("E1", "E3")),
+            ],
+        )
+        assert [
+            (type(predicate), predicate.rows) for predicate in compiled.predicates
+        ] == [(CodeRange, 2), (CodeSet, 3), (CodeSet, 4)]
+        assert compiled.estimated_rows == 2
+        assert compiled.positions().size == 0
+
+    def test_filters_are_not_modified(self, testing_dataset: SalesDataset):
+        filters = [
+            key_filter("Store", "in", ("S1", "S2")),
+            key_filter("Store", "eq", "S2"),
+        ]
+        compile_filters(testing_dataset, filters).positions()
+        assert filters == [
+            key_filter("Store", "in", ("S1", "S2")),
+            key_filter("Store", "eq", "S2"),
+        ]
+
+    @pytest.mark.parametrize(
+        "filter",
+        [
+            Filter(key="Qty", operator=FILTER_OPERATORS["eq"], value=1),
+            key_filter("Date", "in", ("2024-01-01",)),
+        ],
+    )
+    def test_unsupported_filter(self, testing_dataset: SalesDataset, filter: Filter):
+        with pytest.raises(ValueError):
+            compile_filters(testing_dataset, [filter])
@@ -0,0 +1,60 @@
+"""Profiler Test"""
+
+import asyncio
+from datetime import datetime, timezone
+
+from app.services import profiler
+from app.services.profiler import (
+    PROFILE_REASONS,
+    ProfileBuffer,
+    ProfileRequest,
+    run_profiled,
+    run_with_profile,
+)
+
+
+def slow_sum(values):
+    return sum(values)
+
+
+class TestProfiler:
+    """Test profiling of queries and the profiles ring buffer"""
+
+    def test_run_profiled(self):
+        result, report = run_profiled(slow_sum, range(10))
+        assert result == 45
+        assert "slow_sum" in report
+
+    def test_run_profiled_while_profiling(self):
+        # A single profiler runs at a time, other queries aren't profiled
+        with profiler._profiler_lock:
+            assert run_profiled(slow_sum, range(10)) == (45, None)
+
+    def test_buffer_keeps_latest_profiles(self):
+        buffer = ProfileBuffer(max_size=2)
+        request = ProfileRequest(path="/sales/", reason=PROFILE_REASONS["header"])
+        started_at = datetime.now(timezone.utc)
+        for _ in range(3):
+            buffer.add(request, "slow_sum", started_at, 0.1, "report")
+
+        assert [profile.id for profile in buffer.list()] == [3, 2]
+        assert buffer.get(1) is None
+        assert buffer.get(3).report == "report"
+        assert "report" not in buffer.get(3).summary()
+        assert request.profile_ids == [1, 2, 3]
+
+    def test_run_with_profile(self, monkeypatch):
+        buffer = ProfileBuffer()
+        monkeypatch.setattr(profiler, "profile_buffer", lambda: buffer)
+        request = ProfileRequest(path="/sales/", reason=PROFILE_REASONS["sampled"])
+
+        async def run(function, *args):
+            return function(*args)
+
+        result = asyncio.run(run_with_profile(request, run, slow_sum, range(10)))
+        assert result == 45
+        profile = buffer.get(request.profile_ids[0])
+        assert profile.path == "/sales/"
+        assert profile.reason == PROFILE_REASONS["sampled"]
+        assert profile.function == "slow_sum"
+        assert "slow_sum" in profile.report
@@ -0,0 +1,46 @@
+"""ResponseCache Test"""
+
+from unittest.mock import patch
+
+from app.services.response_cache import ResponseCache
+
+
+class TestResponseCache:
+    """Test versioned sales responses cache"""
+
+    def test_hit_and_miss(self):
+        cache = ResponseCache()
+        assert cache.get("/sales/?key_store=S1", "v1") is None
+        cache.put("/sales/?key_store=S1", "v1", b"{}")
+        assert cache.get("/sales/?key_store=S1", "v1") == b"{}"
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_new_version_invalidates(self):
+        cache = ResponseCache()
+        cache.put("/sales/?key_store=S1", "v1", b"{}")
+        assert cache.get("/sales/?key_store=S1", "v2") is None
+        assert cache.stats()["size"] == 0
+        # Responses computed over a replaced version aren't cached
+        cache.put("/sales/?key_store=S1", "v1", b"{}")
+        assert cache.stats()["size"] == 0
+
+    def test_size_eviction(self):
+        cache = ResponseCache(max_size=2)
+        for store in ("S1", "S2", "S3"):
+            cache.put(f"/sales/?key_store={store}", "v1", store.encode())
+        assert cache.get("/sales/?key_store=S1", "v1") is None
+        assert cache.get("/sales/?key_store=S3", "v1") == b"S3"
+
+    def test_ttl_eviction(self):
+        cache = ResponseCache(ttl=10.0)
+        with patch("app.services.response_cache.time.monotonic", return_value=100.0):
+            cache.put("/sales/?key_store=S1", "v1", b"{}")
+        with patch("app.services.response_cache.time.monotonic", return_value=111.0):
+            assert cache.get("/sales/?key_store=S1", "v1") is None
+
+    def test_etag(self):
+        etag = ResponseCache.etag("/sales/?key_store=S1", "v1")
+        assert etag == ResponseCache.etag("/sales/?key_store=S1", "v1")
+        assert etag != ResponseCache.etag("/sales/?key_store=S1", "v2")
+        assert etag != ResponseCache.etag("/sales/?key_store=S2", "v1")
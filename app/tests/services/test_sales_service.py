@@ -1,38 +1,49 @@
 """SalesService Test"""
 
+import asyncio
+from datetime import date
 from unittest.mock import patch
 
-import pandas as pd
+import numpy as np
+import pytest
 
+from app.constants import FILTER_OPERATORS, KEYS_CONSTANTS
+from app.dataloader import DatasetStore, Filter, SalesDataset
 from app.schemas.sales_response import TotalAvgSales
-from app.services.sales import SalesService
+from app.services.executor import QueryExecutor
+from app.services.sales import (
+    SalesBatchService,
+    SalesService,
+    at_data_version,
+    data_version,
+)
 
 
 class TestSalesServiceFiltering:
     """Test filtering data"""
 
     def test_period_filter(
-        self, testing_data: pd.DataFrame, sales_service_period: SalesService
+        self, testing_dataset: SalesDataset, sales_service_period: SalesService
     ):
-        filtered_data = sales_service_period._filter_data(testing_data)
+        filtered_data = sales_service_period._filter_data(testing_dataset)
         assert len(filtered_data) == 3
 
     def test_employee_filter(
-        self, testing_data: pd.DataFrame, sales_service_employee_key: SalesService
+        self, testing_dataset: SalesDataset, sales_service_employee_key: SalesService
     ):
-        filtered_data = sales_service_employee_key._filter_data(testing_data)
+        filtered_data = sales_service_employee_key._filter_data(testing_dataset)
         assert len(filtered_data) == 2
 
     def test_product_filter(
-        self, testing_data: pd.DataFrame, sales_service_product_key: SalesService
+        self, testing_dataset: SalesDataset, sales_service_product_key: SalesService
     ):
-        filtered_data = sales_service_product_key._filter_data(testing_data)
+        filtered_data = sales_service_product_key._filter_data(testing_dataset)
         assert len(filtered_data) == 1
 
     def test_store_filter(
-        self, testing_data: pd.DataFrame, sales_service_store_key: SalesService
+        self, testing_dataset: SalesDataset, sales_service_store_key: SalesService
     ):
-        filtered_data = sales_service_store_key._filter_data(testing_data)
+        filtered_data = sales_service_store_key._filter_data(testing_dataset)
         assert len(filtered_data) == 2
 
 
@@ -41,26 +52,29 @@ class TestSalesServiceSalesPeriod:
 
     def test_employee_filter(
         self,
-        testing_data: pd.DataFrame,
+        testing_dataset: SalesDataset,
         sales_service_employee_key: SalesService,
         total_sales_period_employee: float,
     ):
-        with patch("app.services.sales.load_data") as mock_data:
-            mock_data.return_value = testing_data
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
             total_period_sales = sales_service_employee_key.sales_by_period()
             assert total_period_sales == total_sales_period_employee
 
     def test_employee_filter_empty(
         self,
-        testing_data: pd.DataFrame,
+        testing_dataset: SalesDataset,
         sales_service_employee_key: SalesService,
     ):
-        with patch("app.services.sales.load_data") as mock_data:
+        with patch("app.services.sales.load_dataset") as mock_data:
             with patch(
-                "app.services.sales.SalesService._filter_data"
-            ) as mock_filter_data:
-                mock_data.return_value = testing_data
-                mock_filter_data.return_value = pd.DataFrame()
+                "app.services.sales.SalesService._filter_total"
+            ) as mock_filter_total, patch(
+                "app.services.sales.SalesService._rollup_total"
+            ) as mock_rollup_total:
+                mock_data.return_value = testing_dataset
+                mock_filter_total.return_value = (0.0, 0)
+                mock_rollup_total.return_value = None
                 total_period_sales = sales_service_employee_key.sales_by_period()
                 assert total_period_sales == 0.0
 
@@ -70,25 +84,283 @@ class TestSalesServiceTotalAvg:
 
     def test_store_filter(
         self,
-        testing_data: pd.DataFrame,
+        testing_dataset: SalesDataset,
         sales_service_store_key: SalesService,
         total_avg_sales_store: TotalAvgSales,
     ):
-        with patch("app.services.sales.load_data") as mock_data:
-            mock_data.return_value = testing_data
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
             total_avg_sales = sales_service_store_key.total_avg_sales()
             assert total_avg_sales == total_avg_sales_store
 
     def test_store_filter_empty(
         self,
-        testing_data: pd.DataFrame,
+        testing_dataset: SalesDataset,
         sales_service_store_key: SalesService,
     ):
-        with patch("app.services.sales.load_data") as mock_data:
+        with patch("app.services.sales.load_dataset") as mock_data:
             with patch(
-                "app.services.sales.SalesService._filter_data"
-            ) as mock_filter_data:
-                mock_data.return_value = testing_data
-                mock_filter_data.return_value = pd.DataFrame()
+                "app.services.sales.SalesService._filter_total"
+            ) as mock_filter_total, patch(
+                "app.services.sales.SalesService._rollup_total"
+            ) as mock_rollup_total:
+                mock_data.return_value = testing_dataset
+                mock_filter_total.return_value = (0.0, 0)
+                mock_rollup_total.return_value = None
                 total_avg_sales = sales_service_store_key.total_avg_sales()
                 assert total_avg_sales == TotalAvgSales(total=0.0, average=0.0)
+
+
+class TestSalesServiceRollup:
+    """Test sales answered by the daily rollups"""
+
+    def test_rollup_matches_raw_data(
+        self, testing_dataset: SalesDataset, sales_service_store_key: SalesService
+    ):
+        total, count = sales_service_store_key._rollup_total(testing_dataset)
+        raw_total, raw_count = sales_service_store_key._filter_total(testing_dataset)
+        assert round(total, 2) == round(raw_total, 2)
+        assert count == raw_count
+
+    def test_rollup_unknown_key(
+        self, testing_dataset: SalesDataset, sales_service_unknown_employee_key
+    ):
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            assert sales_service_unknown_employee_key.sales_by_period() == 0.0
+
+    def test_uncovered_filters_fallback(
+        self,
+        testing_dataset: SalesDataset,
+        sales_service_employee_store_key: SalesService,
+        total_sales_period_employee: float,
+    ):
+        assert sales_service_employee_store_key._rollup_total(testing_dataset) is None
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            total_period_sales = sales_service_employee_store_key.sales_by_period()
+            assert total_period_sales == total_sales_period_employee
+
+
+class TestSalesBatchService:
+    """Test many filter sets evaluated together"""
+
+    def test_batch_matches_single_queries(
+        self,
+        testing_dataset: SalesDataset,
+        sales_service_employee_key: SalesService,
+        sales_service_store_key: SalesService,
+        sales_service_employee_store_key: SalesService,
+        sales_service_unknown_employee_key: SalesService,
+    ):
+        services = [
+            sales_service_employee_key,
+            sales_service_store_key,
+            sales_service_employee_store_key,
+            sales_service_unknown_employee_key,
+        ]
+        batch = SalesBatchService([service._filters for service in services])
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            results = batch.total_avg_sales()
+            expected = [service.total_avg_sales() for service in services]
+        assert results == expected
+
+    def test_failed_filter_set(
+        self, testing_dataset: SalesDataset, sales_service_store_key: SalesService
+    ):
+        unsupported = Filter(key="KeyCity", operator=FILTER_OPERATORS["eq"], value="C1")
+        batch = SalesBatchService(
+            [[unsupported, unsupported], sales_service_store_key._filters]
+        )
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            failed, total_avg = batch.total_avg_sales()
+        assert isinstance(failed, ValueError)
+        assert total_avg == sales_service_store_key._total_avg(
+            *sales_service_store_key._aggregate(testing_dataset)
+        )
+
+
+class TestSalesServiceBreakdown:
+    """Test sales grouped by key"""
+
+    def test_period_breakdown(
+        self, testing_dataset: SalesDataset, sales_service_period: SalesService
+    ):
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            breakdown = sales_service_period.breakdown(KEYS_CONSTANTS["Store"])
+        assert [group.key for group in breakdown] == ["S1", "S2"]
+        assert [group.count for group in breakdown] == [1, 2]
+
+    def test_filtered_breakdown_matches_rollups(
+        self,
+        testing_dataset: SalesDataset,
+        sales_service_period: SalesService,
+        store_filter: Filter,
+    ):
+        service = SalesService(filters=[*sales_service_period._filters, store_filter])
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            filtered = service.breakdown(KEYS_CONSTANTS["Employee"])
+            rolled_up = sales_service_period.breakdown(KEYS_CONSTANTS["Employee"])
+        # Only E3 sold in S2, so both ways agree on it
+        assert [group.key for group in filtered] == ["E3"]
+        assert filtered[0] == next(group for group in rolled_up if group.key == "E3")
+
+    def test_top_and_order(self):
+        totals = np.array([5.0, 0.0, 9.0, 1.0, 7.0])
+        counts = np.array([1, 0, 3, 1, 2])
+        assert SalesService._select_top(totals, counts, 2, False).tolist() == [2, 4]
+        assert SalesService._select_top(totals, counts, 2, True).tolist() == [3, 0]
+        assert SalesService._select_top(totals, counts, None, True).tolist() == [
+            3,
+            0,
+            4,
+            2,
+        ]
+
+
+class TestSalesServiceSeries:
+    """Test sales bucketed by time"""
+
+    def test_daily_series(
+        self, testing_dataset: SalesDataset, sales_service_period: SalesService
+    ):
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            series = sales_service_period.series(rolling=2)
+        assert [point.period.isoformat() for point in series] == [
+            "2024-01-02",
+            "2024-01-03",
+        ]
+        assert [point.count for point in series] == [1, 2]
+        assert series[1].rolling_average == round(
+            (series[0].total + series[1].total) / 2, 2
+        )
+
+    def test_rollup_series_matches_raw_data(
+        self,
+        testing_dataset: SalesDataset,
+        sales_service_employee_key: SalesService,
+        sales_service_employee_store_key: SalesService,
+    ):
+        # Only E3 sold in S2, so both filter sets match the same sales
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            rolled_up = sales_service_employee_key.series()
+            raw = sales_service_employee_store_key.series()
+        assert rolled_up == raw
+        assert [point.count for point in raw] == [0, 2]
+
+    def test_weekly_and_monthly_buckets(self):
+        days = np.array([19723, 19724, 19730, 19754])  # 2024-01-01 is a Monday
+        assert SalesService._bucket_start(days, "week").tolist() == [
+            19723,
+            19723,
+            19730,
+            19751,
+        ]
+        assert SalesService._bucket_start(days, "month").tolist() == [
+            19723,
+            19723,
+            19723,
+            19754,
+        ]
+
+    def test_bucket_count(self):
+        first, last = date(2024, 1, 7), date(2024, 3, 1)  # A Sunday to a Friday
+        assert SalesService.bucket_count(first, last, "day") == 55
+        assert SalesService.bucket_count(first, last, "week") == 9
+        assert SalesService.bucket_count(first, last, "month") == 3
+        assert SalesService.bucket_count(last, first, "day") == 0
+
+    def test_unbounded_period(
+        self, testing_dataset: SalesDataset, sales_service_store_key: SalesService
+    ):
+        service = SalesService(filters=sales_service_store_key._filters[1:])
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            with pytest.raises(ValueError):
+                service.series()
+
+
+class TestSalesServiceExport:
+    """Test streaming the filtered sales rows"""
+
+    def test_period_rows_in_chunks(
+        self, testing_dataset: SalesDataset, sales_service_period: SalesService
+    ):
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            batches = list(sales_service_period.export_batches(chunk_size=2))
+        assert [batch.num_rows for batch in batches] == [2, 1]
+        rows = [row for batch in batches for row in batch.to_pylist()]
+        positions = sales_service_period._filter_data(testing_dataset)
+        assert [row[KEYS_CONSTANTS["Date"]].isoformat() for row in rows] == [
+            str(day) for day in testing_dataset.days[positions].astype("datetime64[D]")
+        ]
+        assert sum(row["SaleAmount"] for row in rows) == pytest.approx(
+            testing_dataset.amounts[positions].sum()
+        )
+
+    def test_key_and_range_filters(self, testing_dataset: SalesDataset, stores):
+        service = SalesService(
+            filters=[
+                Filter(
+                    key=KEYS_CONSTANTS["Store"],
+                    operator=FILTER_OPERATORS["eq"],
+                    value=stores[0],
+                ),
+                Filter(
+                    key=KEYS_CONSTANTS["Product"],
+                    operator=FILTER_OPERATORS["gt"],
+                    value="P1",
+                ),
+            ]
+        )
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            rows = [
+                row
+                for batch in service.export_batches(chunk_size=1)
+                for row in batch.to_pylist()
+            ]
+        assert [row[KEYS_CONSTANTS["Product"]] for row in rows] == ["P2", "P3"]
+        assert {row[KEYS_CONSTANTS["Store"]] for row in rows} == {stores[0]}
+
+    def test_unsupported_filter(self, testing_dataset: SalesDataset):
+        service = SalesService(
+            filters=[Filter(key="Unknown", operator=FILTER_OPERATORS["eq"], value=1)]
+        )
+        with patch("app.services.sales.load_dataset") as mock_data:
+            mock_data.return_value = testing_dataset
+            # Raised right away, before any row is streamed
+            with pytest.raises(ValueError):
+                service.export_batches()
+
+
+class TestAtDataVersion:
+    """Test pool processes catching up with the data version of the app"""
+
+    def test_process_pool_follows_reloads(self, testing_data, tmp_path, monkeypatch):
+        def write_parquet(name: str) -> None:
+            testing_data.drop(columns="Index").to_parquet(tmp_path / name)
+
+        write_parquet("sales-1.parquet")
+        store = DatasetStore(str(tmp_path), snapshot=False)
+        # Spawned pool processes load the data directory of their environment
+        monkeypatch.setenv("SALES_DATA_DIR", str(tmp_path))
+        executor = QueryExecutor(kind="process", workers=1)
+        query = SalesService(filters=[]).sales_by_period
+        with patch("app.dataloader.dataset_store", store), patch(
+            "app.services.sales.dataset_store", store
+        ):
+            first = asyncio.run(executor.run(at_data_version, data_version(), query))
+            write_parquet("sales-2.parquet")
+            store.refresh()
+            # The pool process still holds the first version of the dataset
+            second = asyncio.run(executor.run(at_data_version, data_version(), query))
+        assert first > 0
+        assert second == pytest.approx(2 * first)
@@ -0,0 +1,136 @@
+"""ShardedSalesEngine Test"""
+
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+import pytest
+
+from app.config import app_settings
+from app.constants import FILTER_OPERATORS, KEYS_CONSTANTS
+from app.dataloader import LOAD_STAGES, Filter, SalesDataset, shard_of
+from app.services.sales import SalesService
+from app.services.sharded_engine import DatasetShard, ShardedSalesEngine, default_shards
+
+
+@pytest.fixture
+def data_dir(testing_data: pd.DataFrame, tmp_path) -> str:
+    path = tmp_path / "data"
+    path.mkdir()
+    testing_data.drop(columns="Index").to_parquet(path / "sales-1.parquet")
+    return str(path)
+
+
+class TestDatasetShard:
+    """Test the rows held by a shard worker"""
+
+    def test_shard_rows(self, data_dir, testing_dataset: SalesDataset):
+        shards = [DatasetShard(shard, 2, data_dir).dataset(0) for shard in range(2)]
+        assert sum(len(shard) for shard in shards) == len(testing_dataset)
+
+    def test_reload_on_newer_version(self, data_dir, testing_data: pd.DataFrame):
+        shard = DatasetShard(0, 1, data_dir)
+        assert len(shard.dataset(0)) == 5
+
+        new_sales = testing_data.drop(columns="Index")
+        new_sales.to_parquet(f"{data_dir}/sales-2.parquet")
+        assert len(shard.dataset(0)) == 5
+        assert len(shard.dataset(1)) == 10
+
+
+class TestShardedSalesEngine:
+    """Test scatter-gather of queries over the shard workers"""
+
+    def test_store_filter_routes_to_its_shard(self, data_dir, store_filter):
+        engine = ShardedSalesEngine(shards=4, data_dir=data_dir)
+        assert engine.shards_of([store_filter]) == [shard_of(store_filter.value, 4)]
+        assert engine.shards_of([]) == [0, 1, 2, 3]
+
+    def test_store_list_routes_to_their_shards(self, data_dir):
+        engine = ShardedSalesEngine(shards=4, data_dir=data_dir)
+        stores = Filter(
+            key=KEYS_CONSTANTS["Store"],
+            operator=FILTER_OPERATORS["in"],
+            value=("S1", "S2"),
+        )
+        assert engine.shards_of([stores]) == sorted(
+            {shard_of("S1", 4), shard_of("S2", 4)}
+        )
+
+    def test_scatter_matches_single_dataset(
+        self, data_dir, testing_dataset: SalesDataset, period_filters
+    ):
+        engine = ShardedSalesEngine(shards=2, data_dir=data_dir)
+        try:
+            partials = engine.scatter(SalesService._shard_totals, period_filters)
+        finally:
+            engine.shutdown()
+        assert len(partials) == 2
+        total = sum(total for total, _ in partials)
+        count = sum(count for _, count in partials)
+        expected_total, expected_count = SalesService(period_filters)._aggregate(
+            testing_dataset
+        )
+        assert round(total, 2) == expected_total
+        assert count == expected_count
+        assert engine.version == 0
+
+    def test_failed_loads_are_retried(
+        self, data_dir, testing_data: pd.DataFrame, tmp_path, monkeypatch
+    ):
+        data_file = tmp_path / "data" / "sales-1.parquet"
+        data_file.write_bytes(b"not parquet")
+        monkeypatch.setattr(ShardedSalesEngine, "RETRY_INTERVAL", 0.1)
+        engine = ShardedSalesEngine(shards=2, data_dir=data_dir)
+        try:
+            engine.start()
+            engine._loader.join(timeout=3)
+            assert engine._loader.is_alive()
+            assert not engine.ready
+            assert engine.progress.stage != LOAD_STAGES["ready"]
+
+            testing_data.drop(columns="Index").to_parquet(data_file)
+            engine._loader.join(timeout=30)
+            assert engine.ready
+            assert engine.progress.stage == LOAD_STAGES["ready"]
+        finally:
+            engine.shutdown()
+
+    def test_dead_worker_is_replaced(self, data_dir, period_filters):
+        engine = ShardedSalesEngine(shards=1, data_dir=data_dir)
+        try:
+            engine.start()
+            engine._loader.join(timeout=30)
+            for process in engine._pools[0]._processes.values():
+                process.kill()
+            with pytest.raises(BrokenProcessPool):
+                engine.scatter(SalesService._shard_totals, period_filters)
+            assert not engine.ready
+
+            engine._loader.join(timeout=30)
+            assert engine.ready
+            assert engine.scatter(SalesService._shard_totals, period_filters)
+        finally:
+            engine.shutdown()
+
+    def test_export_after_reload(self, data_dir, testing_data: pd.DataFrame):
+        engine = ShardedSalesEngine(shards=1, data_dir=data_dir)
+        try:
+            engine.refresh()
+            assert sum(len(batch) for batch in engine.export_batches([], 2)) == 5
+
+            testing_data.drop(columns="Index").to_parquet(f"{data_dir}/sales-2.parquet")
+            os.remove(f"{data_dir}/sales-1.parquet")
+            testing_data.drop(columns="Index").to_parquet(f"{data_dir}/sales-3.parquet")
+            engine.refresh()
+            assert sum(len(batch) for batch in engine.export_batches([], 2)) == 10
+        finally:
+            engine.shutdown()
+
+
+def test_default_shards_split_cpus_between_workers(monkeypatch):
+    monkeypatch.setattr("os.cpu_count", lambda: 8)
+    monkeypatch.setattr(app_settings(), "WEB_CONCURRENCY", 4)
+    assert default_shards() == 2
+    monkeypatch.setattr(app_settings(), "WEB_CONCURRENCY", 16)
+    assert default_shards() == 1
@@ -0,0 +1,79 @@
+"""SingleFlight Test"""
+
+import asyncio
+
+import pytest
+
+from app.services.single_flight import SingleFlight
+
+
+class TestSingleFlight:
+    """Test coalescing of identical concurrent calls"""
+
+    def test_identical_calls_share_result(self):
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return b"{}"
+
+        async def burst(single_flight: SingleFlight):
+            return await asyncio.gather(
+                *[single_flight.run("/sales/?key_store=S1", compute) for _ in range(10)]
+            )
+
+        single_flight = SingleFlight()
+        assert asyncio.run(burst(single_flight)) == [b"{}"] * 10
+        assert len(calls) == 1
+        assert single_flight.stats()["executions"] == 1
+        assert single_flight.stats()["coalesced"] == 9
+        assert single_flight.stats()["in_flight"] == 0
+
+    def test_different_and_sequential_calls(self):
+        async def compute():
+            return b"{}"
+
+        async def calls(single_flight: SingleFlight):
+            await asyncio.gather(
+                single_flight.run("/sales/?key_store=S1", compute),
+                single_flight.run("/sales/?key_store=S2", compute),
+            )
+            await single_flight.run("/sales/?key_store=S1", compute)
+
+        single_flight = SingleFlight()
+        asyncio.run(calls(single_flight))
+        assert single_flight.stats()["executions"] == 3
+        assert single_flight.stats()["coalesced"] == 0
+
+    def test_shared_exception(self):
+        async def compute():
+            await asyncio.sleep(0.01)
+            raise ValueError("Filtering by KeyCity is not supported")
+
+        async def burst(single_flight: SingleFlight):
+            return await asyncio.gather(
+                *[single_flight.run("/sales/?key_city=C1", compute) for _ in range(3)],
+                return_exceptions=True,
+            )
+
+        single_flight = SingleFlight()
+        errors = asyncio.run(burst(single_flight))
+        assert all(isinstance(error, ValueError) for error in errors)
+        assert single_flight.stats()["executions"] == 1
+
+    def test_caller_cancellation(self):
+        async def compute():
+            await asyncio.sleep(0.02)
+            return b"{}"
+
+        async def calls(single_flight: SingleFlight):
+            leader = asyncio.ensure_future(single_flight.run("key", compute))
+            follower = asyncio.ensure_future(single_flight.run("key", compute))
+            await asyncio.sleep(0)
+            leader.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await leader
+            return await follower
+
+        assert asyncio.run(calls(SingleFlight())) == b"{}"
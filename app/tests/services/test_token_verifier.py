@@ -0,0 +1,155 @@
+"""TokenVerifier Test"""
+
+import datetime
+import time
+
+import jwt
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from app.services.token_verifier import (
+    FIREBASE_ISSUER,
+    ExpiredTokenError,
+    InvalidTokenError,
+    SigningKeys,
+    TokenVerifier,
+)
+
+PROJECT_ID = "celes-test"
+KEY_ID = "test-key"
+
+
+@pytest.fixture(scope="module")
+def private_key() -> rsa.RSAPrivateKey:
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture(scope="module")
+def certificate(private_key) -> str:
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "securetoken")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(private_key, hashes.SHA256())
+    )
+    return certificate.public_bytes(serialization.Encoding.PEM).decode()
+
+
+@pytest.fixture
+def fetch_calls():
+    return []
+
+
+@pytest.fixture
+def token_verifier(certificate, fetch_calls) -> TokenVerifier:
+    def fetch():
+        fetch_calls.append(time.time())
+        return {KEY_ID: certificate}, 3600.0
+
+    return TokenVerifier(SigningKeys(fetch), project_id=PROJECT_ID, ttl=60.0)
+
+
+def make_token(private_key, expires_in: int = 3600, key_id: str = KEY_ID, **claims):
+    now = int(time.time())
+    payload = {
+        "iss": FIREBASE_ISSUER.format(project_id=PROJECT_ID),
+        "aud": PROJECT_ID,
+        "sub": "user-uid",
+        "iat": now,
+        "exp": now + expires_in,
+        **claims,
+    }
+    return jwt.encode(payload, private_key, algorithm="RS256", headers={"kid": key_id})
+
+
+class TestTokenVerifier:
+    """Test token verification and caching"""
+
+    def test_valid_token(self, token_verifier: TokenVerifier, private_key):
+        claims = token_verifier.verify(make_token(private_key))
+        assert claims["sub"] == "user-uid"
+
+    def test_cached_token(
+        self, token_verifier: TokenVerifier, private_key, fetch_calls
+    ):
+        token = make_token(private_key)
+        first = token_verifier.verify(token)
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            monkeypatch.setattr(jwt, "decode", None)  # Cache hits never decode
+            assert token_verifier.verify(token) == first
+        assert token_verifier.stats()["hits"] == 1
+        assert token_verifier.stats()["misses"] == 1
+        assert len(fetch_calls) == 1
+
+    def test_cache_expires_with_token(self, token_verifier: TokenVerifier, private_key):
+        token = make_token(private_key, expires_in=1)
+        token_verifier.verify(token)
+        time.sleep(1.1)
+        with pytest.raises(ExpiredTokenError):
+            token_verifier.verify(token)
+
+    def test_cache_is_bounded(self, certificate, private_key):
+        verifier = TokenVerifier(
+            SigningKeys(lambda: ({KEY_ID: certificate}, 3600.0)),
+            project_id=PROJECT_ID,
+            max_size=2,
+        )
+        for subject in ("a", "b", "c"):
+            verifier.verify(make_token(private_key, sub=subject))
+        assert verifier.stats()["size"] == 2
+
+    def test_expired_token(self, token_verifier: TokenVerifier, private_key):
+        with pytest.raises(ExpiredTokenError):
+            token_verifier.verify(make_token(private_key, expires_in=-10))
+
+    def test_wrong_audience(self, token_verifier: TokenVerifier, private_key):
+        with pytest.raises(InvalidTokenError):
+            token_verifier.verify(make_token(private_key, aud="other-project"))
+
+    def test_unknown_key(
+        self, token_verifier: TokenVerifier, private_key, fetch_calls, monkeypatch
+    ):
+        token_verifier.verify(make_token(private_key))
+        for _ in range(10):
+            with pytest.raises(InvalidTokenError):
+                token_verifier.verify(make_token(private_key, key_id="forged-key"))
+        # Unknown keys don't fetch the keys again right after a fetch
+        assert len(fetch_calls) == 1
+
+        monkeypatch.setattr(SigningKeys, "REFETCH_INTERVAL", 0.0)
+        with pytest.raises(InvalidTokenError):
+            token_verifier.verify(make_token(private_key, key_id="rotated-key"))
+        # But they do later on, in case keys were rotated
+        assert len(fetch_calls) == 2
+
+    def test_failed_fetch_is_throttled(self, private_key):
+        fetch_calls = []
+
+        def fetch():
+            fetch_calls.append(time.time())
+            raise ConnectionError("Unreachable")
+
+        verifier = TokenVerifier(SigningKeys(fetch), project_id=PROJECT_ID)
+        for _ in range(5):
+            with pytest.raises(Exception):
+                verifier.verify(make_token(private_key))
+        assert len(fetch_calls) == 1
+
+    def test_cached_claims(self, token_verifier: TokenVerifier, private_key):
+        token = make_token(private_key)
+        assert token_verifier.cached_claims(token) is None
+        claims = token_verifier.verify(token)
+        assert token_verifier.cached_claims(token) == claims
+
+    def test_malformed_token(self, token_verifier: TokenVerifier):
+        with pytest.raises(InvalidTokenError):
+            token_verifier.verify("not-a-token")
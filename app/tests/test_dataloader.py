@@ -0,0 +1,370 @@
+"""Dataloader Test"""
+
+import tracemalloc
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.constants import FILTER_OPERATORS, INDEXED_KEYS, KEYS_CONSTANTS
+from app.dataloader import (
+    LOAD_STAGES,
+    SNAPSHOT_DIR,
+    DataFile,
+    DatasetStore,
+    DatasetWarmup,
+    Filter,
+    KeyIndex,
+    SalesDataset,
+    day_range,
+    period_bounds,
+    shard_of,
+    to_day_number,
+)
+
+
+def date_filter(operator: str, value: str) -> Filter:
+    return Filter(
+        key=KEYS_CONSTANTS["Date"], operator=FILTER_OPERATORS[operator], value=value
+    )
+
+
+@pytest.fixture
+def sales_days(sales_dates) -> np.ndarray:
+    return np.array([to_day_number(date) for date in sales_dates], dtype=np.int32)
+
+
+class TestPeriodBounds:
+    """Test binary search over sorted dates"""
+
+    def test_closed_period(self, sales_days):
+        filters = [date_filter("gte", "2024-01-02"), date_filter("lte", "2024-01-03")]
+        assert period_bounds(sales_days, filters) == (2, 5)
+
+    def test_open_period(self, sales_days):
+        assert period_bounds(sales_days, [date_filter("gt", "2024-01-01")]) == (2, 5)
+        assert period_bounds(sales_days, [date_filter("lt", "2024-01-02")]) == (0, 2)
+        assert period_bounds(sales_days, [date_filter("eq", "2024-01-03")]) == (3, 5)
+
+    def test_search_without_copying_days(self):
+        days = np.arange(19000, 19000 + 1_000_000, dtype=np.int32)
+        tracemalloc.start()
+        try:
+            period_bounds(days, [date_filter("gte", "2024-01-02")])
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert peak < days.nbytes
+
+    def test_empty_period(self, sales_days):
+        filters = [date_filter("gte", "2024-01-03"), date_filter("lte", "2024-01-01")]
+        lo, hi = period_bounds(sales_days, filters)
+        assert lo == hi
+
+
+class TestKeyIndex:
+    """Test inverted key indexes"""
+
+    def test_lookup(self, sales_days):
+        index = KeyIndex(np.array([0, 0, 0, 1, 1], dtype=np.int32), 2, sales_days)
+        assert index.lookup(0).tolist() == [0, 1, 2]
+        assert index.lookup(1).tolist() == [3, 4]
+
+    def test_lookup_period(self, sales_days):
+        index = KeyIndex(np.array([0, 0, 0, 1, 1], dtype=np.int32), 2, sales_days)
+        positions = index.lookup(0, [date_filter("gte", "2024-01-02")])
+        assert positions.tolist() == [2]
+
+    def test_lookup_missing_value(self, sales_days):
+        index = KeyIndex(np.array([0, 0, 0, 1, 1], dtype=np.int32), 2, sales_days)
+        assert index.lookup(-1).size == 0
+
+    def test_code_ranges(self, sales_days):
+        index = KeyIndex(np.array([2, 0, 1, 2, 0], dtype=np.int32), 3, sales_days)
+        assert index.lookup_range(1, 3).tolist() == [0, 2, 3]
+        assert index.count_range(1, 3) == 3
+        assert index.count(np.array([0, 2])) == 4
+        assert index.lookup_range(1, 1).size == 0
+
+
+class TestSalesDataset:
+    """Test compact dataset built at load time"""
+
+    def test_encoding(self, testing_dataset: SalesDataset, stores):
+        store_key = KEYS_CONSTANTS["Store"]
+        assert testing_dataset.codes[store_key].dtype == np.int32
+        assert testing_dataset.days.dtype == np.int32
+        assert testing_dataset.amounts.dtype == np.float64
+        decoded = testing_dataset.dictionaries[store_key][
+            testing_dataset.codes[store_key]
+        ]
+        assert decoded.tolist() == stores
+        assert testing_dataset.encode(store_key, "S2") == 1
+        assert testing_dataset.encode(store_key, "S9") == -1
+
+    def test_indexes(self, testing_dataset: SalesDataset):
+        assert set(testing_dataset.indexes) == set(INDEXED_KEYS)
+        employee_key = KEYS_CONSTANTS["Employee"]
+        code = testing_dataset.encode(employee_key, "E3")
+        positions = testing_dataset.indexes[employee_key].lookup(code)
+        assert (testing_dataset.codes[employee_key][positions] == code).all()
+
+    def test_sorted_by_date(self, testing_data: pd.DataFrame):
+        dataset = SalesDataset(testing_data.iloc[::-1])
+        assert np.all(np.diff(dataset.days) >= 0)
+
+    def test_memory_report(self, testing_dataset: SalesDataset):
+        report = {
+            column: compact for column, _, compact in testing_dataset.memory_report()
+        }
+        assert report[KEYS_CONSTANTS["Date"]] == 5 * 4
+        assert report["Rollups"] == testing_dataset.rollups_nbytes
+
+    def test_shards(self, testing_dataset: SalesDataset):
+        store_key = KEYS_CONSTANTS["Store"]
+        shards = [testing_dataset.shard(store_key, shard, 2) for shard in range(2)]
+        assert sum(len(shard) for shard in shards) == len(testing_dataset)
+        for position, shard in enumerate(shards):
+            stores = shard.dictionaries[store_key][shard.codes[store_key]]
+            assert all(shard_of(store, 2) == position for store in stores)
+            assert shard.version == testing_dataset.version
+        assert sum(shard.amounts.sum() for shard in shards) == pytest.approx(
+            testing_dataset.amounts.sum()
+        )
+
+
+class TestDailyRollup:
+    """Test daily rollups built at load time"""
+
+    def test_rollups(self, testing_dataset: SalesDataset):
+        assert set(testing_dataset.rollups) == set(INDEXED_KEYS)
+        assert testing_dataset.rollups_nbytes > 0
+
+    def test_lookup_period(
+        self, testing_dataset: SalesDataset, sales_qtys, sales_costs
+    ):
+        store_key = KEYS_CONSTANTS["Store"]
+        rollup = testing_dataset.rollups[store_key]
+        code = testing_dataset.encode(store_key, "S1")
+        total, count = rollup.lookup(code, [date_filter("gte", "2024-01-02")])
+        assert count == 1
+        assert total == pytest.approx(sales_qtys[2] * sales_costs[2])
+
+    def test_lookup_many(self, testing_dataset: SalesDataset):
+        employee_key = KEYS_CONSTANTS["Employee"]
+        rollup = testing_dataset.rollups[employee_key]
+        periods = [
+            (testing_dataset.encode(employee_key, "E1"), ()),
+            (
+                testing_dataset.encode(employee_key, "E3"),
+                [date_filter("gt", "2024-01-01")],
+            ),
+            (
+                testing_dataset.encode(employee_key, "E2"),
+                [date_filter("lt", "2024-01-02")],
+            ),
+            (-1, ()),
+        ]
+        codes = [code for code, _ in periods]
+        first_days, last_days = zip(*[day_range(filters) for _, filters in periods])
+        totals, counts = rollup.lookup_many(codes, first_days, last_days)
+        for (code, filters), total, count in zip(periods, totals, counts):
+            expected_total, expected_count = rollup.lookup(code, filters)
+            assert total == pytest.approx(expected_total)
+            assert count == expected_count
+
+    def test_lookup_whole_history(self, testing_dataset: SalesDataset):
+        employee_key = KEYS_CONSTANTS["Employee"]
+        rollup = testing_dataset.rollups[employee_key]
+        assert rollup.lookup(testing_dataset.encode(employee_key, "E1"))[1] == 2
+        assert rollup.lookup(-1) == (0.0, 0)
+
+
+class TestDatasetStore:
+    """Test data reloading"""
+
+    @staticmethod
+    def write_parquet(data: pd.DataFrame, path) -> None:
+        data.drop(columns="Index").to_parquet(path, engine="pyarrow")
+
+    def test_initial_load(self, testing_data: pd.DataFrame, tmp_path):
+        self.write_parquet(testing_data, tmp_path / "sales-1.parquet")
+        store = DatasetStore(str(tmp_path))
+        assert len(store.dataset) == 5
+        assert store.dataset.version == 0
+        assert store.refresh() is False
+
+    def test_new_file(self, testing_data: pd.DataFrame, tmp_path):
+        self.write_parquet(testing_data, tmp_path / "sales-1.parquet")
+        store = DatasetStore(str(tmp_path))
+        previous = store.dataset
+
+        new_sales = testing_data.assign(**{KEYS_CONSTANTS["Store"]: "S3"})
+        self.write_parquet(new_sales, tmp_path / "sales-2.parquet")
+        assert store.refresh() is True
+        assert store.dataset.version == previous.version + 1
+        assert len(store.dataset) == 10
+        assert store.dataset.dictionaries[KEYS_CONSTANTS["Store"]].tolist() == [
+            "S1",
+            "S2",
+            "S3",
+        ]
+        # The previous version is left untouched for in-flight requests
+        assert len(previous) == 5
+
+    def test_changed_and_removed_files(self, testing_data: pd.DataFrame, tmp_path):
+        self.write_parquet(testing_data, tmp_path / "sales-1.parquet")
+        self.write_parquet(testing_data, tmp_path / "sales-2.parquet")
+        store = DatasetStore(str(tmp_path))
+        assert len(store.dataset) == 10
+
+        self.write_parquet(testing_data.iloc[:2], tmp_path / "sales-1.parquet")
+        (tmp_path / "sales-2.parquet").unlink()
+        assert store.refresh() is True
+        assert len(store.dataset) == 2
+        assert [file.path for file in store.dataset.files] == [
+            str(tmp_path / "sales-1.parquet")
+        ]
+
+    def test_fingerprint(self, testing_data: pd.DataFrame, tmp_path):
+        self.write_parquet(testing_data, tmp_path / "sales-1.parquet")
+        store = DatasetStore(str(tmp_path), snapshot=False)
+        first = store.dataset.fingerprint
+        self.write_parquet(testing_data.head(2), tmp_path / "sales-2.parquet")
+        store.refresh()
+        assert store.dataset.version == 1
+        assert store.dataset.fingerprint != first
+        # A worker loading the same files from scratch is at another version
+        # number, but at the same fingerprint
+        fresh = DatasetStore(str(tmp_path), snapshot=False).dataset
+        assert fresh.version == 0
+        assert fresh.fingerprint == store.dataset.fingerprint
+
+    def test_merge_matches_full_build(self, testing_data: pd.DataFrame):
+        dataset = SalesDataset(testing_data.iloc[:3])
+        delta = testing_data.iloc[3:]
+        merged = dataset.merge(
+            delta,
+            [DataFile(path="delta", mtime_ns=0, size=0)],
+            np.zeros(len(delta.index), dtype=np.int32),
+        )
+        full = SalesDataset(testing_data)
+        assert np.array_equal(merged.days, full.days)
+        assert np.allclose(merged.amounts, full.amounts)
+        for key in INDEXED_KEYS:
+            assert np.array_equal(merged.codes[key], full.codes[key])
+            assert merged.dictionaries[key].tolist() == full.dictionaries[key].tolist()
+
+
+class TestDatasetSnapshot:
+    """Test memory-mapped dataset snapshots"""
+
+    def test_workers_open_snapshot(self, testing_data: pd.DataFrame, tmp_path):
+        TestDatasetStore.write_parquet(testing_data, tmp_path / "sales-1.parquet")
+        built = DatasetStore(str(tmp_path)).dataset
+        assert (tmp_path / SNAPSHOT_DIR).is_dir()
+
+        with patch("app.dataloader.load_data") as mock_load_data:
+            opened = DatasetStore(str(tmp_path)).dataset
+            mock_load_data.assert_not_called()
+        assert opened.version == built.version
+        assert opened.fingerprint == built.fingerprint
+        assert opened.files == built.files
+        assert np.array_equal(opened.days, built.days)
+        assert not opened.days.flags.owndata
+        for key in INDEXED_KEYS:
+            assert opened.dictionaries[key].tolist() == built.dictionaries[key].tolist()
+            assert opened.rollups[key].lookup(0) == built.rollups[key].lookup(0)
+            assert np.array_equal(
+                opened.indexes[key].lookup(0), built.indexes[key].lookup(0)
+            )
+
+    def test_stale_snapshot(self, testing_data: pd.DataFrame, tmp_path):
+        TestDatasetStore.write_parquet(testing_data, tmp_path / "sales-1.parquet")
+        DatasetStore(str(tmp_path)).dataset
+        TestDatasetStore.write_parquet(testing_data, tmp_path / "sales-2.parquet")
+
+        dataset = DatasetStore(str(tmp_path)).dataset
+        assert len(dataset) == 10
+        assert dataset.version == 1
+        assert DatasetStore(str(tmp_path)).dataset.version == 1
+
+    def test_snapshot_disabled(self, testing_data: pd.DataFrame, tmp_path):
+        TestDatasetStore.write_parquet(testing_data, tmp_path / "sales-1.parquet")
+        assert len(DatasetStore(str(tmp_path), snapshot=False).dataset) == 5
+        assert not (tmp_path / SNAPSHOT_DIR).exists()
+
+    def test_unusable_snapshot(self, testing_data: pd.DataFrame, tmp_path):
+        TestDatasetStore.write_parquet(testing_data, tmp_path / "sales-1.parquet")
+        # A file in place of the snapshot directory
+        (tmp_path / SNAPSHOT_DIR).write_text("")
+        store = DatasetStore(str(tmp_path))
+        assert len(store.dataset) == 5
+        assert store.progress.to_dict()["error"] is None
+
+    def test_snapshot_dir(self, testing_data: pd.DataFrame, tmp_path):
+        data_dir, snapshot_dir = tmp_path / "data", tmp_path / "snapshots"
+        data_dir.mkdir()
+        TestDatasetStore.write_parquet(testing_data, data_dir / "sales-1.parquet")
+        DatasetStore(str(data_dir), snapshot_dir=str(snapshot_dir)).dataset
+        assert not (data_dir / SNAPSHOT_DIR).exists()
+        with patch("app.dataloader.load_data") as mock_load_data:
+            store = DatasetStore(str(data_dir), snapshot_dir=str(snapshot_dir))
+            assert len(store.dataset) == 5
+            mock_load_data.assert_not_called()
+
+
+class TestDatasetWarmup:
+    """Test background data loading"""
+
+    def test_progress(self, testing_data: pd.DataFrame, tmp_path):
+        TestDatasetStore.write_parquet(testing_data, tmp_path / "sales-1.parquet")
+        TestDatasetStore.write_parquet(testing_data, tmp_path / "sales-2.parquet")
+        store = DatasetStore(str(tmp_path))
+        assert not store.ready
+        assert store.progress.stage == LOAD_STAGES["pending"]
+
+        store.refresh()
+        progress = store.progress.to_dict()
+        assert store.ready
+        assert progress["stage"] == LOAD_STAGES["ready"]
+        assert progress["files_loaded"] == progress["files_total"] == 2
+        assert progress["elapsed_seconds"] >= 0
+
+    def test_warmup(self, testing_data: pd.DataFrame, tmp_path):
+        TestDatasetStore.write_parquet(testing_data, tmp_path / "sales-1.parquet")
+        store = DatasetStore(str(tmp_path))
+        loaded = []
+        warmup = DatasetWarmup(store, on_ready=loaded.append)
+        warmup.start()
+        warmup.join(timeout=10)
+        assert store.ready
+        assert loaded == [store.dataset]
+
+    def test_failed_load_is_retried(self, testing_data: pd.DataFrame, tmp_path):
+        TestDatasetStore.write_parquet(testing_data, tmp_path / "sales-1.parquet")
+        store = DatasetStore(str(tmp_path), snapshot=False)
+        warmup = DatasetWarmup(store)
+        warmup.RETRY_INTERVAL = 0.01
+        failures = [OSError("Data volume isn't mounted yet")]
+
+        def read_data_file(*args):
+            if failures:
+                raise failures.pop()
+            return testing_data.drop(columns="Index")
+
+        with patch("app.dataloader.read_data_file", side_effect=read_data_file):
+            warmup.start()
+            warmup.join(timeout=10)
+        assert store.ready
+        assert store.progress.stage == LOAD_STAGES["ready"]
+        assert store.progress.error is None
+
+    def test_failed_progress(self, tmp_path):
+        store = DatasetStore(str(tmp_path), snapshot=False)
+        with patch("app.dataloader.scan_data_files", side_effect=OSError("Gone")):
+            with pytest.raises(OSError):
+                store.refresh()
+        assert store.progress.stage == LOAD_STAGES["failed"]
+        assert store.progress.error == "Gone"
@@ -0,0 +1,44 @@
+"""Serializers Test"""
+
+import json
+from datetime import date
+
+from app.schemas.base_response import BaseResponse
+from app.schemas.sales_response import (
+    SalesBreakdownSchema,
+    SalesGroup,
+    SalesPeriodSchema,
+    SalesPoint,
+    SalesSeriesSchema,
+    SalesTotalAvgSchema,
+    TotalAvgSales,
+)
+from app.schemas.serializers import dump_response
+
+
+class TestDumpResponse:
+    """Test bodies match the response schemas"""
+
+    def test_sales_schemas(self):
+        total_avg = TotalAvgSales(total=125698.34, average=62849.17)
+        groups = [
+            SalesGroup.model_construct(key="S1", total=1.5, count=2, average=0.75)
+        ]
+        points = [
+            SalesPoint.model_construct(
+                period=date(2024, 1, 1), total=1.5, count=2, rolling_average=None
+            )
+        ]
+        for schema, data in (
+            (SalesTotalAvgSchema, total_avg),
+            (SalesPeriodSchema, {"amount": 147800.0}),
+            (SalesBreakdownSchema, groups),
+            (SalesSeriesSchema, points),
+        ):
+            assert dump_response(data) == schema(data=data).model_dump_json().encode()
+
+    def test_error_response(self):
+        body = dump_response(error_details={"error_msg": "Invalid key"})
+        assert json.loads(body) == BaseResponse(
+            error_details={"error_msg": "Invalid key"}
+        ).model_dump(mode="json")
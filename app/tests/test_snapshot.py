@@ -0,0 +1,38 @@
+"""Snapshot Test"""
+
+import numpy as np
+
+from app.snapshot import LATEST_FILE, read_snapshot, write_snapshot
+
+
+class TestSnapshot:
+    """Test Arrow IPC snapshots"""
+
+    def test_round_trip(self, tmp_path):
+        arrays = {
+            "days": np.array([19723, 19724], dtype=np.int32),
+            "amounts": np.array([1.5, 2.5]),
+            "dictionary": np.array(["P1", "P2"], dtype=object),
+            "empty": np.array([], dtype=object),
+        }
+        write_snapshot(str(tmp_path), arrays, {"version": 3})
+        restored, metadata = read_snapshot(str(tmp_path))
+        assert metadata == {"version": 3}
+        assert restored["days"].dtype == np.int32
+        assert np.array_equal(restored["days"], arrays["days"])
+        assert np.array_equal(restored["amounts"], arrays["amounts"])
+        assert restored["dictionary"].tolist() == ["P1", "P2"]
+        assert restored["empty"].size == 0
+
+    def test_latest_snapshot(self, tmp_path):
+        write_snapshot(str(tmp_path), {"days": np.array([1])}, {"version": 0})
+        write_snapshot(str(tmp_path), {"days": np.array([2])}, {"version": 1})
+        arrays, metadata = read_snapshot(str(tmp_path))
+        assert metadata["version"] == 1
+        assert arrays["days"].tolist() == [2]
+        snapshots = [path for path in tmp_path.iterdir() if path.is_dir()]
+        assert len(snapshots) == 1
+        assert (tmp_path / LATEST_FILE).read_text() == snapshots[0].name
+
+    def test_missing_snapshot(self, tmp_path):
+        assert read_snapshot(str(tmp_path)) is None
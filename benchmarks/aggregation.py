@@ -0,0 +1,152 @@
+"""Micro-benchmark of the filtered sales total.
+
+Compares, per query shape, the latency and the peak memory allocated by:
+
+- `query`: `DataFrame.query` copying the matching rows into a new frame and
+  another frame to multiply `Qty * CostAmount`, the original implementation
+- `positions`: the positions of the matching rows and the gathered amounts
+  (`_filter_data` + `amounts[positions].sum()`)
+- `fused`: the single-pass masked sum and count over row blocks
+  (`CompiledFilters.aggregate`)
+
+over synthetic sales generated in memory (See `benchmarks.generate_data`).
+
+    python -m benchmarks.aggregation --rows 2000000
+"""
+
+import argparse
+import timeit
+import tracemalloc
+from datetime import timedelta
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+from app.constants import FILTER_OPERATORS, KEYS_CONSTANTS
+from app.dataloader import Filter, SalesDataset
+from app.services.predicates import compile_filters
+from app.services.sales import SalesService
+from benchmarks.generate_data import generate_chunks
+
+REPEAT = 5
+
+
+def query_shapes(dataset: SalesDataset) -> Dict[str, List[Filter]]:
+    """Filters of broad queries, the ones the rollups and indexes don't
+    narrow down to a few rows"""
+    first_day = np.datetime64(int(dataset.days[0]), "D").item()
+    stores = dataset.dictionaries[KEYS_CONSTANTS["Store"]]
+    products = dataset.dictionaries[KEYS_CONSTANTS["Product"]]
+
+    def period(days: int) -> List[Filter]:
+        return [
+            Filter(KEYS_CONSTANTS["Date"], FILTER_OPERATORS["gte"], first_day),
+            Filter(
+                KEYS_CONSTANTS["Date"],
+                FILTER_OPERATORS["lte"],
+                first_day + timedelta(days=days - 1),
+            ),
+        ]
+
+    return {
+        "period_365": period(365),
+        "period_90_store_range": [
+            *period(90),
+            Filter(
+                KEYS_CONSTANTS["Store"],
+                FILTER_OPERATORS["lte"],
+                stores[len(stores) // 2],
+            ),
+        ],
+        "period_30_store_list": [
+            *period(30),
+            Filter(KEYS_CONSTANTS["Store"], FILTER_OPERATORS["in"], tuple(stores[::4])),
+        ],
+        "product_range": [
+            Filter(
+                KEYS_CONSTANTS["Product"],
+                FILTER_OPERATORS["gt"],
+                products[len(products) // 4],
+            ),
+        ],
+    }
+
+
+def query_total(data: pd.DataFrame, filters: List[Filter]) -> float:
+    """Total of the original implementation: a `DataFrame.query` of the
+    filters and a new frame of the row amounts"""
+    conditions = []
+    params = {}
+    for position, filter in enumerate(filters):
+        param = f"value_{position}"
+        value = filter.value
+        if filter.key == KEYS_CONSTANTS["Date"]:
+            value = pd.Timestamp(value)
+        params[param] = list(value) if filter.operator == "in" else value
+        conditions.append(f"{filter.key} {filter.operator} @{param}")
+    filtered = data.query(" & ".join(conditions), local_dict=params)
+    totals = pd.DataFrame()
+    totals["Total"] = filtered["Qty"] * filtered["CostAmount"]
+    return round(totals["Total"].sum(), 2)
+
+
+def positions_total(dataset: SalesDataset, filters: List[Filter]) -> float:
+    positions = SalesService(filters)._filter_data(dataset)
+    return round(float(dataset.amounts[positions].sum()), 2)
+
+
+def fused_total(dataset: SalesDataset, filters: List[Filter]) -> float:
+    total, _ = compile_filters(dataset, filters).aggregate(dataset.amounts)
+    return round(total, 2)
+
+
+def bench(function: Callable, number: int) -> float:
+    """Best time per call in milliseconds"""
+    return min(timeit.repeat(function, number=number, repeat=REPEAT)) / number * 1e3
+
+
+def peak_allocated(function: Callable) -> int:
+    """Peak bytes allocated during a call"""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--number", type=int, default=5, help="Calls per repeat")
+    args = parser.parse_args()
+
+    data = pd.concat(generate_chunks(args.rows), ignore_index=True)
+    dataset = SalesDataset(data)
+    data = data.sort_values(KEYS_CONSTANTS["Date"], kind="stable")
+    print(f"{len(dataset)} rows")
+    print(
+        f"{'query shape':<24}{'':<10}{'query':>12}{'positions':>12}{'fused':>12}"
+        f"{'speedup':>10}"
+    )
+    for shape, filters in query_shapes(dataset).items():
+        implementations = [
+            lambda: query_total(data, filters),
+            lambda: positions_total(dataset, filters),
+            lambda: fused_total(dataset, filters),
+        ]
+        totals = {implementation() for implementation in implementations}
+        assert len(totals) == 1, f"{shape} totals differ: {totals}"
+        latencies = [bench(function, args.number) for function in implementations]
+        peaks = [peak_allocated(function) / 2**20 for function in implementations]
+        print(
+            f"{shape:<24}{'ms':<10}"
+            + "".join(f"{latency:>12.2f}" for latency in latencies)
+            + f"{latencies[0] / latencies[2]:>9.1f}x"
+        )
+        print(f"{'':<24}{'peak MiB':<10}" + "".join(f"{peak:>12.2f}" for peak in peaks))
+
+
+if __name__ == "__main__":
+    main()
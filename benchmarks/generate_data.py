@@ -0,0 +1,101 @@
+"""Synthetic sales data generator.
+
+Writes parquet files with the schema `load_data` expects (`KeyDate`,
+`KeyEmployee`, `KeyProduct`, `KeyStore`, `Qty` and `CostAmount`), chunk by
+chunk so 100M rows don't need to fit in memory. Product sales follow a Zipf
+like popularity and every employee sells in a single store, as in the real
+data.
+
+    python -m benchmarks.generate_data --rows 1000000 --output data/
+"""
+
+import argparse
+import os
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from app.constants import KEYS_CONSTANTS
+
+ROWS_PER_FILE = 1_000_000
+
+
+def key_values(prefix: str, cardinality: int) -> np.ndarray:
+    """Key values shaped as the real ones, e.g. `1|43085`"""
+    return np.array([f"{prefix}|{value}" for value in range(cardinality)], dtype=object)
+
+
+def generate_chunks(
+    rows: int,
+    employees: int = 2000,
+    products: int = 50000,
+    stores: int = 200,
+    start: str = "2022-01-01",
+    days: int = 730,
+    seed: int = 0,
+    chunk_rows: int = ROWS_PER_FILE,
+) -> Iterator[pd.DataFrame]:
+    """Yields frames of synthetic sales adding up to `rows` rows"""
+    rng = np.random.default_rng(seed)
+    employee_values = key_values("1", employees)
+    product_values = key_values("1", products)
+    store_values = key_values("1", stores)
+    employee_stores = rng.integers(0, stores, employees)
+    # Zipf like popularity: a few products account for most sales
+    popularity = 1.0 / np.arange(1, products + 1) ** 0.8
+    popularity = rng.permutation(popularity / popularity.sum())
+    product_costs = np.round(rng.lognormal(mean=8.0, sigma=1.0, size=products), 2)
+    first_day = pd.Timestamp(start).to_datetime64().astype("datetime64[D]")
+
+    for offset in range(0, rows, chunk_rows):
+        size = min(chunk_rows, rows - offset)
+        employee_codes = rng.integers(0, employees, size)
+        product_codes = rng.choice(products, size=size, p=popularity)
+        sale_days = first_day + rng.integers(0, days, size).astype("timedelta64[D]")
+        yield pd.DataFrame(
+            {
+                KEYS_CONSTANTS["Date"]: sale_days.astype("datetime64[ns]"),
+                KEYS_CONSTANTS["Employee"]: employee_values[employee_codes],
+                KEYS_CONSTANTS["Product"]: product_values[product_codes],
+                KEYS_CONSTANTS["Store"]: store_values[employee_stores[employee_codes]],
+                "Qty": rng.integers(1, 11, size).astype(np.float64),
+                "CostAmount": product_costs[product_codes],
+            }
+        )
+
+
+def write_data(output: str, rows: int, **options) -> int:
+    """Writes the synthetic sales into one parquet file per chunk. Returns
+    the number of written files"""
+    os.makedirs(output, exist_ok=True)
+    files = 0
+    for files, chunk in enumerate(generate_chunks(rows, **options), start=1):
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        pq.write_table(table, os.path.join(output, f"sales-{files:05d}.parquet"))
+    return files
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="data/", help="Data directory")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--employees", type=int, default=2000)
+    parser.add_argument("--products", type=int, default=50000)
+    parser.add_argument("--stores", type=int, default=200)
+    parser.add_argument("--start", default="2022-01-01", help="First sales day")
+    parser.add_argument("--days", type=int, default=730, help="Days of sales")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--rows-per-file", dest="chunk_rows", type=int, default=ROWS_PER_FILE
+    )
+    args = vars(parser.parse_args())
+    output, rows = args.pop("output"), args.pop("rows")
+    files = write_data(output, rows, **args)
+    print(f"{rows} rows written to {files} files in {output}")
+
+
+if __name__ == "__main__":
+    main()
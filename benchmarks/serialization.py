@@ -0,0 +1,79 @@
+"""Micro-benchmark of the sales responses serialization.
+
+Compares, per response, the default FastAPI path (building the response
+schema, validating it and encoding it with `jsonable_encoder` + `json`),
+pydantic's `model_dump_json` and the prebuilt orjson serializers.
+
+    python -m benchmarks.serialization
+"""
+
+import timeit
+from datetime import date, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app.schemas.sales_response import (
+    SalesBreakdownSchema,
+    SalesGroup,
+    SalesPoint,
+    SalesSeriesSchema,
+    SalesTotalAvgSchema,
+    TotalAvgSales,
+)
+from app.schemas.serializers import dump_response
+
+REPEAT = 5
+
+
+def responses():
+    total_avg = TotalAvgSales(total=43227797.46, average=18465.52646732166)
+    groups = [
+        SalesGroup.model_construct(
+            key=f"P{i}", total=1000.0 - i, count=i + 1, average=(1000.0 - i) / (i + 1)
+        )
+        for i in range(1000)
+    ]
+    points = [
+        SalesPoint.model_construct(
+            period=date(2024, 1, 1) + timedelta(days=i),
+            total=1500.25 * i,
+            count=i,
+            rolling_average=1400.5 * i,
+        )
+        for i in range(365)
+    ]
+    return {
+        "total_avg": (SalesTotalAvgSchema, total_avg),
+        "breakdown_1000": (SalesBreakdownSchema, groups),
+        "series_365": (SalesSeriesSchema, points),
+    }
+
+
+def bench(function, number: int) -> float:
+    """Best time per call in microseconds"""
+    return min(timeit.repeat(function, number=number, repeat=REPEAT)) / number * 1e6
+
+
+def main() -> None:
+    print(
+        f"{'response':<16}{'fastapi':>12}{'pydantic':>12}{'orjson':>12}{'speedup':>10}"
+    )
+    for name, (schema, data) in responses().items():
+        number = 20000 if name == "total_avg" else 50
+        fastapi_path = bench(
+            lambda: JSONResponse(
+                jsonable_encoder(schema.model_validate(schema(data=data)))
+            ).body,
+            number,
+        )
+        pydantic_path = bench(lambda: schema(data=data).model_dump_json(), number)
+        orjson_path = bench(lambda: dump_response(data), number)
+        print(
+            f"{name:<16}{fastapi_path:>10.1f}us{pydantic_path:>10.1f}us"
+            f"{orjson_path:>10.1f}us{fastapi_path / orjson_path:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""Benchmark suite of the sales microservice.
+
+Measures data load time and memory, `_filter_data`, `sales_by_period`,
+`total_avg_sales` and the end-to-end latency of the sales endpoints over a
+data directory (See `benchmarks.generate_data`). Results are written as JSON
+and metrics more than `--threshold` worse than the baseline are flagged,
+making the run exit with status 1. Runs over another number of rows or
+queries than the baseline aren't compared and exit with status 2.
+
+    python -m benchmarks.generate_data --rows 1000000 --output /tmp/sales
+    python -m benchmarks.suite --data-dir /tmp/sales --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Days of the periods used by the queries
+PERIOD_DAYS = 30
+# Latency changes smaller than this are noise, whatever their ratio
+NOISE_FLOOR_MS = 0.1
+# Run settings the baseline must share with a run to be compared with it
+COMPARABLE_META = ("rows", "queries")
+
+
+def percentiles(durations: List[float]) -> Dict[str, float]:
+    milliseconds = np.array(durations) * 1e3
+    return {
+        "p50_ms": float(np.percentile(milliseconds, 50)),
+        "p95_ms": float(np.percentile(milliseconds, 95)),
+    }
+
+
+def timed(function: Callable, calls: List[Tuple]) -> Dict[str, float]:
+    durations = []
+    for args in calls:
+        started_at = time.perf_counter()
+        function(*args)
+        durations.append(time.perf_counter() - started_at)
+    return percentiles(durations)
+
+
+class SalesBenchmark:
+    """Runs the benchmarks over the data of `data_dir`"""
+
+    def __init__(
+        self, data_dir: str, snapshot_dir: str, queries: int, seed: int = 0
+    ) -> None:
+        self._data_dir = data_dir
+        # Empty directory the snapshots are built in, not the one of the app
+        self._snapshot_dir = snapshot_dir
+        self._queries = queries
+        self._rng = np.random.default_rng(seed)
+        self.metrics: Dict[str, float] = {}
+        self.skipped: Dict[str, str] = {}
+
+    def run(self) -> None:
+        dataset = self.bench_load()
+        self.bench_queries(dataset)
+        self.bench_http(dataset)
+
+    def bench_load(self):
+        from app.dataloader import DatasetStore
+
+        started_at = time.perf_counter()
+        dataset = DatasetStore(self._data_dir, snapshot=False).dataset
+        self.metrics["load.cold_seconds"] = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        DatasetStore(self._data_dir, snapshot_dir=self._snapshot_dir).dataset
+        self.metrics["load.snapshot_build_seconds"] = time.perf_counter() - started_at
+        started_at = time.perf_counter()
+        DatasetStore(self._data_dir, snapshot_dir=self._snapshot_dir).dataset
+        self.metrics["load.snapshot_open_seconds"] = time.perf_counter() - started_at
+
+        report = dataset.memory_report()
+        self.metrics["memory.loaded_bytes"] = sum(loaded for _, loaded, _ in report)
+        self.metrics["memory.compact_bytes"] = sum(compact for _, _, compact in report)
+        # Linux reports the max resident set size in KiB
+        self.metrics["memory.max_rss_bytes"] = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        )
+        return dataset
+
+    def sample_queries(self, dataset) -> Dict[str, List[Dict[str, Any]]]:
+        """Query params by query shape, over keys and periods of the data"""
+        from app.constants import KEYS_CONSTANTS
+
+        def values(key: str):
+            return self._rng.choice(dataset.dictionaries[key], self._queries)
+
+        first_day = np.datetime64(int(dataset.days[0]), "D")
+        span = max(int(dataset.days[-1] - dataset.days[0]) - PERIOD_DAYS, 1)
+        starts = first_day + self._rng.integers(0, span, self._queries)
+        periods = [
+            {
+                "start_period": start.item(),
+                "end_period": start.item() + timedelta(days=PERIOD_DAYS),
+            }
+            for start in starts
+        ]
+        products = values(KEYS_CONSTANTS["Product"])
+        stores = values(KEYS_CONSTANTS["Store"])
+        return {
+            "product": [{"key_product": value} for value in products],
+            "product_period": [
+                {"key_product": value, **period}
+                for value, period in zip(products, periods)
+            ],
+            "store_product": [
+                {"key_store": store, "key_product": product}
+                for store, product in zip(stores, products)
+            ],
+            "store_product_period": [
+                {"key_store": store, "key_product": product, **period}
+                for store, product, period in zip(stores, products, periods)
+            ],
+            # Comma-separated lists, filtered as `in` filters
+            "store_list_period": [
+                {"key_store": ",".join(store_list), **period}
+                for store_list, period in zip(
+                    self._rng.choice(
+                        dataset.dictionaries[KEYS_CONSTANTS["Store"]],
+                        (self._queries, 3),
+                    ),
+                    periods,
+                )
+            ],
+        }
+
+    def bench_queries(self, dataset) -> None:
+        from app.services.sales import SalesService
+
+        for shape, queries in self.sample_queries(dataset).items():
+            services = [(SalesService(build_filters(**query)),) for query in queries]
+            self.add(
+                f"filter_data.{shape}",
+                timed(lambda service: service._filter_data(dataset), services),
+            )
+            if "period" in shape:
+                self.add(
+                    f"sales_by_period.{shape}",
+                    timed(lambda service: service.sales_by_period(), services),
+                )
+            else:
+                self.add(
+                    f"total_avg_sales.{shape}",
+                    timed(lambda service: service.total_avg_sales(), services),
+                )
+
+    def bench_http(self, dataset) -> None:
+        try:
+            import httpx
+
+            from app.api.auth import validate_token
+            from app.main import app
+        except Exception as e:
+            self.skipped["http"] = f"The app couldn't be imported: {e}"
+            return
+
+        app.dependency_overrides[validate_token] = lambda: True
+        queries = self.sample_queries(dataset)
+
+        async def requests() -> None:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://benchmark"
+            ) as client:
+                for shape, path in (
+                    ("product", "/sales/"),
+                    ("product_period", "/sales/period"),
+                ):
+                    durations = []
+                    for params in queries[shape]:
+                        started_at = time.perf_counter()
+                        response = await client.get(path, params=params)
+                        durations.append(time.perf_counter() - started_at)
+                        response.raise_for_status()
+                    self.add(f"http.{shape}", percentiles(durations))
+
+        asyncio.run(requests())
+
+    def add(self, name: str, values: Dict[str, float]) -> None:
+        for suffix, value in values.items():
+            self.metrics[f"{name}.{suffix}"] = value
+
+
+def build_filters(**params) -> List:
+    """Filters the sales endpoints build from their query params"""
+    from app.api.sales import build_filters
+
+    keys = {"key_employee": None, "key_product": None, "key_store": None}
+    return build_filters(**{**keys, **params})
+
+
+def incomparable_meta(meta: Dict[str, Any], baseline_meta: Dict[str, Any]) -> List[str]:
+    """Run settings differing from the ones of the baseline"""
+    return [
+        f"{name} {baseline_meta.get(name)} (baseline) != {meta[name]}"
+        for name in COMPARABLE_META
+        if baseline_meta.get(name) != meta[name]
+    ]
+
+
+def compare(
+    metrics: Dict[str, float], baseline: Dict[str, float], threshold: float
+) -> List[str]:
+    """Prints every metric against the baseline and returns the regressed
+    ones. Every metric is better the lower it is"""
+    regressions = []
+    print(f"{'metric':<48}{'baseline':>14}{'current':>14}{'change':>9}")
+    for name, value in metrics.items():
+        expected = baseline.get(name)
+        if not expected:
+            print(f"{name:<48}{'-':>14}{value:>14.4g}")
+            continue
+        change = value / expected - 1
+        flag = ""
+        noise = name.endswith("_ms") and value - expected < NOISE_FLOOR_MS
+        if change > threshold and not noise:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<48}{expected:>14.4g}{value:>14.4g}{change:>+9.0%}{flag}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data-dir", required=True)
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="Store results as baseline"
+    )
+    args = parser.parse_args()
+
+    # The app reads these settings when its modules are imported
+    os.environ["SALES_DATA_DIR"] = args.data_dir
+    os.environ["SALES_ENGINE"] = "memory"
+    os.environ["RESPONSE_CACHE_SIZE"] = "0"
+    os.environ["DATA_REFRESH_INTERVAL"] = "0"
+    # Snapshots of the benchmark never replace the one the app serves from
+    snapshot_dir = tempfile.mkdtemp(prefix="sales-snapshot-")
+    os.environ["SALES_SNAPSHOT_DIR"] = snapshot_dir
+
+    try:
+        benchmark = SalesBenchmark(args.data_dir, snapshot_dir, args.queries, args.seed)
+        benchmark.run()
+        from app.dataloader import dataset_store
+
+        results = {
+            "meta": {
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "rows": len(dataset_store.dataset),
+                "files": len(dataset_store.dataset.files),
+                "queries": args.queries,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+            },
+            "metrics": benchmark.metrics,
+            "skipped": benchmark.skipped,
+        }
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline:
+            json.dump(results, baseline, indent=2)
+
+    for name, reason in benchmark.skipped.items():
+        print(f"Skipped {name}: {reason}")
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    differences = incomparable_meta(results["meta"], baseline["meta"])
+    if differences:
+        # Latencies over another data size say nothing about regressions
+        print(f"Not compared with the baseline: {', '.join(differences)}")
+        sys.exit(2)
+    regressions = compare(benchmark.metrics, baseline["metrics"], args.threshold)
+    if regressions:
+        print(f"{len(regressions)} metrics regressed over {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()